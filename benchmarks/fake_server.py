@@ -0,0 +1,339 @@
+""" Local stand-in for the podcast hosts, their CDN and archive.org, for the benchmarks.
+
+Everything is synthetic and deterministic, so two runs see the same bytes:
+
+    GET /feed/<name>.xml?entries=N&audio_size=B&desc_bytes=B&encoding=utf-8&declare=1&charset=0&image=0
+        RSS feed of N entries (newest first), with `ETag`/`Last-Modified` and 304s.
+        `encoding`: of the body, `declare`: in the XML declaration, `charset`: in the `Content-Type`.
+    GET /audio/<name>/<i>.mp3?size=B
+        enclosure, `ETag` and `Range` (`If-Range`) support
+    GET /image/<name>.jpg
+
+    archive.org (the benchmarks rewrite the archive.org URLs to this server):
+    GET  /services/search/v1/scrape, /metadata/<identifier>, /?check_limit=1 (S3)
+    POST /metadata/<identifier>     (metadata patch)
+    PUT  /<identifier>/<filename>   (S3 upload)
+
+    GET /_stats  requests and bytes sent by kind (feed, audio, image, ia), `/_*` are not counted
+    POST /_reset
+
+Run it standalone with `python benchmarks/fake_server.py --port 8765`.
+"""
+import argparse
+from email.utils import formatdate
+import functools
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+from xml.sax.saxutils import escape, quoteattr
+
+
+FEED_EPOCH = 1700000000 # pubDate of the newest entry
+FEED_LAST_MODIFIED = formatdate(FEED_EPOCH, usegmt=True)
+DEFAULT_ENTRIES = 20
+DEFAULT_AUDIO_SIZE = 256 * 1024
+DEFAULT_DESC_BYTES = 500
+IMAGE_SIZE = 16 * 1024
+
+# non-ASCII in every title: `encoding`s that can't represent them get XML character references
+TITLE_SAMPLE = 'Épisode 播客'
+LOREM = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor '
+         'incididunt ut labore et dolore magna aliqua. ')
+
+
+def _int_param(query: Dict[str, List[str]], name: str, default: int) -> int:
+    return int(query.get(name, [default])[0])
+
+
+def _str_param(query: Dict[str, List[str]], name: str, default: str) -> str:
+    return query.get(name, [default])[0]
+
+
+def _pattern(seed: str, size: int) -> bytes:
+    digest = hashlib.sha1(seed.encode('utf-8')).digest()
+    return (digest * (size // len(digest) + 1))[:size]
+
+
+@functools.lru_cache(maxsize=64)
+def audio_bytes(name: str, i: int, size: int) -> bytes:
+    return _pattern(f'{name}/{i}', size)
+
+
+@functools.lru_cache(maxsize=8)
+def image_bytes(name: str) -> bytes:
+    return b'\xff\xd8\xff\xe0' + _pattern(f'image/{name}', IMAGE_SIZE)
+
+
+@functools.lru_cache(maxsize=32)
+def feed_bytes(base_url: str, name: str, entries: int, audio_size: int, desc_bytes: int,
+               encoding: str, declare: bool, image: bool) -> bytes:
+    description = (LOREM * (desc_bytes // len(LOREM) + 1))[:desc_bytes]
+    items = []
+    for i in range(entries):
+        items.append(
+            f'<item><title>{escape(f"{TITLE_SAMPLE} {i}: {name}")}</title>'
+            f'<guid isPermaLink="false">{name}-guid-{i}</guid>'
+            f'<pubDate>{formatdate(FEED_EPOCH - i * 86400, usegmt=True)}</pubDate>'
+            f'<description>{escape(description)}</description>'
+            f'<enclosure url={quoteattr(f"{base_url}/audio/{name}/{i}.mp3?size={audio_size}")} '
+            f'length="{audio_size}" type="audio/mpeg"/></item>\n'
+        )
+    channel_image = f'<itunes:image href={quoteattr(f"{base_url}/image/{name}.jpg")}/>' if image else ''
+    declaration = f'<?xml version="1.0" encoding="{encoding}"?>' if declare else '<?xml version="1.0"?>'
+    text = (
+        f'{declaration}\n'
+        '<rss version="2.0" xmlns:itunes="http://www.itunes.com/dtds/podcast-1.0.dtd"><channel>\n'
+        f'<title>{escape(f"{TITLE_SAMPLE} {name}")}</title><link>http://example.com/{name}</link>'
+        f'<description>{escape(description)}</description><language>en</language>{channel_image}\n'
+        f'{"".join(items)}</channel></rss>\n'
+    )
+    return text.encode(encoding, 'xmlcharrefreplace')
+
+
+class FakeItems:
+    """ archive.org items, visible as soon as they are uploaded """
+    def __init__(self):
+        self.items: Dict[str, dict] = {}
+        self.lock = threading.Lock()
+
+    def get(self, identifier: str) -> Optional[dict]:
+        with self.lock:
+            return self.items.get(identifier)
+
+    def put_file(self, identifier: str, filename: str, size: int, headers) -> None:
+        with self.lock:
+            item = self.items.get(identifier)
+            if item is None:
+                item = self.items[identifier] = {'metadata': self.meta_headers(headers), 'files': []}
+            item['files'].append({'name': filename, 'size': str(size)})
+
+    def patch(self, identifier: str, patch: List[dict]) -> bool:
+        with self.lock:
+            item = self.items.get(identifier)
+            if item is None:
+                return False
+            for op in patch:
+                key = op['path'].strip('/').split('/')[0]
+                if op['op'] in ('add', 'replace'):
+                    item['metadata'][key] = op['value']
+                elif op['op'] == 'remove':
+                    item['metadata'].pop(key, None)
+            return True
+
+    @staticmethod
+    def meta_headers(headers) -> dict:
+        ''' `x-archive-meta[NN]-key: [uri(...)]value` of the first S3 PUT '''
+        metadata: dict = {}
+        for header, value in headers.items():
+            m = re.match(r'x-archive-meta(\d\d)?-(.+)', header.lower())
+            if not m:
+                continue
+            value = unquote(value[4:-1]) if value.startswith('uri(') else value
+            key = m.group(2).replace('--', '_')
+            if m.group(1):
+                metadata.setdefault(key, []).append(value)
+            else:
+                metadata[key] = value
+        return metadata
+
+
+class FakeServer:
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.items = FakeItems()
+        self.requests: Dict[str, int] = {}
+        self.bytes_sent: Dict[str, int] = {}
+        self.bytes_received: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.httpd.daemon_threads = True
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def count(self, kind: str, sent: int, received: int = 0):
+        with self._lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+            self.bytes_sent[kind] = self.bytes_sent.get(kind, 0) + sent
+            self.bytes_received[kind] = self.bytes_received.get(kind, 0) + received
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'requests': dict(self.requests), 'bytes_sent': dict(self.bytes_sent),
+                    'bytes_received': dict(self.bytes_received)}
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+            self.bytes_sent.clear()
+            self.bytes_received.clear()
+
+    def start(self) -> 'FakeServer':
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='fake-server', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _make_handler(server: FakeServer):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, kind: Optional[str], code: int, body: bytes = b'',
+                  headers: Optional[Dict[str, str]] = None, received: int = 0):
+            self.send_response(code)
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+            if kind is not None:
+                server.count(kind, len(body), received)
+
+        def reply_json(self, kind: Optional[str], obj, code: int = 200, received: int = 0):
+            self.reply(kind, code, json.dumps(obj).encode('utf-8'), {'Content-Type': 'application/json'}, received)
+
+        def read_body(self) -> bytes:
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        def do_GET(self):
+            u = urlparse(self.path)
+            query = parse_qs(u.query)
+            if u.path == '/_stats':
+                return self.reply_json(None, server.stats())
+
+            m = re.fullmatch(r'/feed/([\w-]+)\.xml', u.path)
+            if m:
+                return self.feed(m.group(1), query)
+            m = re.fullmatch(r'/audio/([\w-]+)/(\d+)\.mp3', u.path)
+            if m:
+                return self.audio(m.group(1), int(m.group(2)), _int_param(query, 'size', DEFAULT_AUDIO_SIZE))
+            m = re.fullmatch(r'/image/([\w-]+)\.jpg', u.path)
+            if m:
+                return self.reply('image', 200, image_bytes(m.group(1)), {'Content-Type': 'image/jpeg'})
+
+            if 'check_limit' in query:
+                return self.reply_json('ia', {'over_limit': 0})
+            if u.path.startswith('/services/search/v1/scrape'):
+                identifiers = re.findall(r'podcast_ep_[0-9a-f]{40}', _str_param(query, 'q', ''))
+                items = [{'identifier': i, 'upload-state': item['metadata'].get('upload-state')}
+                         for i in identifiers if (item := server.items.get(i)) is not None]
+                return self.reply_json('ia', {'items': items, 'count': len(items), 'total': len(items)})
+            m = re.fullmatch(r'/metadata/([^/]+)', u.path)
+            if m:
+                item = server.items.get(m.group(1))
+                if item is None:
+                    return self.reply_json('ia', {})
+                return self.reply_json('ia', {'metadata': dict(item['metadata'], identifier=m.group(1)),
+                                              'files': item['files'], 'created': int(time.time()),
+                                              'server': 'localhost', 'dir': '/', 'd1': 'localhost'})
+            self.reply(None, 404)
+
+        def do_HEAD(self):
+            self.do_GET()
+
+        def feed(self, name: str, query: Dict[str, List[str]]):
+            encoding = _str_param(query, 'encoding', 'utf-8')
+            etag = '"' + hashlib.sha1(self.path.encode('utf-8')).hexdigest()[:16] + '"'
+            headers = {'ETag': etag, 'Last-Modified': FEED_LAST_MODIFIED}
+            if self.headers.get('If-None-Match') == etag or self.headers.get('If-Modified-Since') == FEED_LAST_MODIFIED:
+                return self.reply('feed', 304, headers=headers)
+            body = feed_bytes(
+                server.url, name,
+                entries=_int_param(query, 'entries', DEFAULT_ENTRIES),
+                audio_size=_int_param(query, 'audio_size', DEFAULT_AUDIO_SIZE),
+                desc_bytes=_int_param(query, 'desc_bytes', DEFAULT_DESC_BYTES),
+                encoding=encoding,
+                declare=_str_param(query, 'declare', '1') != '0',
+                image=_str_param(query, 'image', '0') != '0',
+            )
+            content_type = 'application/rss+xml'
+            if _str_param(query, 'charset', '0') != '0':
+                content_type += f'; charset={encoding}'
+            headers['Content-Type'] = content_type
+            self.reply('feed', 200, body, headers)
+
+        def audio(self, name: str, i: int, size: int):
+            data = audio_bytes(name, i, size)
+            etag = f'"{name}-{i}-{size}"'
+            headers = {'ETag': etag, 'Last-Modified': FEED_LAST_MODIFIED, 'Content-Type': 'audio/mpeg',
+                       'Accept-Ranges': 'bytes'}
+            range_header = self.headers.get('Range')
+            if_range = self.headers.get('If-Range')
+            m = re.fullmatch(r'bytes=(\d+)-', range_header or '')
+            if m and (if_range is None or if_range == etag) and int(m.group(1)) < size:
+                start = int(m.group(1))
+                headers['Content-Range'] = f'bytes {start}-{size - 1}/{size}'
+                return self.reply('audio', 206, data[start:], headers)
+            self.reply('audio', 200, data, headers)
+
+        def do_POST(self):
+            u = urlparse(self.path)
+            body = self.read_body()
+            if u.path == '/_reset':
+                server.reset()
+                return self.reply(None, 204)
+            m = re.fullmatch(r'/metadata/([^/]+)', u.path)
+            if m:
+                form = parse_qs(body.decode('utf-8'))
+                patch = json.loads(form.get('-patch', ['[]'])[0])
+                if not server.items.patch(m.group(1), patch):
+                    return self.reply_json('ia', {'success': False, 'error': 'no such item'}, received=len(body))
+                return self.reply_json('ia', {'success': True}, received=len(body))
+            self.reply(None, 404)
+
+        def do_PUT(self):
+            data = self.read_body()
+            parts = urlparse(self.path).path.strip('/').split('/', 1)
+            if len(parts) != 2:
+                return self.reply(None, 400)
+            server.items.put_file(parts[0], unquote(parts[1]), len(data), self.headers)
+            self.reply('ia', 200, headers={'ETag': '"' + hashlib.md5(data).hexdigest() + '"'}, received=len(data))
+
+    return Handler
+
+
+def stats_of(url: str) -> dict:
+    ''' `/_stats` of a running FakeServer '''
+    from urllib.request import urlopen
+    with urlopen(f'{url}/_stats') as r:
+        return json.load(r)
+
+
+def stats_delta(before: dict, after: dict) -> Tuple[int, int, int]:
+    ''' (requests, bytes_sent, bytes_received) between two `/_stats` '''
+    return tuple( # type: ignore
+        sum(after[key].values()) - sum(before[key].values())
+        for key in ('requests', 'bytes_sent', 'bytes_received')
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake feeds/CDN/archive.org server for the benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    server = FakeServer(args.host, args.port)
+    print(f'serving on {server.url}, e.g. {server.url}/feed/demo.xml?entries=5')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
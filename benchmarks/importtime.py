@@ -0,0 +1,127 @@
+""" Startup cost of the commands: `python -X importtime` of the entry modules, and the wall time of `-h`.
+
+    python benchmarks/importtime.py [-r REPEAT] [-o results.json] [--baseline results.json]
+
+For each module, reports the median cumulative import time and the heaviest top-level
+packages it pulls in. Exits 1 if a module or command got slower than `--threshold`.
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+MODULES = [
+    'preserve_podcasts',
+    'preserve_podcasts.preservePodcasts',
+    'preserve_podcasts.uploadPodcasts',
+    'preserve_podcasts.stats',
+    'preserve_podcasts.lease',
+]
+COMMANDS = {
+    'podcastsPreserve -h': ['-m', 'preserve_podcasts', '-h'],
+    'podcastsUpload -h': ['-m', 'preserve_podcasts.uploadPodcasts', '-h'],
+    'podcastsStats -h': ['-m', 'preserve_podcasts.stats', '-h'],
+}
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.10
+TOP_PACKAGES = 8
+
+# import time:     self [us] | cumulative | imported package
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$')
+
+
+def python_env() -> Dict[str, str]:
+    return dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [str(REPO_DIR), os.environ.get('PYTHONPATH')])))
+
+
+def importtime(module: str) -> Tuple[int, Dict[str, int]]:
+    ''' (cumulative us of `module`, {top-level package: self us}) '''
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          env=python_env(), stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, check=True)
+    total = 0
+    packages: Dict[str, int] = {}
+    for line in proc.stderr.decode('utf-8', 'replace').splitlines():
+        m = IMPORTTIME_RE.match(line)
+        if not m:
+            continue
+        self_us, cumulative_us, name = int(m.group(1)), int(m.group(2)), m.group(4)
+        if name == module and not m.group(3): # the module itself, not nested
+            total = cumulative_us
+        top = name.split('.')[0]
+        packages[top] = packages.get(top, 0) + self_us
+    return total, packages
+
+
+def command_seconds(args: List[str]) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, *args], env=python_env(), stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - start
+
+
+def measure(repeat: int) -> dict:
+    results: dict = {'modules': {}, 'commands': {}}
+    for module in MODULES:
+        runs = [importtime(module) for _ in range(repeat)]
+        packages = runs[-1][1]
+        top = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:TOP_PACKAGES]
+        median_us = statistics.median(total for total, _ in runs)
+        results['modules'][module] = {'import_us': median_us, 'top_packages_us': dict(top)}
+        print(f'{module:<36} {median_us / 1000:8.1f} ms   ' + ', '.join(f'{name} {us / 1000:.1f}' for name, us in top[:5]))
+    for name, args in COMMANDS.items():
+        seconds = statistics.median(command_seconds(args) for _ in range(repeat))
+        results['commands'][name] = {'wall_seconds': seconds}
+        print(f'{name:<36} {seconds * 1000:8.1f} ms')
+    return results
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> List[str]:
+    regressions = []
+    for kind, metric in (('modules', 'import_us'), ('commands', 'wall_seconds')):
+        for name, result in current[kind].items():
+            old = baseline.get(kind, {}).get(name, {}).get(metric)
+            if not old:
+                continue
+            change = (result[metric] - old) / old
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressions.append(name)
+            elif change < -threshold:
+                flag = '  improved'
+            print(f'{name:<36} {change:+8.1%}{flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time of the commands')
+    parser.add_argument('-r', '--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('-o', '--output', type=Path, help='write the results as JSON')
+    parser.add_argument('--baseline', type=Path, help='results JSON to compare with, exits 1 on a regression')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+
+    results = measure(args.repeat)
+    results['python'] = sys.version.split()[0]
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regression(s) over {args.threshold:.0%}: {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
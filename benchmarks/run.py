@@ -0,0 +1,387 @@
+""" Benchmarks of the archiving and upload hot paths, against the local fake server (fake_server.py).
+
+    python benchmarks/run.py -o results.json                   # every scenario
+    python benchmarks/run.py -s do_archive -p entries=500      # one scenario, bigger feed
+    python benchmarks/run.py --baseline results.json           # exits 1 on a regression
+
+Each run of a scenario is a fresh worker process in an empty temporary directory
+(`pod_data/` is relative, and the catalog/registry/rate limiter are per process).
+The worker prepares its data, then measures only the scenario itself: wall time, CPU time,
+peak RSS, read/write syscalls and bytes (`/proc/self/io`), and the requests and bytes
+the fake server saw. ffprobe is needed by every scenario that downloads episodes.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None # type: ignore
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCHMARKS_DIR.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from fake_server import FakeServer, stats_delta, stats_of # noqa: E402
+
+
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.10 # 10%
+# metrics compared against the baseline. Counts (requests, bytes) are deterministic, any change shows
+COMPARED_METRICS = ('wall_seconds', 'cpu_seconds', 'syscalls', 'requests', 'bytes_sent')
+NEEDS_FFPROBE = 'ffprobe'
+
+
+def feed_url(server_url: str, name: str, params: dict) -> str:
+    query = '&'.join(f'{key}={params[key]}' for key in ('entries', 'audio_size', 'desc_bytes', 'encoding')
+                     if key in params)
+    return f'{server_url}/feed/{name}.xml?{query}'
+
+
+# Scenarios: setup(ctx) runs untimed, then run(ctx) is measured. ctx: {'server_url', 'params', ...}
+
+def setup_all_podcast_id(ctx: dict):
+    from preserve_podcasts import preservePodcasts
+    from preserve_podcasts.podcast import Podcast
+
+    os.makedirs(preservePodcasts.DATA_DIR / preservePodcasts.PODCAST_INDEX_DIR)
+    for i in range(ctx['params']['podcasts']):
+        podcast = Podcast()
+        podcast.create(init_feed_url=f'https://feeds.example.com/{i}.xml')
+        podcast['title'] = f'Podcast {i}'
+        preservePodcasts.save_podcast_index_json(podcast)
+    preservePodcasts._podcast_registry = None # listed again by the measured run
+
+
+def run_all_podcast_id(ctx: dict):
+    from preserve_podcasts import preservePodcasts
+    assert len(preservePodcasts.all_podcast_id()) == ctx['params']['podcasts']
+
+
+def setup_download_episode(ctx: dict):
+    from preserve_podcasts import preservePodcasts
+    ctx['session'] = preservePodcasts.make_session()
+
+
+def run_download_episode(ctx: dict):
+    from preserve_podcasts import preservePodcasts
+    params = ctx['params']
+    audio_dir = preservePodcasts.DATA_DIR / preservePodcasts.PODCAST_AUDIO_DIR / 'bench'
+    for i in range(params['episodes']):
+        episode_dir = audio_dir / f'{i:040x}'
+        os.makedirs(episode_dir)
+        preservePodcasts.download_episode(
+            ctx['session'], f"{ctx['server_url']}/audio/bench/{i}.mp3?size={params['audio_size']}",
+            guid=f'bench-guid-{i}', episode_dir=episode_dir, filename=f'{i}.mp3',
+            possible_size=params['audio_size'], title=f'Episode {i}',
+        )
+
+
+def new_podcast(ctx: dict, name: str):
+    from preserve_podcasts import preservePodcasts
+    from preserve_podcasts.podcast import Podcast
+
+    os.makedirs(preservePodcasts.DATA_DIR / preservePodcasts.PODCAST_INDEX_DIR, exist_ok=True)
+    podcast = Podcast()
+    podcast.create(init_feed_url=feed_url(ctx['server_url'], name, ctx['params']))
+    podcast['title'] = name
+    ctx['podcast_json'] = preservePodcasts.save_podcast_index_json(podcast)
+    return podcast
+
+
+def setup_archive_entries(ctx: dict):
+    from preserve_podcasts import preservePodcasts
+    ctx['session'] = preservePodcasts.make_session()
+    podcast = new_podcast(ctx, 'entries')
+    feed = preservePodcasts.get_feed(ctx['session'], podcast.feed_url)
+    ctx['d'] = preservePodcasts.parse_feed(podcast, feed)
+    ctx['podcast_audio_dir'] = preservePodcasts.DATA_DIR / preservePodcasts.PODCAST_AUDIO_DIR / podcast.id
+
+
+def run_archive_entries(ctx: dict):
+    from preserve_podcasts import preservePodcasts
+    preservePodcasts.archive_entries(ctx['d'], ctx['session'], ctx['podcast_audio_dir'],
+                                     incremental=ctx.get('incremental', False))
+
+
+def setup_archive_entries_incremental(ctx: dict):
+    ''' everything archived already: the cost of walking a feed with nothing new '''
+    setup_archive_entries(ctx)
+    run_archive_entries(ctx)
+    ctx['incremental'] = True
+
+
+def setup_do_archive(ctx: dict):
+    from preserve_podcasts import preservePodcasts
+    ctx['session'] = preservePodcasts.make_session()
+    ctx['podcast'] = new_podcast(ctx, 'archive')
+
+
+def run_do_archive(ctx: dict):
+    from preserve_podcasts import preservePodcasts
+    preservePodcasts.do_archive(ctx['podcast'], ctx['session'], incremental=ctx.get('incremental', False))
+
+
+def setup_do_archive_not_modified(ctx: dict):
+    ''' archived already, the feed answers 304 '''
+    setup_do_archive(ctx)
+    run_do_archive(ctx)
+    ctx['incremental'] = True
+
+
+def setup_upload_episode(ctx: dict):
+    from requests.adapters import HTTPAdapter
+
+    from preserve_podcasts import preservePodcasts, uploadPodcasts
+
+    setup_do_archive(ctx)
+    run_do_archive(ctx)
+
+    server_url = ctx['server_url']
+
+    class FakeArchiveAdapter(HTTPAdapter):
+        ''' send the archive.org requests to the fake server '''
+        def send(self, request, **kwargs):
+            scheme, _, rest = request.url.partition('://')
+            host, _, path = rest.partition('/')
+            if host == 'archive.org' or host.endswith('.archive.org'):
+                request.url = f'{server_url}/{path}'
+            return super().send(request, **kwargs)
+
+    keys_file = Path('ia_keys.txt')
+    keys_file.write_text('access\nsecret\n', encoding='utf-8')
+    args = uploadPodcasts.Args(keys_file=keys_file, collection='test_collection', dry_run=False, debug=False)
+    session = uploadPodcasts.make_ia_session(args)
+    adapter = FakeArchiveAdapter()
+    session.get_adapter = lambda url: adapter # type: ignore
+    ctx['args'], ctx['ia_session'] = args, session
+    podcast_audio_dir = preservePodcasts.DATA_DIR / preservePodcasts.PODCAST_AUDIO_DIR / ctx['podcast'].id
+    ctx['episode_dirs'] = sorted(path for path in podcast_audio_dir.iterdir() if path.is_dir())
+
+
+def run_upload_episode(ctx: dict):
+    from preserve_podcasts import uploadPodcasts
+    for episode_dir in ctx['episode_dirs']:
+        result = uploadPodcasts.upload_episode(ctx['podcast'], episode_dir, ctx['args'], ctx['ia_session'])
+        assert result is True, f'{episode_dir}: {result}'
+
+
+class Scenario:
+    def __init__(self, setup: Callable[[dict], None], run: Callable[[dict], None], params: dict,
+                 requires: Optional[str] = None):
+        self.setup = setup
+        self.run = run
+        self.params = params
+        self.requires = requires
+
+
+FEED_PARAMS = {'entries': 50, 'audio_size': 256 * 1024, 'desc_bytes': 2000, 'encoding': 'utf-8'}
+
+SCENARIOS: Dict[str, Scenario] = {
+    'all_podcast_id': Scenario(setup_all_podcast_id, run_all_podcast_id, {'podcasts': 5000}),
+    'download_episode': Scenario(setup_download_episode, run_download_episode,
+                                 {'episodes': 10, 'audio_size': 1024 * 1024}, requires=NEEDS_FFPROBE),
+    'archive_entries': Scenario(setup_archive_entries, run_archive_entries, FEED_PARAMS, requires=NEEDS_FFPROBE),
+    'archive_entries_incremental': Scenario(setup_archive_entries_incremental, run_archive_entries, FEED_PARAMS,
+                                            requires=NEEDS_FFPROBE),
+    'do_archive': Scenario(setup_do_archive, run_do_archive, FEED_PARAMS, requires=NEEDS_FFPROBE),
+    'do_archive_not_modified': Scenario(setup_do_archive_not_modified, run_do_archive, FEED_PARAMS,
+                                        requires=NEEDS_FFPROBE),
+    'upload_episode': Scenario(setup_upload_episode, run_upload_episode, {**FEED_PARAMS, 'entries': 5},
+                               requires=NEEDS_FFPROBE),
+}
+
+
+def read_proc_io() -> Dict[str, int]:
+    ''' syscr, syscw, rchar, wchar... of this process (Linux only) '''
+    try:
+        with open('/proc/self/io', 'r') as f:
+            return {key: int(value) for key, value in (line.split(':') for line in f if ':' in line)}
+    except OSError:
+        return {}
+
+
+def worker(name: str, server_url: str, params: dict, result_path: str):
+    ''' runs in the temporary directory, writes the measurements to `result_path` '''
+    from preserve_podcasts import preservePodcasts
+    from preserve_podcasts.utils.rate_limit import configure_rate_limiter
+
+    preservePodcasts.POST_DOWNLOAD_DELAY = 0
+    configure_rate_limiter(rate=1e9, burst=1000000) # one host serves everything here
+    scenario = SCENARIOS[name]
+    ctx = {'server_url': server_url, 'params': params}
+    scenario.setup(ctx)
+
+    server_before = stats_of(server_url)
+    io_before = read_proc_io()
+    rusage_before = resource.getrusage(resource.RUSAGE_SELF) if resource else None
+    start = time.perf_counter()
+    scenario.run(ctx)
+    wall_seconds = time.perf_counter() - start
+    rusage_after = resource.getrusage(resource.RUSAGE_SELF) if resource else None
+    io_after = read_proc_io()
+    requests, bytes_sent, bytes_received = stats_delta(server_before, stats_of(server_url))
+
+    result = {'wall_seconds': wall_seconds, 'requests': requests, 'bytes_sent': bytes_sent,
+              'bytes_received': bytes_received}
+    if rusage_before and rusage_after:
+        result['cpu_user_seconds'] = rusage_after.ru_utime - rusage_before.ru_utime
+        result['cpu_system_seconds'] = rusage_after.ru_stime - rusage_before.ru_stime
+        result['cpu_seconds'] = result['cpu_user_seconds'] + result['cpu_system_seconds']
+        result['max_rss_kib'] = rusage_after.ru_maxrss # of the whole worker, setup included
+    if io_before and io_after:
+        for key in ('syscr', 'syscw', 'rchar', 'wchar', 'read_bytes', 'write_bytes'):
+            if key in io_after:
+                result[key] = io_after[key] - io_before.get(key, 0)
+        result['syscalls'] = result.get('syscr', 0) + result.get('syscw', 0)
+    with open(result_path, 'w', encoding='utf-8') as f:
+        json.dump(result, f)
+
+
+def run_once(name: str, server_url: str, params: dict, verbose: bool = False) -> dict:
+    workdir = tempfile.mkdtemp(prefix=f'ptp_bench_{name}_')
+    result_path = os.path.join(workdir, 'result.json')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [str(REPO_DIR), os.environ.get('PYTHONPATH')])))
+    try:
+        output = None if verbose else subprocess.DEVNULL
+        subprocess.run([sys.executable, str(Path(__file__).resolve()), '--worker', name,
+                        '--server-url', server_url, '--params', json.dumps(params), '--result', result_path],
+                       cwd=workdir, env=env, stdout=output, stderr=output, check=True)
+        with open(result_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def summarize(runs: List[dict]) -> dict:
+    ''' median of each metric over the runs '''
+    keys = sorted(set().union(*runs))
+    return {key: statistics.median(run[key] for run in runs if key in run) for key in keys}
+
+
+def parse_param(value: str):
+    key, sep, raw = value.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(f'{value!r} is not KEY=VALUE')
+    try:
+        return key, int(raw)
+    except ValueError:
+        return key, raw
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> List[str]:
+    ''' prints the changes, returns the regressions '''
+    regressions = []
+    for name, result in current['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(name)
+        if not base or 'summary' not in base or 'summary' not in result:
+            continue
+        if base.get('params') != result.get('params'):
+            print(f'{name}: params changed, not compared')
+            continue
+        for metric in COMPARED_METRICS:
+            old, new = base['summary'].get(metric), result['summary'].get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else (0.0 if new == old else float('inf'))
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressions.append(f'{name}.{metric}')
+            elif change < -threshold:
+                flag = '  improved'
+            print(f'{name:<28} {metric:<14} {old:>14.4g} -> {new:<14.4g} {change:+8.1%}{flag}')
+    return regressions
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmarks against a local fake feeds/CDN/archive.org server')
+    parser.add_argument('-s', '--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='scenario to run, can be given several times [default: all]')
+    parser.add_argument('-p', '--param', action='append', type=parse_param, default=[], metavar='KEY=VALUE',
+                        help='override a parameter of the scenarios that have it, e.g. entries=500')
+    parser.add_argument('-r', '--repeat', type=int, default=DEFAULT_REPEAT,
+                        help=f'runs per scenario, the median is kept [default: {DEFAULT_REPEAT}]')
+    parser.add_argument('-o', '--output', type=Path, help='write the results as JSON')
+    parser.add_argument('--baseline', type=Path, help='results JSON to compare with, exits 1 on a regression')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help=f'relative change counted as a regression [default: {DEFAULT_THRESHOLD}]')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the output of the workers')
+    # internal: a single measured run, in a worker process
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--server-url', help=argparse.SUPPRESS)
+    parser.add_argument('--params', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    if args.worker:
+        worker(args.worker, args.server_url, json.loads(args.params), args.result)
+        return
+
+    has_ffprobe = shutil.which('ffprobe') is not None
+    overrides = dict(args.param)
+    server = FakeServer().start()
+    results = {
+        'meta': {
+            'time': int(time.time()),
+            'git': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+        },
+        'scenarios': {},
+    }
+    try:
+        for name in args.scenario or SCENARIOS:
+            scenario = SCENARIOS[name]
+            params = {key: overrides.get(key, value) for key, value in scenario.params.items()}
+            if scenario.requires == NEEDS_FFPROBE and not has_ffprobe:
+                print(f'{name}: skipped, ffprobe not found')
+                results['scenarios'][name] = {'params': params, 'skipped': 'ffprobe not found'}
+                continue
+            runs = [run_once(name, server.url, params, verbose=args.verbose) for _ in range(args.repeat)]
+            summary = summarize(runs)
+            results['scenarios'][name] = {'params': params, 'summary': summary, 'runs': runs}
+            print(f"{name:<28} {summary['wall_seconds']:8.3f}s  cpu {summary.get('cpu_seconds', 0):7.3f}s  "
+                  f"syscalls {summary.get('syscalls', 0):>8.0f}  requests {summary['requests']:>5.0f}  "
+                  f"sent {summary['bytes_sent'] / 1024 / 1024:8.2f} MiB")
+    finally:
+        server.stop()
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f'results: {args.output}')
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regression(s) over {args.threshold:.0%}: {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+""" `safe_chars()`: equivalence with the previous implementation, and speed.
+
+    python benchmarks/safe_chars.py [--cases N] [--seed S]
+
+Random titles (ASCII, CJK, emoji, control and NTFS reserved characters, trailing dots,
+lone surrogates) with random options must give exactly the output of the previous
+character-by-character implementation, kept below, or raise the same exception.
+Exits 1 on the first difference.
+"""
+import argparse
+import random
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from preserve_podcasts.utils.util import NTFS_CHARS, UNPRINTABLE_CHARS, safe_chars # noqa: E402
+
+
+def legacy_safe_chars(s: str, replace_space: bool = True, max_bytes: int = 240, replace_last_dot: bool = True) -> str:
+    string = ''.join(c if c not in UNPRINTABLE_CHARS else '' for c in s)
+    to_replace = NTFS_CHARS + (' ' if replace_space else '')
+    string = ''.join(c if c not in to_replace else '_' for c in string)
+    while len(string.encode('utf-8')) > max_bytes:
+        string = string[:-1]
+    if replace_last_dot and string.endswith('.'):
+        string = string[:-1] + '_'
+    return string
+
+
+ALPHABETS = [
+    'abcdefghijklmnopqrstuvwxyz0123456789 -_.',
+    NTFS_CHARS + ' .',
+    UNPRINTABLE_CHARS + '\x7f',
+    'éàüßñøÆ', # 2 bytes
+    '播客中文節目の日本語한국어', # 3 bytes
+    '🎙🎧😀𝄞', # 4 bytes
+]
+
+
+def random_title(rng: random.Random) -> str:
+    length = rng.choice([0, 1, 5, 30, 80, 120, 250, 1000])
+    chars = []
+    for _ in range(length):
+        if rng.random() < 0.002:
+            chars.append(chr(rng.randint(0xD800, 0xDFFF))) # lone surrogate, not encodable
+        else:
+            chars.append(rng.choice(rng.choice(ALPHABETS)))
+    if rng.random() < 0.2:
+        chars.append('.' * rng.randint(1, 3))
+    return ''.join(chars)
+
+
+def outcome(f, *args, **kwargs):
+    try:
+        return f(*args, **kwargs)
+    except Exception as e:
+        return type(e)
+
+
+def check_equivalence(cases: int, seed: int) -> bool:
+    rng = random.Random(seed)
+    for i in range(cases):
+        title = random_title(rng)
+        kwargs = {'replace_space': rng.random() < 0.5, 'max_bytes': rng.choice([0, 1, 2, 3, 4, 5, 30, 100, 240, 255]),
+                  'replace_last_dot': rng.random() < 0.5}
+        expected, got = outcome(legacy_safe_chars, title, **kwargs), outcome(safe_chars, title, **kwargs)
+        if expected != got:
+            print(f'case {i}: safe_chars({title!r}, **{kwargs}) = {got!r}, expected {expected!r}')
+            return False
+    print(f'{cases} random cases (seed {seed}): same output')
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='safe_chars() equivalence and speed')
+    parser.add_argument('--cases', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-n', '--calls', type=int, default=2000)
+    args = parser.parse_args()
+
+    if not check_equivalence(args.cases, args.seed):
+        sys.exit(1)
+
+    titles = {
+        'ascii 60': 'Episode 42: "Hello/World" <live> from the studio, part two.',
+        'cjk 1000': '播客中文節目' * 166 + '。',
+        'emoji 500': '🎙🎧' * 250,
+    }
+    print(f'{"title":<12} {"legacy":>12} {"safe_chars":>12}   us/call')
+    for name, title in titles.items():
+        legacy = min(timeit.repeat(lambda: legacy_safe_chars(title), number=args.calls, repeat=3)) / args.calls
+        current = min(timeit.repeat(lambda: safe_chars(title), number=args.calls, repeat=3)) / args.calls
+        print(f'{name:<12} {legacy * 1e6:>12.1f} {current * 1e6:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+""" Per-call overhead of `@runtimeTypeCheck()`.
+
+    python benchmarks/type_check.py [-n CALLS] [-o results.json]
+
+Compares, for a trivial function and for the decorated hot helpers:
+the plain function (what `PTP_TYPECHECK=off` returns), the decorator, and the
+previous implementation (`inspect.signature()` + `bind()` on every call), kept below for reference.
+"""
+import argparse
+import inspect
+import json
+import sys
+import timeit
+from pathlib import Path
+from typing import Callable, Dict
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from preserve_podcasts.utils import type_check # noqa: E402
+from preserve_podcasts.utils.type_check import runtimeTypeCheck # noqa: E402
+from preserve_podcasts.utils import util # noqa: E402
+
+
+DEFAULT_CALLS = 200_000
+
+
+def legacy_runtime_type_check(f):
+    ''' the decorator before the signatures were cached '''
+    def wrapper(*args, **kwargs):
+        sig = inspect.signature(f)
+        bound_args = sig.bind(*args, **kwargs)
+        if sys.version_info < (3, 10):
+            return f(*args, **kwargs)
+        for name, value in bound_args.arguments.items():
+            if name == 'self':
+                continue
+            if name in sig.parameters:
+                if not isinstance(value, sig.parameters[name].annotation):
+                    if sig.parameters[name].annotation is inspect._empty:
+                        continue
+                    raise TypeError(f'Argument {name} must be of type {sig.parameters[name].annotation}')
+        return f(*args, **kwargs)
+    return wrapper
+
+
+def noop(s: str, replace_space: bool = True) -> str:
+    return s
+
+
+def plain(f: Callable) -> Callable:
+    ''' the undecorated function, from the module source '''
+    return getattr(f, '__wrapped__', f)
+
+
+def per_call_ns(f: Callable, args: tuple, kwargs: dict, calls: int) -> float:
+    seconds = min(timeit.repeat(lambda: f(*args, **kwargs), number=calls, repeat=5))
+    return seconds / calls * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--calls', type=int, default=DEFAULT_CALLS)
+    parser.add_argument('-o', '--output', type=Path, help='write the results as JSON')
+    args = parser.parse_args()
+
+    title = 'Épisode 12: "Hello/World" <live>'
+    cases: Dict[str, tuple] = {
+        'noop': (noop, (title,), {'replace_space': False}),
+        'safe_chars': (plain(util.safe_chars), (title,), {}),
+        'replace_ntfs_chars': (plain(util.replace_ntfs_chars), (title,), {}),
+        'remove_unprintable_chars': (plain(util.remove_unprintable_chars), (title,), {}),
+    }
+    if not type_check.TYPECHECK_SUPPORTED:
+        print(f'Python {sys.version.split()[0]}: the decorator is a pass-through below 3.10')
+
+    results = {}
+    print(f'{"function":<26} {"plain":>10} {"decorated":>10} {"legacy":>10}   ns/call')
+    for name, (f, f_args, f_kwargs) in cases.items():
+        row = {
+            'plain': per_call_ns(f, f_args, f_kwargs, args.calls),
+            'decorated': per_call_ns(runtimeTypeCheck()(f), f_args, f_kwargs, args.calls),
+            'legacy': per_call_ns(legacy_runtime_type_check(f), f_args, f_kwargs, args.calls),
+        }
+        results[name] = row
+        print(f'{name:<26} {row["plain"]:>10.0f} {row["decorated"]:>10.0f} {row["legacy"]:>10.0f}')
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'calls': args.calls, 'python': sys.version.split()[0], 'ns_per_call': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
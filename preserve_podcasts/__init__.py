@@ -1,3 +1,5 @@
-from preserve_podcasts.preservePodcasts import main
-if __name__ == '__main__':
-    main()
\ No newline at end of file
+def main():
+    # imported here: `import preserve_podcasts` (and `python -m preserve_podcasts.<module>`)
+    # should not load the whole archiver
+    from preserve_podcasts.preservePodcasts import main
+    main()
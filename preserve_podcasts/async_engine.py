@@ -0,0 +1,359 @@
+""" asyncio engine of `podcastsPreserve --update --async`, many feeds and enclosures in flight from one process.
+
+Needs aiohttp (`pip install aiohttp`, or the `async` extra).
+
+Only the network side lives here: feeds are parsed by `parse_feed()`, entries are picked by
+`iter_episode_jobs()` and episodes go through the same plan/start/write/finish steps as
+`download_episode()`, so the on-disk layout is identical to the blocking engine.
+"""
+import asyncio
+import contextlib
+import logging
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+
+import aiohttp
+import requests
+from requests.structures import CaseInsensitiveDict
+from rich import print
+
+from preserve_podcasts import schedule
+from preserve_podcasts.exception import FeedTooLargeError
+from preserve_podcasts.pod_sessiosn import PRESERVE_THOSE_POD_UA, RETRY_STATUS_FORCELIST, RETRY_TOTAL, retry_sleep_time
+from preserve_podcasts.podcast import Podcast
+from preserve_podcasts.preservePodcasts import (
+    DATA_DIR, EPISODE_DOWNLOAD_CHUNK_SIZE, FEED_CHUNK_SIZE, FEED_SIZE_LIMIT,
+    PODCAST_AUDIO_DIR, PODCAST_LOCK_DIR, UPDATE_DEFERRED, UPDATE_FAILED, UPDATE_LOCKED, UPDATE_UPDATED,
+    ArchiveInterrupted, EpisodeDownload, EpisodeJob, FeedResponse, QueuedPodcast, RestartDownload, UpdateStats,
+    check_podcast_due, check_shutdown, close_part, feed_response_headers, finish_episode_download,
+    iter_episode_jobs, iter_update_queue, load_podcast_if_changed, lowercase_headers, parse_feed,
+    plan_episode_download, remove_episodes_not_in_feed, save_episode_entry,
+    save_podcast_index_json, start_episode_download, write_part,
+)
+from preserve_podcasts.lease import LeaseLostError, resource_lock
+from preserve_podcasts.utils import metrics
+from preserve_podcasts.utils.fileLock import AlreadyRunningError
+from preserve_podcasts.utils.rate_limit import get_rate_limiter, url_host
+from preserve_podcasts.utils.response import get_content_length
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONNECTIONS = 64
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 4
+EPISODES_PER_WORKER = 4 # episodes downloaded at once, per podcast refreshed concurrently (--workers)
+WRITE_BATCH_SIZE = EPISODE_DOWNLOAD_CHUNK_SIZE # bytes received before hashing and writing them off the event loop
+
+
+@contextlib.asynccontextmanager
+async def locked_in_executor(lock):
+    ''' `async with` a FileLock/LeaseLock, taken and released in the default executor
+    (lock files and the SQLite lease table are blocking) '''
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, lock.__enter__)
+    try:
+        yield lock
+    finally:
+        await loop.run_in_executor(None, lock.__exit__, None, None, None)
+
+
+def to_requests_response(resp: aiohttp.ClientResponse) -> requests.Response:
+    ''' headers-only requests.Response of an aiohttp response,
+    for the helpers in utils/response.py and `save_audio_file_metadata()` '''
+    r = requests.Response()
+    r.status_code = resp.status
+    r.reason = resp.reason # type: ignore
+    r.url = str(resp.url)
+    # raw headers keep the case of the server (saved in the metadata JSON), repeated headers are folded like requests does
+    headers: CaseInsensitiveDict = CaseInsensitiveDict()
+    for raw_key, raw_value in resp.raw_headers:
+        key, value = raw_key.decode('latin-1'), raw_value.decode('latin-1')
+        headers[key] = f'{headers[key]}, {value}' if key in headers else value
+    r.headers = headers
+    r.history = [to_requests_response(redirect) for redirect in resp.history]
+    r.request = requests.PreparedRequest()
+    r.request.prepare(method=resp.method, url=str(resp.request_info.url),
+                      headers=dict(resp.request_info.headers))
+    return r
+
+
+class AsyncFetcher:
+    """ aiohttp session with per-host connection limits and the retry policy of `create_session()` """
+    def __init__(self, max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                 max_connections_per_host: int = DEFAULT_MAX_CONNECTIONS_PER_HOST, insecure: bool = False,
+                 max_episodes: int = EPISODES_PER_WORKER):
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.insecure = insecure
+        # episodes in flight across all the podcasts (open .part files, coroutines)
+        self.max_episodes = max_episodes
+        self.episode_slots: Optional[asyncio.Semaphore] = None
+        self.rate_limiter = get_rate_limiter() # shared with the blocking sessions
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.max_connections_per_host,
+                                         ssl=False if self.insecure else None) # type: ignore
+        self.session = aiohttp.ClientSession(
+            connector=connector, headers={'User-Agent': PRESERVE_THOSE_POD_UA},
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=300))
+        self.episode_slots = asyncio.Semaphore(self.max_episodes) # bound to the running loop
+        print(f'async: {self.max_connections} connection(s), {self.max_connections_per_host} per host')
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        assert self.session is not None
+        await self.session.close()
+
+    @contextlib.asynccontextmanager
+    async def get(self, url: str, headers: Optional[Dict[str, str]] = None) -> AsyncIterator[aiohttp.ClientResponse]:
+        ''' GET `url` (rate limited per host, like the blocking sessions), the body is not read yet
+
+        Connection errors and RETRY_STATUS_FORCELIST are retried RETRY_TOTAL times,
+        after the last retry the error response is returned as is.
+        '''
+        assert self.session is not None
+        errors = 0
+        while True:
+            delay = self.rate_limiter.reserve(url_host(url))
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                resp = await self.session.get(url, headers=headers, allow_redirects=True)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                errors += 1
+                if errors > RETRY_TOTAL:
+                    raise
+                print(f'req retry ({type(e).__name__}: {e}) {url}')
+                await asyncio.sleep(retry_sleep_time(errors))
+                continue
+            retry_after = self.rate_limiter.observe(str(resp.url), resp.status, resp.headers.get('Retry-After'))
+            if resp.status in RETRY_STATUS_FORCELIST and errors < RETRY_TOTAL:
+                errors += 1
+                resp.release()
+                print(f'req retry ({resp.status}) {url}')
+                await asyncio.sleep(retry_sleep_time(errors, retry_after))
+                continue
+            break
+        try:
+            yield resp
+        finally:
+            resp.release()
+
+    async def get_feed(self, url: str, headers: Optional[Dict[str, str]] = None) -> FeedResponse:
+        ''' asyncio `get_feed()` '''
+        with metrics.timed('feed_fetch'):
+            return await self._get_feed(url, headers=headers)
+
+    async def _get_feed(self, url: str, headers: Optional[Dict[str, str]] = None) -> FeedResponse:
+        async with self.get(url, headers=headers) as resp:
+            r = to_requests_response(resp)
+            if resp.status == 304:
+                return FeedResponse(response=r, content=None, response_headers=lowercase_headers(r.headers),
+                                    request_headers=dict(r.request.headers))
+            r.raise_for_status()
+
+            content_length = get_content_length(r)
+            if content_length > FEED_SIZE_LIMIT:
+                raise FeedTooLargeError(f'Feed too large: Content-Length {content_length}')
+            data = bytearray()
+            async for chunk in resp.content.iter_chunked(FEED_CHUNK_SIZE):
+                data += chunk
+                if len(data) > FEED_SIZE_LIMIT:
+                    raise FeedTooLargeError(f'Feed too large: > {FEED_SIZE_LIMIT} bytes')
+            metrics.add_bytes('feed_fetch', len(data))
+
+        content = bytes(data)
+        response_headers = await asyncio.get_running_loop().run_in_executor(
+            None, feed_response_headers, url, r.headers, content)
+        return FeedResponse(response=r, content=content, response_headers=response_headers,
+                            request_headers=dict(r.request.headers))
+
+    async def download_episode(self, job: EpisodeJob, force_redownload: bool = False):
+        ''' asyncio `download_episode()` '''
+        with metrics.timed('episode_download'):
+            downloaded = await self._download_episode(job, force_redownload=force_redownload)
+        if downloaded is None:
+            return
+        # ffprobe and the metadata files, its own stage (see download_episode())
+        with metrics.timed('episode_finish'):
+            await asyncio.get_running_loop().run_in_executor(None, finish_episode_download, *downloaded)
+
+    async def _download_episode(self, job: EpisodeJob,
+                                force_redownload: bool = False) -> Optional[Tuple[EpisodeDownload, requests.Response]]:
+        ''' the transfer, (plan, response) to finish, None if there is nothing to download '''
+        loop = asyncio.get_running_loop()
+        while True:
+            # reads the catalog and the metadata JSON
+            plan = await loop.run_in_executor(None, lambda: plan_episode_download(
+                job.url, episode_dir=job.episode_dir, filename=job.filename, possible_size=job.length,
+                title=job.title, force_redownload=force_redownload))
+            if plan is None:
+                return
+
+            async with self.get(job.url, headers=plan.headers) as resp:
+                r = to_requests_response(resp)
+                try:
+                    # hashes the already downloaded part of a resumed download
+                    await loop.run_in_executor(None, start_episode_download, plan, r)
+                except RestartDownload:
+                    continue
+                try:
+                    if plan.to_download:
+                        # hashing and writing block, batch the chunks and do it off the event loop
+                        batch = bytearray()
+                        async for chunk in resp.content.iter_chunked(EPISODE_DOWNLOAD_CHUNK_SIZE):
+                            batch += chunk
+                            if len(batch) >= WRITE_BATCH_SIZE:
+                                await loop.run_in_executor(None, write_part, plan, bytes(batch))
+                                batch.clear()
+                                check_shutdown() # the .part file is resumed next time
+                        if batch:
+                            await loop.run_in_executor(None, write_part, plan, bytes(batch))
+                finally:
+                    await loop.run_in_executor(None, close_part, plan)
+            return plan, r
+
+
+async def do_archive_async(podcast: Podcast, fetcher: AsyncFetcher, delete_episodes_not_in_feed: bool = False,
+                           incremental: bool = False):
+    ''' asyncio `do_archive()`, the episodes of the feed are downloaded concurrently '''
+    try:
+        feed = await fetcher.get_feed(podcast.feed_url, headers=podcast.conditional_headers())
+
+        if feed.not_modified:
+            print(f'Podcast {podcast.id}: feed not modified (304), skip.')
+            podcast.update_success()
+            schedule.record_success(podcast)
+            return
+
+        d = await asyncio.get_running_loop().run_in_executor(None, parse_feed, podcast, feed)
+    except Exception as e:
+        podcast.update_failed()
+        raise e
+
+    loop = asyncio.get_running_loop()
+    podcast_audio_dir = DATA_DIR / PODCAST_AUDIO_DIR / podcast.id
+
+    sha1ed_guids: Set[str] = set()
+    # entries sharing a guid share an episode directory, archive them one after another
+    jobs_by_dir: Dict[Path, List[EpisodeJob]] = {}
+    # reads the catalog and the episode directories
+    jobs = await loop.run_in_executor(None, lambda: list(
+        iter_episode_jobs(d, podcast_audio_dir, sha1ed_guids, incremental=incremental)))
+    for job in jobs:
+        jobs_by_dir.setdefault(job.episode_dir, []).append(job)
+
+    pending_dirs = iter(jobs_by_dir.values())
+    errors: List[BaseException] = []
+    assert fetcher.episode_slots is not None
+
+    async def archive_episode_dirs():
+        # a few of these per podcast pull from `pending_dirs`, not one coroutine per episode
+        for dir_jobs in pending_dirs:
+            try:
+                async with fetcher.episode_slots:
+                    for job in dir_jobs:
+                        check_shutdown()
+                        await fetcher.download_episode(job)
+                        await loop.run_in_executor(None, save_episode_entry, job)
+            except ArchiveInterrupted:
+                raise
+            except Exception as e:
+                errors.append(e)
+
+    # every runner is done before returning (the podcast lock is released after), even when interrupted
+    interrupted = [result for result in await asyncio.gather(
+        *(archive_episode_dirs() for _ in range(min(fetcher.max_episodes, len(jobs_by_dir)))), return_exceptions=True)
+        if isinstance(result, BaseException)]
+    if interrupted:
+        raise interrupted[0]
+    if errors:
+        if len(errors) > 1:
+            print(f'[red]Podcast {podcast.id}: {len(errors)} episode(s) failed[/red]')
+        raise errors[0]
+
+    if delete_episodes_not_in_feed:
+        await loop.run_in_executor(None, remove_episodes_not_in_feed, podcast_audio_dir, sha1ed_guids)
+
+    # only remember the validators once every entry is archived (see do_archive())
+    podcast.update_http_cache(etag=feed.response_headers.get('etag'),
+                              last_modified=feed.response_headers.get('last-modified'))
+    podcast.update_success()
+    schedule.record_success(podcast, schedule.published_timestamps(d.entries))
+
+
+async def update_podcast_async(queued: QueuedPodcast, fetcher: AsyncFetcher,
+                               incremental: bool = True) -> Tuple[str, Optional[Exception]]:
+    ''' asyncio `update_podcast()` of a podcast of the update queue (already loaded and found due) '''
+    loop = asyncio.get_running_loop()
+    podcast_json_file_path = queued.path
+    this_podcast = queued.podcast
+    assert this_podcast.id
+
+    print(f'Podcast {this_podcast.id}: {this_podcast.title} updating...')
+    error = None
+    try:
+        async with locked_in_executor(resource_lock(DATA_DIR / PODCAST_LOCK_DIR, 'podcast', this_podcast.id)):
+            try:
+                changed = await loop.run_in_executor(None, load_podcast_if_changed, podcast_json_file_path,
+                                                     queued.json_stat)
+            except Exception as e: # broken index JSON, don't overwrite it
+                return UPDATE_FAILED, e
+            if changed is not None: # saved by another instance since the queue was built
+                this_podcast = changed
+                not_due = check_podcast_due(this_podcast)
+                if not_due is not None:
+                    return not_due, None
+            await do_archive_async(this_podcast, fetcher, incremental=incremental)
+    except AlreadyRunningError:
+        print("Another instance is archiving this podcast, skip.")
+        return UPDATE_LOCKED, None
+    except LeaseLostError as e:
+        # another node is archiving it now, leave its index JSON alone
+        print(f'[red]Podcast {this_podcast.id}: {this_podcast.title} failed: {e}[/red]')
+        return UPDATE_FAILED, e
+    except ArchiveInterrupted:
+        # not a failure: still due, picked up by the next run (see update_podcast())
+        print(f'[yellow]Podcast {this_podcast.id}: {this_podcast.title} interrupted[/yellow]')
+        return UPDATE_DEFERRED, None
+    except Exception as e:
+        print(f'[red]Podcast {this_podcast.id}: {this_podcast.title} failed: {e}[/red]')
+        this_podcast.update_failed()
+        schedule.record_failure(this_podcast)
+        error = e
+    await loop.run_in_executor(None, lambda: save_podcast_index_json(
+        this_podcast, podcast_json_file_path=Path(podcast_json_file_path)))
+
+    return (UPDATE_FAILED, error) if error is not None else (UPDATE_UPDATED, None)
+
+
+async def update_all_async(workers: int, max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                           max_connections_per_host: int = DEFAULT_MAX_CONNECTIONS_PER_HOST,
+                           insecure: bool = False, incremental: bool = True,
+                           max_runtime: Optional[float] = None) -> UpdateStats:
+    ''' asyncio `update_all()`
+
+    workers: number of podcasts refreshed concurrently, up to `workers * EPISODES_PER_WORKER` episodes
+    are downloaded at once, their feeds and episodes share `max_connections` (`max_connections_per_host` per host)
+    '''
+    stats = UpdateStats()
+
+    async def update_one(queued: QueuedPodcast):
+        try:
+            result, error = await update_podcast_async(queued, fetcher, incremental=incremental)
+        except Exception as e:
+            result, error = UPDATE_FAILED, e
+        stats.record(queued.path.name, result, error)
+
+    async with AsyncFetcher(max_connections=max_connections, max_connections_per_host=max_connections_per_host,
+                            insecure=insecure, max_episodes=workers * EPISODES_PER_WORKER) as fetcher:
+        running: Set[asyncio.Future] = set()
+        for queued in iter_update_queue(stats, max_runtime=max_runtime):
+            if len(running) >= workers:
+                _, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            running.add(asyncio.ensure_future(update_one(queued)))
+        if running:
+            await asyncio.wait(running)
+
+    print(stats.summary())
+    return stats
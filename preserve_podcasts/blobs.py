@@ -0,0 +1,131 @@
+""" Content-addressed store of the episode audio files, `pod_data/blobs/<sha1[:2]>/<sha1>`.
+
+The episode directories keep their audio file (uploads, the catalog and the
+on-disk layout do not change), but byte-identical files of several episodes
+are hardlinks to the same blob, so they are only stored once.
+A blob without any other link (`st_nlink == 1`) is not used anymore, see `prune()`.
+"""
+import errno
+import logging
+import os
+from pathlib import Path
+from typing import Optional, Union
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+# no hardlinks on this filesystem (or between these directories), keep the files as they are
+NO_HARDLINK_ERRNOS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP)
+
+
+def _set_mtime(path: Path, st: os.stat_result, mtime: Optional[float]):
+    if mtime is not None:
+        os.utime(path, (st.st_atime, mtime)) # keep access time
+
+
+class BlobStore:
+    def __init__(self, blob_dir: Union[str, Path]):
+        self.blob_dir = Path(blob_dir)
+        self.hardlinks = True # False once the filesystem refused a hardlink
+
+    def path_of(self, sha1: str) -> Path:
+        return self.blob_dir / sha1[:2] / sha1
+
+    def has(self, sha1: str, size: Optional[int] = None) -> bool:
+        try:
+            st = os.stat(self.path_of(sha1))
+        except FileNotFoundError:
+            return False
+        return size is None or st.st_size == size
+
+    def _link(self, src: Path, dst: Path):
+        ''' hardlink `src` to `dst`, replacing `dst` atomically '''
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = dst.parent / f'.{dst.name[:32]}.{uuid.uuid4().hex}.link'
+        try:
+            os.link(src, tmp_path)
+            os.replace(tmp_path, dst)
+        except BaseException:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _try_link(self, src: Path, dst: Path) -> bool:
+        if not self.hardlinks:
+            return False
+        try:
+            self._link(src, dst)
+        except OSError as e:
+            if e.errno not in NO_HARDLINK_ERRNOS:
+                raise
+            logger.warning(f'blobs: hardlinks not supported ({e}), episodes will not be deduplicated')
+            self.hardlinks = False
+            return False
+        return True
+
+    def adopt(self, path: Path, sha1: str, mtime: Optional[float] = None) -> bool:
+        ''' deduplicate a downloaded file: replace it by a link to the blob `sha1` if the store
+        already has it, otherwise add it to the store. Returns True if `path` was replaced.
+
+        `mtime` (Last-Modified of the download) is set if `path` becomes the blob or stays
+        its own file, an existing blob keeps its mtime. '''
+        path = Path(path)
+        blob_path = self.path_of(sha1)
+        st = os.stat(path)
+        try:
+            blob_st = os.stat(blob_path)
+        except FileNotFoundError:
+            _set_mtime(path, st, mtime) # while the inode is still only ours
+            self._try_link(path, blob_path)
+            return False
+        if (blob_st.st_dev, blob_st.st_ino) == (st.st_dev, st.st_ino):
+            return False # already linked
+        if blob_st.st_size != st.st_size:
+            logger.warning(f'blobs: {blob_path} has the wrong size, replacing it')
+            _set_mtime(path, st, mtime)
+            self._try_link(path, blob_path)
+            return False
+        if self._try_link(blob_path, path):
+            return True
+        _set_mtime(path, st, mtime) # no hardlinks
+        return False
+
+    def set_mtime(self, path: Path, mtime: float, sha1: Optional[str] = None) -> bool:
+        ''' set the mtime of `path`, unless it is linked to other episodes: the mtime belongs to
+        the inode, shared by every link. Linked to its own blob `sha1` only is fine. '''
+        st = os.stat(path)
+        links = st.st_nlink
+        if sha1 is not None and links == 2:
+            try:
+                blob_st = os.stat(self.path_of(sha1))
+            except FileNotFoundError:
+                pass
+            else:
+                if (blob_st.st_dev, blob_st.st_ino) == (st.st_dev, st.st_ino):
+                    links -= 1
+        if links > 1:
+            return False
+        _set_mtime(path, st, mtime)
+        return True
+
+    def link_to(self, sha1: str, path: Path) -> bool:
+        ''' create `path` as a link to the blob `sha1`, False if the store does not have it '''
+        if not self.has(sha1):
+            return False
+        return self._try_link(self.path_of(sha1), Path(path))
+
+    def prune(self) -> int:
+        ''' remove the blobs no episode links to anymore, returns the number of freed bytes '''
+        freed = 0
+        if not self.blob_dir.is_dir():
+            return freed
+        for prefix in os.scandir(self.blob_dir):
+            if not prefix.is_dir():
+                continue
+            for blob in os.scandir(prefix.path):
+                st = blob.stat(follow_symlinks=False)
+                if blob.is_file(follow_symlinks=False) and st.st_nlink == 1:
+                    os.remove(blob.path)
+                    freed += st.st_size
+        return freed
@@ -0,0 +1,399 @@
+import json
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+from preserve_podcasts.layout import CATALOG_FILE, DATA_DIR, PODCAST_AUDIO_DIR
+from preserve_podcasts.lease import get_lease_coordinator
+from preserve_podcasts.podcast import Podcast
+
+
+# episodes.download_state
+DOWNLOAD_STATE_DOWNLOADED = 'downloaded' # audio, audio metadata and entry JSON are saved
+
+# episodes.upload_state (NULL: not uploaded yet)
+UPLOAD_STATE_PENDING = 'pending'
+UPLOAD_STATE_UPLOADED = 'uploaded'
+UPLOAD_STATE_SPAM = 'spam'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS podcasts (
+    id TEXT PRIMARY KEY,
+    feed_url TEXT,
+    title TEXT,
+    index_json TEXT,
+    enabled INTEGER,
+    last_success_timestamp INTEGER,
+    last_checked_timestamp INTEGER,
+    last_checked_status TEXT
+);
+CREATE TABLE IF NOT EXISTS episodes (
+    podcast_id TEXT NOT NULL,
+    guid_sha1 TEXT NOT NULL,
+    filename TEXT,
+    expected_size INTEGER,
+    actual_size INTEGER,
+    sha1 TEXT,
+    md5 TEXT,
+    download_state TEXT,
+    upload_state TEXT,
+    ia_identifier TEXT,
+    updated_timestamp INTEGER,
+    entry_hash TEXT,
+    PRIMARY KEY (podcast_id, guid_sha1)
+);
+'''
+
+# columns added after the first release of the catalog: {table: {column: type}}
+MIGRATIONS = {
+    'podcasts': {
+        'consecutive_failures': 'INTEGER', # saveweb.consecutive_failures
+    },
+    'episodes': {
+        'entry_hash': 'TEXT', # sha1 of the saved entry JSON
+        'url': 'TEXT', # enclosure URL
+        'etag': 'TEXT', # of the downloaded audio
+        'download_bytes': 'INTEGER', # bytes transferred by the last download (less than actual_size if resumed)
+        'download_seconds': 'REAL', # time spent transferring them
+    },
+}
+
+# created after the migrations, they may index migrated columns
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS episodes_url ON episodes (url);
+CREATE INDEX IF NOT EXISTS episodes_sha1 ON episodes (sha1);
+'''
+
+
+class Catalog:
+    """ SQLite index of podcasts and episodes.
+
+    The files under `pod_data/` stay the source of truth, the catalog only
+    saves us from walking and stat()ing them. It can be rebuilt from disk
+    at any time with `rebuild_from_disk()`.
+
+    Safe to share between threads (one connection per thread) and
+    between processes (WAL).
+
+    `shared`: `pod_data/` is shared by several nodes (`--lease-db`), WAL needs
+    shared memory and does not work over network filesystems, use a rollback
+    journal instead. Recorded in the catalog, so that the processes without
+    `--lease-db` (`podcastsStats`...) don't switch it back to WAL.
+    """
+    def __init__(self, db_path: Path, shared: bool = False):
+        self.db_path = Path(db_path)
+        self._local = threading.local()
+        is_new = not self.db_path.exists()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.shared = shared or (not is_new and self._marked_shared())
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+            self._migrate(conn)
+            conn.executescript(INDEXES)
+            if shared:
+                conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('shared', '1'))
+        self.is_new = is_new
+
+    def _marked_shared(self) -> bool:
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            row = conn.execute('SELECT value FROM meta WHERE key = ?', ('shared',)).fetchone()
+        except sqlite3.OperationalError: # no meta table yet
+            return False
+        finally:
+            conn.close()
+        return row is not None and row[0] == '1'
+
+    def _migrate(self, conn: sqlite3.Connection):
+        for table, columns in MIGRATIONS.items():
+            existing = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+            for column, column_type in columns.items():
+                if column not in existing:
+                    conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=60)
+            conn.row_factory = sqlite3.Row
+            if self.shared:
+                conn.execute('PRAGMA journal_mode=DELETE')
+                conn.execute('PRAGMA synchronous=FULL')
+            else:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    # meta
+
+    def is_complete(self) -> bool:
+        ''' True if every episode on disk is known by the catalog '''
+        row = self._conn().execute('SELECT value FROM meta WHERE key = ?', ('complete',)).fetchone()
+        return row is not None and row['value'] == '1'
+
+    def set_complete(self, complete: bool = True):
+        with self._conn() as conn:
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                         ('complete', '1' if complete else '0'))
+
+    # podcasts
+
+    def upsert_podcast(self, podcast: Podcast, index_json: Optional[str] = None):
+        with self._conn() as conn:
+            self._upsert_podcast(conn, podcast, index_json)
+
+    def _upsert_podcast(self, conn: sqlite3.Connection, podcast: Podcast, index_json: Optional[str]):
+        conn.execute('''
+            INSERT INTO podcasts (id, feed_url, title, index_json, enabled,
+                last_success_timestamp, last_checked_timestamp, last_checked_status, consecutive_failures)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET
+                feed_url = excluded.feed_url, title = excluded.title,
+                index_json = COALESCE(excluded.index_json, podcasts.index_json),
+                enabled = excluded.enabled,
+                last_success_timestamp = excluded.last_success_timestamp,
+                last_checked_timestamp = excluded.last_checked_timestamp,
+                last_checked_status = excluded.last_checked_status,
+                consecutive_failures = excluded.consecutive_failures
+            ''', (podcast.id, podcast.feed_url, podcast.title, index_json, int(bool(podcast.enabled)),
+                  podcast.saveweb.get('last_success_timestamp'), podcast.saveweb.get('last_checked_timestamp'),
+                  podcast.saveweb.get('last_checked_status'), podcast.saveweb.get('consecutive_failures')))
+
+    # episodes
+
+    def get_episode(self, podcast_id: str, guid_sha1: str) -> Optional[sqlite3.Row]:
+        return self._conn().execute('SELECT * FROM episodes WHERE podcast_id = ? AND guid_sha1 = ?',
+                                    (podcast_id, guid_sha1)).fetchone()
+
+    def update_episode_file(self, podcast_id: str, guid_sha1: str, *, filename: str,
+                            expected_size: Optional[int] = None, actual_size: Optional[int] = None,
+                            sha1: Optional[str] = None, md5: Optional[str] = None,
+                            url: Optional[str] = None, etag: Optional[str] = None,
+                            download_bytes: Optional[int] = None, download_seconds: Optional[float] = None):
+        ''' record the audio file of an episode, unknown (None) values do not overwrite known ones '''
+        with self._conn() as conn:
+            conn.execute('''
+                INSERT INTO episodes (podcast_id, guid_sha1, filename, expected_size, actual_size,
+                    sha1, md5, url, etag, download_bytes, download_seconds, updated_timestamp)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (podcast_id, guid_sha1) DO UPDATE SET
+                    filename = excluded.filename,
+                    expected_size = COALESCE(excluded.expected_size, episodes.expected_size),
+                    actual_size = COALESCE(excluded.actual_size, episodes.actual_size),
+                    sha1 = COALESCE(excluded.sha1, episodes.sha1),
+                    md5 = COALESCE(excluded.md5, episodes.md5),
+                    url = COALESCE(excluded.url, episodes.url),
+                    etag = COALESCE(excluded.etag, episodes.etag),
+                    download_bytes = COALESCE(excluded.download_bytes, episodes.download_bytes),
+                    download_seconds = COALESCE(excluded.download_seconds, episodes.download_seconds),
+                    updated_timestamp = excluded.updated_timestamp
+                ''', (podcast_id, guid_sha1, filename, expected_size, actual_size, sha1, md5, url, etag,
+                      download_bytes, download_seconds, int(time.time())))
+
+    def find_download(self, url: str, etag: Optional[str], size: int) -> Optional[sqlite3.Row]:
+        ''' an episode already downloaded from `url` with the same ETag and size (any podcast) '''
+        if not etag or size <= 0:
+            return None # a URL alone does not tell whether the bytes changed
+        return self._conn().execute('''
+            SELECT * FROM episodes
+            WHERE url = ? AND etag = ? AND actual_size = ? AND sha1 IS NOT NULL AND download_state = ?
+            LIMIT 1
+            ''', (url, etag, size, DOWNLOAD_STATE_DOWNLOADED)).fetchone()
+
+    def downloaded_files(self) -> List[sqlite3.Row]:
+        ''' (podcast_id, guid_sha1, filename, sha1) of the downloaded episodes with a known sha1 '''
+        return self._conn().execute('''
+            SELECT podcast_id, guid_sha1, filename, sha1 FROM episodes
+            WHERE download_state = ? AND sha1 IS NOT NULL AND filename IS NOT NULL
+            ''', (DOWNLOAD_STATE_DOWNLOADED,)).fetchall()
+
+    def set_download_state(self, podcast_id: str, guid_sha1: str, state: Optional[str],
+                           entry_hash: Optional[str] = None):
+        with self._conn() as conn:
+            conn.execute('''
+                INSERT INTO episodes (podcast_id, guid_sha1, download_state, entry_hash, updated_timestamp)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (podcast_id, guid_sha1) DO UPDATE SET
+                    download_state = excluded.download_state,
+                    entry_hash = COALESCE(excluded.entry_hash, episodes.entry_hash),
+                    updated_timestamp = excluded.updated_timestamp
+                ''', (podcast_id, guid_sha1, state, entry_hash, int(time.time())))
+
+    def archived_entries(self, podcast_id: str) -> Dict[str, str]:
+        ''' {guid_sha1: entry_hash} of the completely archived episodes of a podcast '''
+        rows = self._conn().execute('''
+            SELECT guid_sha1, entry_hash FROM episodes
+            WHERE podcast_id = ? AND download_state = ? AND entry_hash IS NOT NULL
+            ''', (podcast_id, DOWNLOAD_STATE_DOWNLOADED)).fetchall()
+        return {row['guid_sha1']: row['entry_hash'] for row in rows}
+
+    def downloaded_counts(self) -> Dict[str, int]:
+        ''' {podcast_id: number of downloaded episodes} '''
+        rows = self._conn().execute('''
+            SELECT podcast_id, COUNT(*) AS n FROM episodes WHERE download_state = ? GROUP BY podcast_id
+            ''', (DOWNLOAD_STATE_DOWNLOADED,)).fetchall()
+        return {row['podcast_id']: row['n'] for row in rows}
+
+    def downloaded_count(self, podcast_id: str) -> int:
+        ''' number of downloaded episodes of a podcast '''
+        row = self._conn().execute('''
+            SELECT COUNT(*) AS n FROM episodes WHERE podcast_id = ? AND download_state = ?
+            ''', (podcast_id, DOWNLOAD_STATE_DOWNLOADED)).fetchone()
+        return row['n']
+
+    def podcasts(self) -> List[sqlite3.Row]:
+        return self._conn().execute('SELECT * FROM podcasts').fetchall()
+
+    def episode_stats(self) -> List[sqlite3.Row]:
+        ''' per podcast: downloaded episodes, their bytes, episodes to upload, uploaded episodes,
+        bytes and seconds of the timed downloads '''
+        return self._conn().execute('''
+            SELECT podcast_id,
+                COUNT(*) AS episodes,
+                COALESCE(SUM(actual_size), 0) AS bytes,
+                SUM(upload_state IS NULL OR upload_state NOT IN (?, ?)) AS to_upload,
+                SUM(upload_state IS ?) AS uploaded,
+                COALESCE(SUM(download_bytes), 0) AS download_bytes,
+                COALESCE(SUM(download_seconds), 0) AS download_seconds
+            FROM episodes WHERE download_state = ? GROUP BY podcast_id
+            ''', (UPLOAD_STATE_UPLOADED, UPLOAD_STATE_SPAM, UPLOAD_STATE_UPLOADED, DOWNLOAD_STATE_DOWNLOADED)).fetchall()
+
+    def unique_bytes(self) -> int:
+        ''' bytes of the downloaded episodes, byte-identical ones (same sha1) counted once '''
+        row = self._conn().execute('''
+            SELECT COALESCE(SUM(size), 0) AS n FROM (
+                SELECT MAX(actual_size) AS size FROM episodes WHERE download_state = ?
+                GROUP BY COALESCE(sha1, podcast_id || '/' || guid_sha1)
+            )
+            ''', (DOWNLOAD_STATE_DOWNLOADED,)).fetchone()
+        return row['n']
+
+    def set_upload_state(self, podcast_id: str, guid_sha1: str, state: Optional[str],
+                         ia_identifier: Optional[str] = None):
+        with self._conn() as conn:
+            conn.execute('''
+                INSERT INTO episodes (podcast_id, guid_sha1, upload_state, ia_identifier, updated_timestamp)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (podcast_id, guid_sha1) DO UPDATE SET
+                    upload_state = excluded.upload_state,
+                    ia_identifier = COALESCE(excluded.ia_identifier, episodes.ia_identifier),
+                    updated_timestamp = excluded.updated_timestamp
+                ''', (podcast_id, guid_sha1, state, ia_identifier, int(time.time())))
+
+    def delete_episode(self, podcast_id: str, guid_sha1: str):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM episodes WHERE podcast_id = ? AND guid_sha1 = ?', (podcast_id, guid_sha1))
+
+    def episodes_to_upload(self, podcast_id: str, include_spam: bool = False) -> List[str]:
+        ''' guid_sha1s of downloaded episodes that are not uploaded yet '''
+        skip_states = [UPLOAD_STATE_UPLOADED] + ([] if include_spam else [UPLOAD_STATE_SPAM])
+        rows = self._conn().execute(f'''
+            SELECT guid_sha1 FROM episodes
+            WHERE podcast_id = ? AND download_state = ?
+                AND (upload_state IS NULL OR upload_state NOT IN ({', '.join('?' * len(skip_states))}))
+            ORDER BY guid_sha1
+            ''', (podcast_id, DOWNLOAD_STATE_DOWNLOADED, *skip_states)).fetchall()
+        return [row['guid_sha1'] for row in rows]
+
+    # migration
+
+    def rebuild_from_disk(self, index_dir: Path, audio_dir: Path, podcast_json_prefix: str,
+                          upload_marks: Dict[str, str]):
+        ''' (re)build the catalog from an existing `pod_data/` tree
+
+        upload_marks: {mark filename: UPLOAD_STATE_*}
+        '''
+        conn = self._conn()
+        with conn:
+            conn.execute('DELETE FROM podcasts')
+            conn.execute('DELETE FROM episodes')
+
+            for entry in os.scandir(index_dir) if os.path.isdir(index_dir) else []:
+                if not (entry.name.startswith(podcast_json_prefix) and entry.name.endswith('.json')):
+                    continue
+                podcast = Podcast()
+                podcast.load(entry.path)
+                if podcast.id:
+                    self._upsert_podcast(conn, podcast, index_json=entry.name)
+
+            n_episodes = 0
+            for podcast_entry in os.scandir(audio_dir) if os.path.isdir(audio_dir) else []:
+                if not podcast_entry.is_dir():
+                    continue
+                for episode_entry in os.scandir(podcast_entry.path):
+                    if not episode_entry.is_dir():
+                        continue
+                    self._rebuild_episode(conn, podcast_entry.name, episode_entry, upload_marks)
+                    n_episodes += 1
+                print(f'catalog: {podcast_entry.name} scanned, {n_episodes} episode(s) so far', end='\r')
+
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('complete', '1'))
+        print(f'\ncatalog: rebuilt, {n_episodes} episode(s)')
+        return n_episodes
+
+    def _rebuild_episode(self, conn: sqlite3.Connection, podcast_id: str, episode_entry: os.DirEntry,
+                         upload_marks: Dict[str, str]):
+        guid_sha1 = episode_entry.name
+        names = set(os.listdir(episode_entry.path))
+
+        upload_state = None
+        for mark, state in upload_marks.items():
+            if mark in names:
+                upload_state = state
+                break
+
+        metadata = {}
+        filename = None
+        for name in names:
+            if name.endswith('.metadata.json'):
+                filename = name[:-len('.metadata.json')]
+                try:
+                    with open(os.path.join(episode_entry.path, name), 'r', encoding='utf-8') as f:
+                        metadata = json.load(f)
+                except (OSError, ValueError):
+                    metadata = {}
+                break
+
+        download_state = None
+        if filename is not None and filename in names and f'entry_guid_sha1_{guid_sha1}.json' in names:
+            download_state = DOWNLOAD_STATE_DOWNLOADED
+
+        url_history = metadata.get('url-history') or {}
+        first_request = url_history.get('0') or {} # JSON keys, the enclosure URL before redirects
+        conn.execute('''
+            INSERT OR REPLACE INTO episodes (podcast_id, guid_sha1, filename, expected_size, actual_size,
+                sha1, md5, download_state, upload_state, ia_identifier, url, etag, updated_timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (podcast_id, guid_sha1, filename, metadata.get('http-content-length'), metadata.get('actual-size'),
+                  metadata.get('sha1'), metadata.get('md5'), download_state, upload_state,
+                  f'podcast_ep_{guid_sha1}' if upload_state is not None else None,
+                  first_request.get('url'), metadata.get('http-etag'), int(time.time())))
+
+
+_catalog: Optional[Catalog] = None
+_catalog_lock = threading.Lock()
+
+def get_catalog() -> Catalog:
+    ''' the process-wide episode catalog (DATA_DIR / CATALOG_FILE) '''
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = Catalog(DATA_DIR / CATALOG_FILE, shared=get_lease_coordinator() is not None)
+            if _catalog.is_new and not any((DATA_DIR / PODCAST_AUDIO_DIR).glob('*')):
+                # nothing on disk yet, the catalog will see every episode from the start
+                _catalog.set_complete()
+        return _catalog
@@ -0,0 +1,265 @@
+""" `podcastsPreserve --daemon`: a long-running `--update`.
+
+The index is read once at startup and kept in memory (a few fields per podcast), then only the
+JSONs that change are read again: the ones the daemon refreshed, and the ones written by other
+processes (`podcastsPreserve --add/--import`, an editor...), seen by watching the index directory
+(inotify, or a scan every `--poll-interval` seconds). Between two refreshes the daemon sleeps until
+the next podcast is due. The worker threads and their sessions (connection pools) live as long as the daemon.
+
+SIGINT/SIGTERM: stop the running refreshes at the next episode or download chunk, release
+their locks and exit (a second signal exits right away). SIGHUP: read the whole index again.
+"""
+import dataclasses
+import heapq
+import math
+import signal
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import requests
+from rich import print
+
+from preserve_podcasts import schedule
+from preserve_podcasts.catalog import get_catalog
+from preserve_podcasts.layout import DATA_DIR, PODCAST_INDEX_DIR, get_podcast_json_file_paths
+from preserve_podcasts.pod_sessiosn import create_session
+from preserve_podcasts.podcast import Podcast
+from preserve_podcasts.preservePodcasts import (
+    UPDATE_FAILED, UpdateStats, get_podcast_registry, request_shutdown, update_podcast, update_priority,
+)
+from preserve_podcasts.utils.dirwatch import DEFAULT_POLL_INTERVAL, DirChanges, DirWatcher, open_dir_watcher
+from preserve_podcasts.utils.file import file_stat
+
+
+DAEMON_MAX_SLEEP = 60 * 60 # seconds, wake up at least hourly (clock changes, suspend)
+# seconds before retrying a podcast still due after its refresh (locked by another instance, broken JSON...)
+DAEMON_RETRY_DELAY = 60 * 5
+
+
+@dataclasses.dataclass
+class DaemonEntry:
+    """ what the daemon keeps of an index JSON """
+    filename: str
+    podcast_id: str
+    next_check: float # math.inf if disabled
+    is_new: bool # never archived successfully
+    backlog: int # episodes in the feed not downloaded yet
+    stat: Tuple[int, int] # (mtime_ns, size) of the JSON when read
+
+    def priority(self, now: float) -> Tuple[int, float]:
+        return update_priority(self.is_new, now - self.next_check, self.backlog)
+
+
+class ArchiveDaemon:
+    def __init__(self, workers: int = 1, session_factory: Optional[Callable[[], requests.Session]] = None,
+                 incremental: bool = True, poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 max_runtime: Optional[float] = None):
+        self.workers = workers
+        self.session_factory = session_factory
+        self.incremental = incremental
+        self.poll_interval = poll_interval
+        self.index_dir = DATA_DIR / PODCAST_INDEX_DIR
+        self.stats = UpdateStats()
+        self.deadline = self.stats.start_time + max_runtime if max_runtime else None
+
+        self.entries: Dict[str, DaemonEntry] = {} # {index JSON filename: entry}
+        self._due_heap: List[Tuple[float, str]] = [] # (next_check, filename), outdated items are skipped
+        self._ready: Set[str] = set() # due, waiting for a worker
+        self._running: Dict[Future, str] = {}
+        self._local = threading.local()
+        self._watcher: Optional[DirWatcher] = None
+        self._stop = False
+        self._rescan = False
+
+    # index
+
+    def _read_entry(self, filename: str, downloaded: Optional[int] = None) -> Optional[DaemonEntry]:
+        path = self.index_dir / filename
+        stat = file_stat(path)
+        if stat is None:
+            return None
+        podcast = Podcast()
+        podcast.load(path)
+        assert podcast.id
+        if downloaded is None:
+            downloaded = get_catalog().downloaded_count(podcast.id)
+        return DaemonEntry(
+            filename=filename, podcast_id=podcast.id,
+            next_check=schedule.next_check_timestamp(podcast) if podcast.enabled is not False else math.inf,
+            is_new=not podcast.saveweb.get('last_success_timestamp'),
+            backlog=max(0, (podcast.saveweb.get('feed_episode_count') or 0) - downloaded),
+            stat=stat)
+
+    def reload(self, filename: str, downloaded: Optional[int] = None):
+        ''' (re)read an index JSON, forget it if it is gone '''
+        try:
+            entry = self._read_entry(filename, downloaded=downloaded)
+        except Exception as e: # broken or half-written JSON, keep what we had
+            print(f'[red]{filename}: {type(e).__name__}: {e}[/red]')
+            return
+        if entry is None:
+            if self.entries.pop(filename, None) is not None:
+                print(f'{filename} removed from the index')
+            self._ready.discard(filename)
+            return
+        if filename not in self.entries:
+            get_podcast_registry().add(entry.podcast_id, filename)
+        self.entries[filename] = entry
+        self._ready.discard(filename)
+        heapq.heappush(self._due_heap, (entry.next_check, filename))
+
+    def rescan(self):
+        ''' read every index JSON that changed since we last read it '''
+        get_podcast_registry().load()
+        downloaded = get_catalog().downloaded_counts()
+        seen = set()
+        for path in get_podcast_json_file_paths():
+            filename = path.name
+            seen.add(filename)
+            entry = self.entries.get(filename)
+            if entry is not None and entry.stat == file_stat(path):
+                continue
+            podcast_id = get_podcast_registry().podcast_id_of(filename)
+            self.reload(filename, downloaded=downloaded.get(podcast_id, 0))
+        for filename in set(self.entries) - seen:
+            self.reload(filename) # gone
+        print(f'{len(self.entries)} podcast(s) in the index')
+
+    def on_changes(self, changes: DirChanges):
+        if changes.overflow:
+            self.rescan()
+            return
+        registry = get_podcast_registry()
+        running = set(self._running.values())
+        for filename in changes.names:
+            if registry.podcast_id_of(filename) is None or filename in running:
+                continue # not an index JSON, or read again when its refresh is done
+            entry = self.entries.get(filename)
+            if entry is not None and entry.stat == file_stat(self.index_dir / filename):
+                continue # our own write
+            if entry is None:
+                print(f'New podcast: {filename}')
+            self.reload(filename)
+
+    # scheduling
+
+    def _pop_due(self, now: float):
+        while self._due_heap and self._due_heap[0][0] <= now:
+            next_check, filename = heapq.heappop(self._due_heap)
+            entry = self.entries.get(filename)
+            if entry is None or entry.next_check != next_check:
+                continue # removed or rescheduled since
+            self._ready.add(filename)
+
+    def _worker(self, filename: str) -> Tuple[str, Optional[Exception]]:
+        # requests.Session is not thread-safe, one session per worker thread, kept between refreshes
+        if getattr(self._local, 'session', None) is None:
+            self._local.session = (self.session_factory or create_session)()
+        return update_podcast(self.index_dir / filename, session=self._local.session, incremental=self.incremental)
+
+    def _submit(self, executor: ThreadPoolExecutor, now: float):
+        running = set(self._running.values())
+        ready = sorted((filename for filename in self._ready if filename not in running),
+                       key=lambda filename: (self.entries[filename].priority(now), filename))
+        for filename in ready[:self.workers - len(self._running)]:
+            self._ready.discard(filename)
+            future = executor.submit(self._worker, filename)
+            self._running[future] = filename
+            future.add_done_callback(self._wakeup)
+
+    def _collect(self):
+        for future in [future for future in self._running if future.done()]:
+            filename = self._running.pop(future)
+            try:
+                result, error = future.result()
+            except Exception as e: # broken index JSON, etc.
+                result, error = UPDATE_FAILED, e
+            self.stats.record(filename, result, error)
+            self.reload(filename)
+            entry = self.entries.get(filename)
+            now = time.time()
+            if entry is not None and entry.next_check <= now:
+                entry.next_check = now + DAEMON_RETRY_DELAY
+                heapq.heappush(self._due_heap, (entry.next_check, filename))
+
+    def _sleep_seconds(self, now: float) -> Optional[float]:
+        ''' until the next podcast is due, None if a running refresh has to finish first '''
+        if self._stop or (self._ready and len(self._running) >= self.workers):
+            return None
+        timeout = DAEMON_MAX_SLEEP
+        if self._due_heap:
+            timeout = min(timeout, self._due_heap[0][0] - now)
+        if self.deadline is not None:
+            timeout = min(timeout, self.deadline - now)
+        return max(timeout, 0)
+
+    # signals
+
+    def _wakeup(self, *_):
+        if self._watcher is not None:
+            self._watcher.wakeup()
+
+    def _on_stop_signal(self, signum, frame):
+        print(f'[yellow]{signal.Signals(signum).name}: stopping, {len(self._running)} refresh(es) to interrupt '
+              '(again to exit now)[/yellow]')
+        self._stop = True
+        request_shutdown()
+        for sig, handler in self._previous_handlers.items():
+            if sig != signal.SIGHUP:
+                signal.signal(sig, handler)
+        self._wakeup()
+
+    def _on_rescan_signal(self, signum, frame):
+        self._rescan = True
+        self._wakeup()
+
+    def _install_signal_handlers(self):
+        self._previous_handlers = {signal.SIGINT: signal.signal(signal.SIGINT, self._on_stop_signal),
+                                   signal.SIGTERM: signal.signal(signal.SIGTERM, self._on_stop_signal)}
+        if hasattr(signal, 'SIGHUP'):
+            self._previous_handlers[signal.SIGHUP] = signal.signal(signal.SIGHUP, self._on_rescan_signal)
+
+    def _restore_signal_handlers(self):
+        for sig, handler in self._previous_handlers.items():
+            signal.signal(sig, handler)
+
+    # main loop
+
+    def run(self) -> UpdateStats:
+        self._install_signal_handlers()
+        try:
+            with open_dir_watcher(self.index_dir, poll_interval=self.poll_interval) as watcher, \
+                    ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='daemon') as executor:
+                self._watcher = watcher
+                self.rescan()
+                while not (self._stop and not self._running):
+                    now = time.time()
+                    if not self._stop and self.deadline is not None and now >= self.deadline:
+                        print('[yellow]--max-runtime reached, waiting for the running refreshes[/yellow]')
+                        self._stop = True
+                    self._collect()
+                    if self._rescan:
+                        self._rescan = False
+                        self.rescan()
+                    if not self._stop:
+                        self._pop_due(now)
+                        self._submit(executor, now)
+                    if self._stop and not self._running:
+                        break
+                    changes = watcher.wait(self._sleep_seconds(time.time()))
+                    if changes and not self._stop:
+                        self.on_changes(changes)
+                self._watcher = None
+        finally:
+            self._restore_signal_handlers()
+        print(self.stats.summary())
+        return self.stats
+
+
+def run_daemon(workers: int = 1, session_factory: Optional[Callable[[], requests.Session]] = None,
+               incremental: bool = True, poll_interval: float = DEFAULT_POLL_INTERVAL,
+               max_runtime: Optional[float] = None) -> UpdateStats:
+    return ArchiveDaemon(workers=workers, session_factory=session_factory, incremental=incremental,
+                         poll_interval=poll_interval, max_runtime=max_runtime).run()
@@ -0,0 +1,235 @@
+""" Bulk import of feeds (`podcastsPreserve --import FILE`), from an OPML or a newline-delimited list.
+
+Importing is split in passes, each one can be interrupted and re-run:
+
+1. register: write an index JSON for every new feed, no network. Already registered feeds are skipped.
+2. metadata (`--metadata-only`): fetch and parse the feeds that were never checked, to fill
+   their title, episode count, etc. No audio is downloaded.
+3. episodes: the normal `--update`, new feeds (never archived) go first.
+"""
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+import dataclasses
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+import xml.etree.ElementTree as ET
+
+import requests
+from rich import print
+
+from preserve_podcasts import schedule
+from preserve_podcasts.lease import resource_lock
+from preserve_podcasts.podcast import Podcast
+from preserve_podcasts.preservePodcasts import (
+    DATA_DIR, PODCAST_LOCK_DIR, get_feed, get_podcast_registry, parse_feed, save_podcast_index_json,
+)
+from preserve_podcasts.utils.fileLock import AlreadyRunningError
+from preserve_podcasts.utils.util import podcast_guid_uuid5, safe_chars
+
+
+IMPORT_REGISTERED = 'registered'
+IMPORT_EXISTS = 'exists'
+IMPORT_INVALID = 'invalid'
+IMPORT_FETCHED = 'fetched'
+IMPORT_FAILED = 'failed'
+IMPORT_LOCKED = 'locked'
+
+PROGRESS_EVERY = 100 # feeds, print the progress of the register pass every PROGRESS_EVERY feeds
+IMPORT_TITLE_MAX_CHARS = 30 # same as the titles of the index filenames of `--add`
+
+
+@dataclasses.dataclass
+class ImportFeed:
+    url: str
+    title: Optional[str] = None # from the OPML, until the feed is fetched
+
+
+@dataclasses.dataclass
+class ImportStats:
+    """ Thread-safe counters of an import pass. """
+    total: int
+    start_time: float = dataclasses.field(default_factory=time.time)
+    results: Dict[str, int] = dataclasses.field(default_factory=dict)
+    failures: List[Tuple[str, str]] = dataclasses.field(default_factory=list) # [(feed_url, error), ...]
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+
+    def record(self, feed_url: str, result: str, error: Optional[str] = None) -> int:
+        ''' returns the number of feeds done '''
+        with self._lock:
+            self.results[result] = self.results.get(result, 0) + 1
+            if error is not None:
+                self.failures.append((feed_url, error))
+            return sum(self.results.values())
+
+    def progress(self) -> str:
+        done = sum(self.results.values())
+        elapsed = time.time() - self.start_time
+        rate = done / elapsed if elapsed > 0 else 0
+        eta = f', ETA {(self.total - done) / rate:.0f}s' if rate > 0 and done < self.total else ''
+        return f'[{done}/{self.total}] {rate:.1f} feeds/s{eta}'
+
+    def summary(self, name: str) -> str:
+        lines = [
+            f'import {name}: {self.progress()}',
+            ', '.join(f'{result}: {count}' for result, count in sorted(self.results.items())),
+        ]
+        for feed_url, error in self.failures:
+            lines.append(f'[red]{name} failed[/red] {feed_url}: {error}')
+        return '\n'.join(lines)
+
+
+def is_opml(path: Path, head: bytes) -> bool:
+    return path.suffix.lower() in ('.opml', '.xml') or head.lstrip(b'\xef\xbb\xbf \t\r\n').startswith(b'<')
+
+
+def read_import_file(path: Path) -> List[ImportFeed]:
+    ''' feeds of an OPML (`<outline xmlUrl="...">`, nested outlines too) or of a file with one URL per line
+    (blank lines and `#` comments are ignored), in file order '''
+    with open(path, 'rb') as f:
+        head = f.read(1024)
+    feeds: List[ImportFeed] = []
+    if is_opml(path, head):
+        for outline in ET.parse(path).iter('outline'):
+            url = outline.get('xmlUrl') or outline.get('xmlurl')
+            if url:
+                feeds.append(ImportFeed(url.strip(), outline.get('title') or outline.get('text')))
+    else:
+        with open(path, 'r', encoding='utf-8-sig') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    feeds.append(ImportFeed(line))
+    return feeds
+
+
+def unique_feeds(feeds: List[ImportFeed]) -> List[ImportFeed]:
+    ''' first occurrence of each podcast id (`http://` and `https://` URLs of a feed are the same podcast) '''
+    seen: Set[str] = set()
+    unique = []
+    for feed in feeds:
+        key = podcast_guid_uuid5(feed.url) if feed.url.startswith(('http://', 'https://')) else feed.url
+        if key not in seen:
+            seen.add(key)
+            unique.append(feed)
+    return unique
+
+
+def register_feeds(feeds: List[ImportFeed]) -> ImportStats:
+    ''' write an index JSON for each new feed, without fetching it '''
+    registry = get_podcast_registry()
+    stats = ImportStats(total=len(feeds))
+    for feed in feeds:
+        if not feed.url.startswith(('http://', 'https://')):
+            done = stats.record(feed.url, IMPORT_INVALID, 'not a http(s) URL')
+        elif podcast_guid_uuid5(feed.url) in registry:
+            done = stats.record(feed.url, IMPORT_EXISTS)
+        else:
+            podcast = Podcast()
+            podcast.create(init_feed_url=feed.url)
+            # placeholder, replaced by the title of the feed on the first refresh.
+            # The index filename keeps it, podcasts are looked up by id.
+            podcast['title'] = safe_chars(feed.title or '', replace_space=False)[:IMPORT_TITLE_MAX_CHARS]
+            podcast_json_file_path = save_podcast_index_json(podcast)
+            registry.add(podcast.id, podcast_json_file_path.name)
+            done = stats.record(feed.url, IMPORT_REGISTERED)
+        if done % PROGRESS_EVERY == 0:
+            print(f'import register: {stats.progress()}')
+    print(stats.summary('register'))
+    return stats
+
+
+def fetch_feed_metadata(podcast_json_file_path: Path, session: requests.Session) -> Tuple[str, Optional[str]]:
+    ''' fetch and parse the feed of a podcast, no audio. Returns (IMPORT_*, error)
+
+    The podcast stays "new" (`last_success_timestamp` is 0) and no HTTP validators are kept,
+    so the next `--update` archives every entry first.
+    '''
+    podcast = Podcast()
+    podcast.load(podcast_json_file_path)
+    error = None
+    try:
+        with resource_lock(DATA_DIR / PODCAST_LOCK_DIR, 'podcast', podcast.id):
+            try:
+                parse_feed(podcast, get_feed(session, podcast.feed_url))
+            except Exception as e:
+                podcast.update_failed()
+                schedule.record_failure(podcast)
+                error = f'{type(e).__name__}: {e}'
+            else:
+                podcast.saveweb['last_checked_timestamp'] = int(time.time())
+                podcast.saveweb['last_checked_status'] = 'success'
+            save_podcast_index_json(podcast, podcast_json_file_path=podcast_json_file_path)
+    except AlreadyRunningError:
+        return IMPORT_LOCKED, None
+    return (IMPORT_FAILED, error) if error is not None else (IMPORT_FETCHED, None)
+
+
+def iter_unchecked_podcasts(feeds: List[ImportFeed]) -> Iterator[Tuple[str, Path]]:
+    ''' (feed_url, index JSON) of the imported feeds that were never checked '''
+    registry = get_podcast_registry()
+    for feed in feeds:
+        if not feed.url.startswith(('http://', 'https://')):
+            continue
+        podcast_json_file_path = registry.path_of(podcast_guid_uuid5(feed.url))
+        if podcast_json_file_path is None:
+            continue
+        podcast = Podcast()
+        podcast.load(podcast_json_file_path)
+        if not podcast.saveweb.get('last_checked_timestamp'):
+            yield feed.url, podcast_json_file_path
+
+
+def fetch_metadata(feeds: List[ImportFeed], session_factory: Callable[[], requests.Session],
+                   workers: int = 1) -> ImportStats:
+    ''' metadata pass, `workers` feeds in parallel, each worker thread with its own session '''
+    pending = list(iter_unchecked_podcasts(feeds))
+    stats = ImportStats(total=len(pending))
+    print(f'import metadata: {len(pending)} feed(s) never checked')
+    local = threading.local()
+
+    def worker(podcast_json_file_path: Path):
+        # requests.Session is not thread-safe, one session per worker thread
+        if getattr(local, 'session', None) is None:
+            local.session = session_factory()
+        return fetch_feed_metadata(podcast_json_file_path, session=local.session)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='import') as executor:
+        running: Dict[Future, str] = {}
+
+        def collect(done: Set[Future]):
+            for future in done:
+                feed_url = running.pop(future)
+                try:
+                    result, error = future.result()
+                except Exception as e: # broken index JSON, etc.
+                    result, error = IMPORT_FAILED, f'{type(e).__name__}: {e}'
+                stats.record(feed_url, result, error)
+                print(f'import metadata: {stats.progress()} {result} {feed_url}')
+
+        for feed_url, podcast_json_file_path in pending:
+            if len(running) >= workers * 2:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                collect(done)
+            running[executor.submit(worker, podcast_json_file_path)] = feed_url
+        collect(wait(running).done)
+
+    print(stats.summary('metadata'))
+    return stats
+
+
+def import_feeds(paths: List[Path], session_factory: Callable[[], requests.Session],
+                 metadata_only: bool = False, workers: int = 1) -> List[ImportFeed]:
+    ''' register the feeds of the import files, and fetch their metadata if `metadata_only` '''
+    feeds: List[ImportFeed] = []
+    for path in paths:
+        file_feeds = read_import_file(path)
+        print(f'import: {len(file_feeds)} feed(s) in {path}')
+        feeds.extend(file_feeds)
+    feeds = unique_feeds(feeds)
+    register_feeds(feeds)
+    if metadata_only:
+        fetch_metadata(feeds, session_factory=session_factory, workers=workers)
+    return feeds
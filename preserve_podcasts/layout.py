@@ -0,0 +1,45 @@
+""" The `pod_data/` layout: directories, file names and marks.
+
+No third-party imports here, so that every command (and `-h`) can use them cheaply.
+
+    pod_data/
+        podcasts_index/podcast_<id>_<title>.json    see PodcastRegistry
+        podcasts_audio/<id>/<guid sha1>/<audio>     plus the marks below, the entry and the audio metadata
+        blobs/<sha1[:2]>/<sha1>                     see BlobStore
+        catalog.sqlite3                             see Catalog
+"""
+from pathlib import Path
+from typing import Iterator
+
+
+DATA_DIR = Path('pod_data/')
+PODCAST_INDEX_DIR = 'podcasts_index/'
+PODCAST_LOCK_DIR = 'podcasts_lock/'
+PODCAST_AUDIO_DIR = 'podcasts_audio/'
+PODCAST_JSON_PREFIX = 'podcast_'
+PODCAST_ID_CACHE = 'feed_id_cache.txt'
+__DEMO__PODCAST_JSON_FILE = DATA_DIR / PODCAST_INDEX_DIR / PODCAST_JSON_PREFIX / '114514_abcdedfdsf.json'
+__DEMO__PODCAST_AUDIO_FILE = DATA_DIR / PODCAST_AUDIO_DIR / '114514/guid_sha1_aabbcc/ep123.mp3'
+LOCK_FILE = 'preserve_podcasts.lock'
+CATALOG_FILE = 'catalog.sqlite3'
+BLOB_DIR = 'blobs/' # content-addressed audio, see blobs.py
+EPISODE_LOCK_DIR = 'episode_lock/'
+
+ # title mark
+TITLE_MARK_PREFIX = '_=TITLE=='
+MARKS_SUFFIX = '.mark'
+
+# upload marks, in the episode directory
+MARKS_PREFIX = '_'
+PENDING_MARK = '_pending.mark'
+UPLOADED_MARK = '_uploaded.mark'
+SPAM_MARK = '_spam.mark'
+
+# unfinished downloads, resumed with `Range` on the next run
+PART_SUFFIX = '.part'
+PART_META_SUFFIX = '.part.json' # validators of the .part file, for `If-Range`
+
+
+def get_podcast_json_file_paths() -> Iterator[Path]:
+    for podcast_json_file_path in (DATA_DIR / PODCAST_INDEX_DIR).glob(f'{PODCAST_JSON_PREFIX}*.json'):
+        yield podcast_json_file_path
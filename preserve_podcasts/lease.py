@@ -0,0 +1,272 @@
+""" Lease-based work distribution between archiving nodes.
+
+fcntl locks (`FileLock`) only work between the processes of one host, and not reliably over NFS.
+With `--lease-db`, podcasts (`podcastsPreserve --update`) and episodes (`podcastsUpload`) are
+claimed in a shared SQLite lease table instead: a lease expires after `ttl` seconds unless its
+node keeps renewing it (heartbeat), so the work of a crashed node is picked up by the others.
+
+The lease DB must be on a filesystem with working SQLite locking (a local disk for several
+processes of one host, or a share that supports POSIX locks), and the clocks of the nodes
+should be in sync (NTP), leases are compared with wall-clock time.
+
+A node that loses a lease (heartbeat late, taken over by another node) stops working on it:
+`check_leases()` raises `LeaseLostError` between two episodes, and so does leaving the `with` block.
+
+    python -m preserve_podcasts.lease <lease_db> # list the current leases
+"""
+import atexit
+import logging
+import os
+from pathlib import Path
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from typing import Optional, Set, Union
+import uuid
+
+from preserve_podcasts.utils.fileLock import AlreadyRunningError, FileLock
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEASE_TTL = 60 * 5 # seconds
+
+_entered = threading.local() # LeaseLocks entered by the current thread
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS leases (
+    resource TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    acquired_timestamp REAL NOT NULL,
+    expires_timestamp REAL NOT NULL
+);
+'''
+
+
+def default_node_id() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+class LeaseCoordinator:
+    """ Claims resources (`podcast:<id>`, `episode:<guid_sha1>`) in a shared SQLite lease table.
+
+    The held leases are renewed every `ttl / 3` seconds by a heartbeat thread,
+    and released on `close()` (also called at exit).
+    """
+    def __init__(self, db_path: Union[str, Path], node_id: Optional[str] = None, ttl: float = DEFAULT_LEASE_TTL):
+        self.db_path = Path(db_path)
+        self.node_id = node_id or default_node_id()
+        self.ttl = ttl
+        self._local = threading.local()
+        self._held: Set[str] = set()
+        self._claiming: Set[str] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat: Optional[threading.Thread] = None
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn().executescript(SCHEMA)
+        atexit.register(self.close)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # autocommit, transactions are explicit (BEGIN IMMEDIATE)
+            # no WAL: it does not work on network filesystems
+            conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def acquire(self, resource: str) -> bool:
+        ''' claim `resource`, False if another node (or thread of this node) holds an unexpired lease on it '''
+        with self._lock:
+            if resource in self._held or resource in self._claiming:
+                return False
+            self._claiming.add(resource)
+        try:
+            if not self._claim(resource):
+                return False
+            with self._lock:
+                self._held.add(resource)
+        finally:
+            with self._lock:
+                self._claiming.discard(resource)
+        self._start_heartbeat()
+        return True
+
+    def _claim(self, resource: str) -> bool:
+        conn = self._conn()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT owner, expires_timestamp FROM leases WHERE resource = ?',
+                               (resource,)).fetchone()
+            if row is not None and row['owner'] != self.node_id and row['expires_timestamp'] > now:
+                conn.execute('ROLLBACK')
+                return False
+            if row is not None and row['owner'] != self.node_id:
+                logger.warning(f'lease: {resource} expired ({row["owner"]}), taking it over')
+            conn.execute('''
+                INSERT OR REPLACE INTO leases (resource, owner, acquired_timestamp, expires_timestamp)
+                VALUES (?, ?, ?, ?)
+                ''', (resource, self.node_id, now, now + self.ttl))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return True
+
+    def owner(self, resource: str) -> Optional[str]:
+        ''' node holding an unexpired lease on `resource` '''
+        row = self._conn().execute('SELECT owner FROM leases WHERE resource = ? AND expires_timestamp > ?',
+                                   (resource, time.time())).fetchone()
+        return row['owner'] if row is not None else None
+
+    def release(self, resource: str):
+        with self._lock:
+            self._held.discard(resource)
+        self._conn().execute('DELETE FROM leases WHERE resource = ? AND owner = ?', (resource, self.node_id))
+
+    def renew(self):
+        ''' extend the held leases, forget the ones another node took over '''
+        with self._lock:
+            held = list(self._held)
+        if not held:
+            return
+        conn = self._conn()
+        expires = time.time() + self.ttl
+        lost = []
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for resource in held:
+                cursor = conn.execute('UPDATE leases SET expires_timestamp = ? WHERE resource = ? AND owner = ?',
+                                      (expires, resource, self.node_id))
+                if cursor.rowcount == 0:
+                    lost.append(resource)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        for resource in lost:
+            logger.warning(f'lease: lost {resource} (expired and taken over by another node)')
+            with self._lock:
+                self._held.discard(resource)
+
+    def is_held(self, resource: str) -> bool:
+        with self._lock:
+            return resource in self._held
+
+    def _start_heartbeat(self):
+        with self._lock:
+            if self._heartbeat is not None:
+                return
+            self._heartbeat = threading.Thread(target=self._heartbeat_loop, name='lease-heartbeat', daemon=True)
+            self._heartbeat.start()
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                self.renew()
+            except sqlite3.Error as e:
+                logger.warning(f'lease: heartbeat failed: {e}')
+
+    def close(self):
+        ''' stop the heartbeat and release every held lease '''
+        self._stop.set()
+        with self._lock:
+            held = list(self._held)
+        for resource in held:
+            try:
+                self.release(resource)
+            except sqlite3.Error as e:
+                logger.warning(f'lease: failed to release {resource}: {e}')
+
+    def lease(self, resource: str) -> 'LeaseLock':
+        return LeaseLock(self, resource)
+
+
+class LeaseLostError(Exception):
+    """ the lease expired and was taken over by another node before the work was done """
+
+
+class LeaseLock:
+    """ `with LeaseLock(coordinator, resource):`, a drop-in for `FileLock`, raises AlreadyRunningError """
+    def __init__(self, coordinator: LeaseCoordinator, resource: str):
+        self.coordinator = coordinator
+        self.resource = resource
+
+    def __enter__(self):
+        if not self.coordinator.acquire(self.resource):
+            raise AlreadyRunningError(
+                f'Another node is already working on it. ({self.coordinator.owner(self.resource)}) ({self.resource})')
+        if not hasattr(_entered, 'locks'):
+            _entered.locks = []
+        _entered.locks.append(self)
+        return self
+
+    def check(self):
+        if not self.coordinator.is_held(self.resource):
+            raise LeaseLostError(f'lease: {self.resource} was lost before the work was done')
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _entered.locks.remove(self)
+        if not self.coordinator.is_held(self.resource):
+            if exc_type is None:
+                self.check() # the work may be half done by two nodes, don't report it as done
+            return
+        self.coordinator.release(self.resource)
+
+    # decorator
+    def __call__(self, func):
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return wrapper
+
+
+_coordinator: Optional[LeaseCoordinator] = None
+
+def configure_lease_coordinator(db_path: Optional[Union[str, Path]], ttl: float = DEFAULT_LEASE_TTL) -> Optional[LeaseCoordinator]:
+    ''' use a shared lease table (`--lease-db`) instead of local lock files, None: lock files '''
+    global _coordinator
+    _coordinator = LeaseCoordinator(db_path, ttl=ttl) if db_path else None
+    if _coordinator is not None:
+        print(f'lease: node {_coordinator.node_id}, lease DB {_coordinator.db_path}')
+    return _coordinator
+
+
+def get_lease_coordinator() -> Optional[LeaseCoordinator]:
+    return _coordinator
+
+
+def resource_lock(lock_dir: Path, kind: str, name: str):
+    ''' lease on `<kind>:<name>` if a lease coordinator is configured, otherwise the local `FileLock(lock_dir, name)` '''
+    coordinator = get_lease_coordinator()
+    if coordinator is not None:
+        return coordinator.lease(f'{kind}:{name}')
+    return FileLock(lock_dir, name)
+
+
+def check_leases():
+    ''' raise LeaseLostError if a lease entered by this thread was lost, call it between units of work '''
+    for lock in getattr(_entered, 'locks', ()):
+        lock.check()
+
+
+def main():
+    if len(sys.argv) != 2:
+        print('usage: python -m preserve_podcasts.lease <lease_db>')
+        sys.exit(2)
+    conn = sqlite3.connect(sys.argv[1])
+    conn.executescript(SCHEMA)
+    now = time.time()
+    for resource, owner, acquired, expires in conn.execute(
+            'SELECT resource, owner, acquired_timestamp, expires_timestamp FROM leases ORDER BY resource'):
+        state = f'expires in {expires - now:.0f}s' if expires > now else f'expired {now - expires:.0f}s ago'
+        print(f'{resource}\t{owner}\theld for {now - acquired:.0f}s\t{state}')
+
+
+if __name__ == '__main__':
+    main()
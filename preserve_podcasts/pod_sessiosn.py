@@ -1,14 +1,33 @@
 import queue
 import time
+from typing import Optional
 
 import requests
 
 from preserve_podcasts.version import PTP_VERSION
+from preserve_podcasts.utils.rate_limit import parse_retry_after
 from preserve_podcasts.utils.requests_patch import SessionMonkeyPatch
 
 
 PRESERVE_THOSE_POD_UA = f'PreserveThosePod/{PTP_VERSION}'
 
+# retry policy, shared by create_session() and the asyncio engine (async_engine.py)
+RETRY_TOTAL = 5
+RETRY_BACKOFF_FACTOR = 1.5
+RETRY_STATUS_FORCELIST = [500, 502, 503, 504, 429]
+RETRY_ALLOWED_METHODS = ['DELETE', 'PUT', 'GET', 'OPTIONS', 'TRACE', 'HEAD', 'POST']
+RETRY_BACKOFF_MAX = 120 # urllib3's default
+RETRY_EXTRA_SLEEP = 5 # seconds, added to every backoff (see CustomRetry.sleep())
+
+
+def retry_sleep_time(consecutive_errors: int, retry_after: Optional[float] = None) -> float:
+    ''' seconds CustomRetry sleeps before the next retry (urllib3's Retry.get_backoff_time() + RETRY_EXTRA_SLEEP),
+    at least `retry_after` (parsed `Retry-After` header) '''
+    backoff = 0.0
+    if consecutive_errors > 1:
+        backoff = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_FACTOR * (2 ** (consecutive_errors - 1))) + RETRY_EXTRA_SLEEP
+    return max(backoff, retry_after or 0)
+
 
 def create_session():
     session = requests.Session()
@@ -46,19 +65,21 @@ def create_session():
 
             def sleep(self, response=None):
                 backoff = self.get_backoff_time()
-                if backoff <= 0:
-                    return
+                retry_after = None
                 if response is not None:
                     msg = 'req retry (%s)' % response.status
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
                 else:
                     msg = None
-                time.sleep(backoff+5)
+                sleep_time = max(backoff+RETRY_EXTRA_SLEEP if backoff > 0 else 0, retry_after or 0)
+                if sleep_time <= 0:
+                    return
+                time.sleep(sleep_time)
 
         __retries__ = CustomRetry(
-            total=5, backoff_factor=1.5,
-            status_forcelist=[500, 502, 503, 504, 429],
-            allowed_methods=['DELETE', 'PUT', 'GET',
-                             'OPTIONS', 'TRACE', 'HEAD', 'POST']
+            total=RETRY_TOTAL, backoff_factor=RETRY_BACKOFF_FACTOR,
+            status_forcelist=RETRY_STATUS_FORCELIST,
+            allowed_methods=RETRY_ALLOWED_METHODS
         )
         session.mount("https://", HTTPAdapter(max_retries=__retries__))
         session.mount("http://", HTTPAdapter(max_retries=__retries__))
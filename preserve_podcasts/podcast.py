@@ -1,3 +1,4 @@
+import copy
 import dataclasses
 import json
 from pathlib import Path
@@ -30,6 +31,18 @@ class Podcast:
             'last_success_timestamp': 0,
             'last_checked_timestamp': 0,
             'last_checked_status': 'success',
+            # refresh schedule, see schedule.py
+            'next_check_timestamp': 0,
+            'refresh_interval': None,
+            'consecutive_failures': 0,
+            'feed_episode_count': None, # episodes in the last parsed feed
+        },
+
+        # HTTP validators of the last successfully archived feed response,
+        # sent back as If-None-Match/If-Modified-Since on the next refresh
+        'http_cache': {
+            'etag': None,
+            'last_modified': None,
         },
 
         'tags': [],
@@ -77,10 +90,13 @@ class Podcast:
     # TODO: class Saveweb
     @property
     def saveweb(self)->Dict:    return self._Dic['saveweb']
+    @property
+    def http_cache(self)->Dict: return self._Dic['http_cache']
 
 
     def __init__(self):
-        self._Dic = Podcast._Dic
+        # each instance gets its own copy, the class-level _Dic is only a template
+        self._Dic = copy.deepcopy(Podcast._Dic)
 
     def __getitem__(self, key):
         return self._Dic[key]
@@ -121,6 +137,10 @@ class Podcast:
 
         for key in dic:
             if key in self._Dic:
+                if key in ('saveweb', 'http_cache') and isinstance(dic[key], dict):
+                    # keep the defaults of the keys added after this JSON was saved
+                    self._Dic[key] = {**Podcast._Dic[key], **dic[key]} # type: ignore @runtimeTypeCheck
+                    continue
                 self._Dic[key] = dic[key] # type: ignore @runtimeTypeCheck
 
     def update_failed(self):
@@ -132,6 +152,21 @@ class Podcast:
         self._Dic['saveweb']['last_success_timestamp'] = int(time.time())
         self._Dic['saveweb']['last_checked_status'] = 'success'
 
+    def conditional_headers(self)->Dict[str, str]:
+        ''' If-None-Match/If-Modified-Since headers for a conditional GET of the feed '''
+        headers = {}
+        if self.http_cache.get('etag'):
+            headers['If-None-Match'] = self.http_cache['etag']
+        if self.http_cache.get('last_modified'):
+            headers['If-Modified-Since'] = self.http_cache['last_modified']
+        return headers
+
+    def update_http_cache(self, etag: Optional[str], last_modified: Optional[str]):
+        self._Dic['http_cache'] = {
+            'etag': etag,
+            'last_modified': last_modified,
+        }
+
     def to_dict(self):
         __Dic = self._Dic
         if 'bozo_exception' in __Dic:
@@ -1,32 +1,53 @@
 import builtins
+import codecs
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+import dataclasses
+import heapq
 from pathlib import Path
 import logging
+import re
 import shutil
+import threading
 
 import rich
 import requests
 from requests.structures import CaseInsensitiveDict
 
-from preserve_podcasts.utils.file import audio_duration, md5file, sha1file
-from preserve_podcasts.utils.fileLock import AlreadyRunningError, FileLock
-from preserve_podcasts.utils.response import get_content_disposition, get_content_length, get_content_type, get_etag, get_last_modified, float_last_modified, get_suggested_filename
+from preserve_podcasts.utils.file import MultiHasher, audio_duration, file_stat, md5file, sha1file
+from preserve_podcasts.utils import metrics
+from preserve_podcasts.lease import DEFAULT_LEASE_TTL, LeaseLostError, check_leases, configure_lease_coordinator, resource_lock
+from preserve_podcasts.utils.dirwatch import DEFAULT_POLL_INTERVAL
+from preserve_podcasts.utils.fileLock import AlreadyRunningError
+from preserve_podcasts.utils.rate_limit import DEFAULT_HOST_BURST, DEFAULT_HOST_RATE, configure_rate_limiter
+from preserve_podcasts.utils.response import get_content_disposition, get_content_length, get_content_range, get_content_type, get_etag, get_last_modified, float_last_modified, get_suggested_filename
 from preserve_podcasts.utils.type_check import runtimeTypeCheck
 from preserve_podcasts.utils.util import podcast_guid_uuid5, safe_chars, sha1
 
 logger = logging.getLogger(__name__)
 
-from typing import Dict, List, Optional, Set
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Set, Tuple
 import os
 import time
 import json
 from urllib.parse import urlparse
 
-import feedparser
-from charset_normalizer import from_bytes
+from charset_normalizer import from_bytes # loaded by requests anyway
 
+from . import schedule
+from .blobs import BlobStore
+from .catalog import DOWNLOAD_STATE_DOWNLOADED, get_catalog
 from .podcast import Podcast
+from .registry import PodcastRegistry
 from .pod_sessiosn import PRESERVE_THOSE_POD_UA, create_session
 from .exception import FeedTooLargeError
+from .layout import (
+    BLOB_DIR, CATALOG_FILE, DATA_DIR, MARKS_SUFFIX, PART_META_SUFFIX, PART_SUFFIX, PENDING_MARK,
+    PODCAST_AUDIO_DIR, PODCAST_ID_CACHE, PODCAST_INDEX_DIR, PODCAST_JSON_PREFIX, PODCAST_LOCK_DIR,
+    SPAM_MARK, TITLE_MARK_PREFIX, UPLOADED_MARK, get_podcast_json_file_paths,
+)
+
+if TYPE_CHECKING:
+    import feedparser # imported by parse_feed(), `podcastsUpload` does not need it
 
 
 DEBUG_MODE = False
@@ -41,40 +62,92 @@ else:
 
 assert print
 
-# Limit Feed size to 20 MiB
+# Limit Feed size to 40 MiB
 FEED_SIZE_LIMIT = 1024 * 1024 * 40 # 40 MiB
+FEED_CHUNK_SIZE = 1024 * 64 # 64 KiB
 MAX_EPISODE_AUDIO_SIZE = 1024 * 1024 * 778 # 778 MiB
 
 # Maximum tolerable file size overestimation rate
 MAX_EPISODE_AUDIO_SIZE_TOLERANCE = 3
 
 
-DATA_DIR = Path('pod_data/')
-PODCAST_INDEX_DIR = 'podcasts_index/'
-PODCAST_LOCK_DIR = 'podcasts_lock/'
-PODCAST_AUDIO_DIR = 'podcasts_audio/'
-PODCAST_JSON_PREFIX = 'podcast_'
-PODCAST_ID_CACHE = 'feed_id_cache.txt'
-__DEMO__PODCAST_JSON_FILE = DATA_DIR / PODCAST_INDEX_DIR / PODCAST_JSON_PREFIX / '114514_abcdedfdsf.json'
-__DEMO__PODCAST_AUDIO_FILE = DATA_DIR / PODCAST_AUDIO_DIR / '114514/guid_sha1_aabbcc/ep123.mp3'
-LOCK_FILE = 'preserve_podcasts.lock'
+EPISODE_DOWNLOAD_CHUNK_SIZE = 1024 * 337 # bytes
+PROGRESS_INTERVAL = 1.0 # seconds between two progress lines of a download
+POST_DOWNLOAD_DELAY = 3 # seconds, pause after each downloaded episode (0 in the benchmarks)
 
- # title mark
-TITLE_MARK_PREFIX = '_=TITLE=='
-MARKS_SUFFIX = '.mark'
 
-EPISODE_DOWNLOAD_CHUNK_SIZE = 1024 * 337 # bytes
+class ArchiveInterrupted(Exception):
+    """ shutdown requested (see `request_shutdown()`), the podcast was left between two episodes
+    or with a resumable .part file """
 
-REFRESH_INTERVAL = 60 * 60 * 24 # 24 hours
 
+_shutdown_requested = threading.Event()
 
-def checkFeedSize(data: bytes):
-    if data is None:
-        return
-    if len(data) > FEED_SIZE_LIMIT:
-        raise FeedTooLargeError('Feed too large')
+def request_shutdown():
+    ''' make the running refreshes stop at the next episode (or download chunk), their locks are released '''
+    _shutdown_requested.set()
+
+
+def check_shutdown():
+    if _shutdown_requested.is_set():
+        raise ArchiveInterrupted('shutdown requested')
+
+
+_blob_store: Optional[BlobStore] = None
+_blob_store_lock = threading.Lock()
+
+def get_blob_store() -> BlobStore:
+    ''' the process-wide blob store (DATA_DIR / BLOB_DIR) '''
+    global _blob_store
+    with _blob_store_lock:
+        if _blob_store is None:
+            _blob_store = BlobStore(DATA_DIR / BLOB_DIR)
+        return _blob_store
+
+
+def dedupe_episodes():
+    ''' move the downloaded episodes into the blob store (byte-identical ones become hardlinks)
+    and remove the blobs no episode uses anymore '''
+    blob_store = get_blob_store()
+    linked, saved = 0, 0
+    for row in get_catalog().downloaded_files():
+        audio_path = DATA_DIR / PODCAST_AUDIO_DIR / row['podcast_id'] / row['guid_sha1'] / row['filename']
+        if not audio_path.exists():
+            continue
+        if blob_store.adopt(audio_path, row['sha1']):
+            linked += 1
+            saved += os.path.getsize(audio_path)
+    freed = blob_store.prune()
+    print(f'blobs: {linked} duplicate episode(s) linked ({saved / 1024 / 1024:.1f} MiB saved), '
+          f'{freed / 1024 / 1024:.1f} MiB of unused blobs removed')
+
+
+_podcast_registry: Optional[PodcastRegistry] = None
+_podcast_registry_lock = threading.Lock()
+
+def get_podcast_registry() -> PodcastRegistry:
+    ''' the process-wide podcast id registry, listed from the index filenames once '''
+    global _podcast_registry
+    with _podcast_registry_lock:
+        if _podcast_registry is None:
+            _podcast_registry = PodcastRegistry(DATA_DIR / PODCAST_INDEX_DIR, PODCAST_JSON_PREFIX, PODCAST_ID_CACHE).load()
+        return _podcast_registry
 
 
+def rebuild_catalog():
+    from preserve_podcasts.catalog import UPLOAD_STATE_PENDING, UPLOAD_STATE_SPAM, UPLOAD_STATE_UPLOADED
+    get_catalog().rebuild_from_disk(
+        index_dir=DATA_DIR / PODCAST_INDEX_DIR, audio_dir=DATA_DIR / PODCAST_AUDIO_DIR,
+        podcast_json_prefix=PODCAST_JSON_PREFIX,
+        upload_marks={ # first match wins
+            UPLOADED_MARK: UPLOAD_STATE_UPLOADED,
+            SPAM_MARK: UPLOAD_STATE_SPAM,
+            PENDING_MARK: UPLOAD_STATE_PENDING,
+        })
+
+
+_last_progress = 0.0
+
 def checkEpisodeAudioSize(data, possible_sizes: List[int]=[-1]):
     ''' :data: bytes or int'''
     if type(data) == int:
@@ -91,121 +164,446 @@ def checkEpisodeAudioSize(data, possible_sizes: List[int]=[-1]):
     if possible_size > 0 and data_size > possible_size * MAX_EPISODE_AUDIO_SIZE_TOLERANCE:
         raise FeedTooLargeError('Episode audio too large')
     
-    # show progress bar
+    # show progress bar, at most every PROGRESS_INTERVAL
+    global _last_progress
+    now = time.monotonic()
+    if data_size and now - _last_progress < PROGRESS_INTERVAL:
+        return
+    _last_progress = now
     print(f'{data_size}/{possible_size} \t {data_size/1024/1024:.2f} MiB {data_size/possible_size*100:.2f}%',
         end='               \r')
 
 
 
-def get_feed(session: requests.Session, url: str) -> Optional[bytes]:
-    session.stream = True
-    with session.get(url, stream=True) as r:
-        r.raise_for_status()
-        data_raw: Optional[bytes] = None
-        encoding = r.encoding
-        for chunk in r.iter_content(chunk_size=1024):
-            checkFeedSize(chunk)
-            if data_raw is None:
-                data_raw = chunk
-            else:
-                data_raw += chunk
-        if type(data_raw) != bytes:
-            return None
-        apparent_encoding = from_bytes(data_raw).best()
-        if apparent_encoding is not None:
-            apparent_encoding = apparent_encoding.encoding
-    print(encoding, apparent_encoding)
+@dataclasses.dataclass
+class FeedResponse:
+    response: requests.Response
+    content: Optional[bytes] # None if not modified (304)
+    response_headers: Dict[str, str] # lowercased, for feedparser
+    request_headers: Dict[str, str]
 
-    return data_raw
+    @property
+    def not_modified(self) -> bool:
+        return self.content is None
 
 
+XML_ENCODING_RE = re.compile(rb'^\s*<\?xml[^>]*?encoding\s*=\s*["\']([A-Za-z0-9._:-]+)["\']')
+BOMS = (codecs.BOM_UTF8, codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE, codecs.BOM_UTF32_LE, codecs.BOM_UTF32_BE)
 
 
-@runtimeTypeCheck()
-def download_episode(session: requests.Session, url: str, *, guid: str, episode_dir: Path, filename: str,
-                    possible_size: int=-1, title: str= '',
-                    force_redownload: bool = False):
-    to_download = True
-    possible_sizes = [possible_size]
+def declared_feed_encoding(content_type: Optional[str], data: bytes) -> Optional[str]:
+    ''' charset of the Content-Type header, BOM or XML declaration, None if the feed does not declare one '''
+    if content_type:
+        for param in content_type.split(';')[1:]:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'charset' and value.strip(' "\''):
+                return value.strip(' "\'')
+    if data.startswith(BOMS):
+        return 'bom'
+    m = XML_ENCODING_RE.match(data[:1024])
+    if m:
+        return m.group(1).decode('ascii')
+    return None
+
+
+def get_feed(session: requests.Session, url: str, headers: Optional[Dict[str, str]] = None) -> FeedResponse:
+    ''' fetch a feed, up to FEED_SIZE_LIMIT bytes (after decompression)
+
+    raises FeedTooLargeError
+    '''
+    _headers = {'User-Agent': PRESERVE_THOSE_POD_UA}
+    _headers.update(headers or {})
+    with metrics.timed('feed_fetch'), session.get(url, stream=True, headers=_headers) as r:
+        if r.status_code == 304:
+            return FeedResponse(response=r, content=None, response_headers=lowercase_headers(r.headers),
+                                request_headers=dict(r.request.headers))
+        r.raise_for_status()
 
-    ep_audio_file_path = episode_dir / filename
-    ep_audio_meta_path = episode_dir / (filename + '.metadata.json')
-    if ep_audio_meta_path.exists():
-        with open(ep_audio_meta_path, 'r', encoding='utf-8') as f:
+        content_length = get_content_length(r)
+        if content_length > FEED_SIZE_LIMIT:
+            raise FeedTooLargeError(f'Feed too large: Content-Length {content_length}')
+        data = bytearray()
+        for chunk in r.iter_content(chunk_size=FEED_CHUNK_SIZE):
+            data += chunk
+            if len(data) > FEED_SIZE_LIMIT:
+                raise FeedTooLargeError(f'Feed too large: > {FEED_SIZE_LIMIT} bytes')
+        metrics.add_bytes('feed_fetch', len(data))
+
+    content = bytes(data)
+    return FeedResponse(response=r, content=content,
+                        response_headers=feed_response_headers(url, r.headers, content),
+                        request_headers=dict(r.request.headers))
+
+
+def feed_response_headers(url: str, headers: CaseInsensitiveDict, content: bytes) -> Dict[str, str]:
+    ''' lowercased headers for feedparser, with a guessed charset if the feed does not declare its encoding '''
+    response_headers = lowercase_headers(headers)
+    # only guess when the feed does not tell us, charset_normalizer is slow on big feeds
+    if declared_feed_encoding(response_headers.get('content-type'), content) is None:
+        best_guess = from_bytes(content).best()
+        if best_guess is not None:
+            content_type = response_headers.get('content-type', 'application/xml')
+            response_headers['content-type'] = f'{content_type}; charset={best_guess.encoding}'
+            logger.info(f'{url}: no encoding declared, guessed {best_guess.encoding}')
+    return response_headers
+
+
+def load_part_validators(part_path: Path, part_meta_path: Path, url: str) -> Optional[str]:
+    """ Return the `If-Range` validator of a resumable .part file, or None if it can not be resumed. """
+    if not part_path.exists() or not part_meta_path.exists():
+        return None
+    try:
+        with open(part_meta_path, 'r', encoding='utf-8') as f:
+            part_meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if part_meta.get('url') != url:
+        return None
+
+    etag = part_meta.get('etag')
+    # If-Range requires a strong validator
+    if etag and not etag.startswith('W/'):
+        return etag
+    return part_meta.get('last-modified')
+
+
+def remove_part_files(part_path: Path, part_meta_path: Path):
+    for path in (part_path, part_meta_path):
+        if path.exists():
+            os.remove(path)
+
+
+# Content-Length and Range count the encoded (compressed) bytes, we write the decoded ones
+EPISODE_REQUEST_HEADERS = {'Accept-Encoding': 'identity'}
+
+
+def is_content_encoded(r: requests.Response) -> bool:
+    return r.headers.get('content-encoding', 'identity').strip().lower() not in ('', 'identity')
+
+
+class RestartDownload(Exception):
+    """ the .part file can not be resumed with this response, start over """
+
+
+@dataclasses.dataclass
+class EpisodeDownload:
+    """ An episode download, shared by `download_episode()` and the asyncio engine (`async_engine.py`).
+
+    plan_episode_download() -> start_episode_download(response) -> write_part() ... -> finish_episode_download()
+    """
+    url: str
+    episode_dir: Path
+    filename: str
+    title: str = ''
+    possible_size: int = -1
+    possible_sizes: List[int] = dataclasses.field(default_factory=list)
+    force_redownload: bool = False
+    to_download: bool = True
+    resume_from: int = 0
+    headers: Dict[str, str] = dataclasses.field(default_factory=lambda: dict(EPISODE_REQUEST_HEADERS))
+    content_length: int = -1
+    real_size: int = 0
+    started: float = 0.0 # time.monotonic() of the response headers
+    # set if the audio was linked from the blob store instead of downloaded (see `reuse_download()`)
+    blob_sha1: Optional[str] = None
+    blob_md5: Optional[str] = None
+
+    def __post_init__(self):
+        self._hasher: Optional[MultiHasher] = None
+        self._hash_seconds = 0.0 # hashing is done inline, timed chunk by chunk
+        self._part_file = None
+
+    @property
+    def audio_path(self) -> Path:
+        return self.episode_dir / self.filename
+
+    @property
+    def meta_path(self) -> Path:
+        return self.episode_dir / (self.filename + '.metadata.json')
+
+    @property
+    def part_path(self) -> Path:
+        return self.episode_dir / (self.filename + PART_SUFFIX)
+
+    @property
+    def part_meta_path(self) -> Path:
+        return self.episode_dir / (self.filename + PART_META_SUFFIX)
+
+    @property
+    def podcast_id(self) -> str:
+        return self.episode_dir.parent.name
+
+    @property
+    def guid_sha1(self) -> str:
+        return self.episode_dir.name
+
+
+def plan_episode_download(url: str, *, episode_dir: Path, filename: str, possible_size: int = -1,
+                          title: str = '', force_redownload: bool = False) -> Optional[EpisodeDownload]:
+    """ None if the episode is already downloaded, otherwise the download to start (with `Range` if resumable) """
+    plan = EpisodeDownload(url=url, episode_dir=episode_dir, filename=filename, title=title,
+                           possible_size=possible_size, possible_sizes=[possible_size],
+                           force_redownload=force_redownload)
+    possible_sizes = plan.possible_sizes
+    catalog = get_catalog()
+    catalog_episode = catalog.get_episode(plan.podcast_id, plan.guid_sha1)
+    if catalog_episode is not None and catalog_episode['filename'] == filename:
+        possible_sizes.append(catalog_episode['expected_size']) if catalog_episode['expected_size'] else None
+    elif plan.meta_path.exists():
+        with open(plan.meta_path, 'r', encoding='utf-8') as f:
             metadata = json.load(f)
             possible_sizes.append(metadata['http-content-length']) if 'http-content-length' in metadata else None
 
-    if os.path.exists(ep_audio_file_path) and os.path.getsize(ep_audio_file_path) in possible_sizes:
+    if os.path.exists(plan.audio_path) and os.path.getsize(plan.audio_path) in possible_sizes:
         print('File already exists')
-        to_download = False
-        return
+        if catalog_episode is None or catalog_episode['filename'] != filename:
+            catalog.update_episode_file(plan.podcast_id, plan.guid_sha1, filename=filename,
+                                        expected_size=max(possible_sizes) if max(possible_sizes) > 0 else None,
+                                        actual_size=os.path.getsize(plan.audio_path))
+        return None
 
     checkEpisodeAudioSize(0, possible_sizes) # show progress bar and check size
     print('')
 
+    if_range = None if force_redownload else load_part_validators(plan.part_path, plan.part_meta_path, url)
+    if if_range is not None:
+        plan.resume_from = os.path.getsize(plan.part_path)
+        plan.headers.update({'Range': f'bytes={plan.resume_from}-', 'If-Range': if_range})
+        print(f'Resuming from {plan.resume_from} bytes ({plan.part_path.name})')
+    return plan
+
+
+def reuse_download(plan: EpisodeDownload, etag: Optional[str], content_length: int) -> bool:
+    ''' link the audio of an episode already downloaded from the same URL (same ETag and size),
+    from any podcast, instead of downloading it again '''
+    catalog_episode = get_catalog().find_download(plan.url, etag, content_length)
+    if catalog_episode is None:
+        return False
+    blob_store = get_blob_store()
+    if not blob_store.has(catalog_episode['sha1'], size=content_length):
+        # downloaded before the blob store, or pruned
+        known_path = DATA_DIR / PODCAST_AUDIO_DIR / catalog_episode['podcast_id'] / catalog_episode['guid_sha1'] / catalog_episode['filename']
+        if not known_path.exists() or os.path.getsize(known_path) != content_length:
+            return False
+        blob_store.adopt(known_path, catalog_episode['sha1'])
+    if not blob_store.link_to(catalog_episode['sha1'], plan.audio_path):
+        return False
+    print(f'Same audio as {catalog_episode["podcast_id"]}/{catalog_episode["guid_sha1"]}, linked instead of downloaded')
+    plan.to_download = False
+    plan.blob_sha1, plan.blob_md5 = catalog_episode['sha1'], catalog_episode['md5']
+    return True
+
+
+def start_episode_download(plan: EpisodeDownload, r: requests.Response):
+    """ check the response headers and open the .part file
+
+    raises RestartDownload (after removing the .part files) if the .part file can not be resumed
+    """
+    content_range = get_content_range(r) if r.status_code == 206 else None
+    encoded = is_content_encoded(r) # despite `Accept-Encoding: identity`
+    if plan.resume_from > 0 and encoded:
+        print(f'Unable to resume (Content-Encoding: {r.headers.get("content-encoding")}), restarting download')
+        remove_part_files(plan.part_path, plan.part_meta_path)
+        raise RestartDownload(r.status_code)
+    if plan.resume_from > 0 and (r.status_code == 416 or
+                                 (r.status_code == 206 and (content_range is None or content_range[0] != plan.resume_from))):
+        print(f'Unable to resume ({r.status_code} {r.headers.get("content-range")}), restarting download')
+        remove_part_files(plan.part_path, plan.part_meta_path)
+        raise RestartDownload(r.status_code)
+    r.raise_for_status()
+    if r.history:
+        print('redirects:', ' ==> '.join([f'{redirect.status_code} {redirect.url}' for redirect in r.history]
+                                         + [f'{r.status_code} {r.url}']))
+
+    if content_range is not None:
+        content_length = content_range[2] # size of the whole file, not of this response
+    else:
+        if r.status_code == 206:
+            raise ValueError(f'Unexpected partial response: {r.headers.get("content-range")}')
+        if plan.resume_from > 0:
+            # server ignored the Range or the file changed (If-Range), fallback to a fresh download
+            print('Server sent the whole file, restarting download')
+        plan.resume_from = 0
+        # the size of the encoded body, not of the audio we get
+        content_length = -1 if encoded else get_content_length(r)
+    plan.content_length = content_length
+    plan.started = time.monotonic()
+    etag = get_etag(r)
+    last_modified = get_last_modified(r)
+
+    # content_disposition = get_content_disposition(r)
+    suggested_filename = get_suggested_filename(r)
+
+    print(f'content-length: {content_length}, etag: [green]{etag}[/green], last-modified: [yellow]{last_modified}[/yellow], suggested_filename: [blue]{suggested_filename}[/blue]')
+    if content_length > 0 and content_length != plan.possible_size:
+        if os.path.exists(plan.audio_path) and os.path.getsize(plan.audio_path) == content_length:
+            print('File already exists')
+            plan.possible_sizes.append(content_length) if content_length > 0 and content_length not in plan.possible_sizes else None
+            plan.to_download = False
+
+    plan.real_size = plan.resume_from
+    plan.to_download = plan.to_download or plan.force_redownload
+    if not plan.to_download:
+        return
+    if plan.resume_from == 0 and not plan.force_redownload and reuse_download(plan, etag, content_length):
+        return
+
+    os.makedirs(os.path.dirname(plan.audio_path), exist_ok=True)
+    if plan.resume_from == 0 and not encoded:
+        # remember the validators, so that an interrupted download can be resumed
+        with open(plan.part_meta_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({
+                'url': plan.url,
+                'etag': r.headers.get('etag'),
+                'last-modified': last_modified,
+            }, indent=4, ensure_ascii=False))
+    # hash while downloading, the file will not be read again
+    plan._hasher = MultiHasher()
+    if plan.resume_from > 0:
+        hash_start = time.perf_counter()
+        plan._hasher.update_from_file(plan.part_path)
+        plan._hash_seconds += time.perf_counter() - hash_start
+    plan._part_file = open(plan.part_path, 'ab' if plan.resume_from > 0 else 'wb')
+
+
+def write_part(plan: EpisodeDownload, chunk: bytes):
+    plan.real_size += len(chunk)
+    checkEpisodeAudioSize(plan.real_size, [plan.possible_size, plan.content_length])
+    assert plan._hasher is not None and plan._part_file is not None
+    metrics.add_bytes('episode_download', len(chunk))
+    hash_start = time.perf_counter()
+    plan._hasher.update(chunk)
+    plan._hash_seconds += time.perf_counter() - hash_start
+    plan._part_file.write(chunk)
+
+
+def close_part(plan: EpisodeDownload):
+    if plan._part_file is not None:
+        plan._part_file.close()
+        plan._part_file = None
+
+
+def finish_episode_download(plan: EpisodeDownload, r: requests.Response):
+    """ move the .part file in place, save the audio metadata and the title mark """
+    close_part(plan)
+    episode_dir = plan.episode_dir
+    ep_audio_file_path = plan.audio_path
+    download_bytes, download_seconds = None, None
+    if plan.to_download:
+        assert plan._hasher is not None
+        print('') # new line
+        content_length, real_size = plan.content_length, plan.real_size
+        download_bytes, download_seconds = real_size - plan.resume_from, time.monotonic() - plan.started
+        metrics.observe(metrics.STAGE_SECONDS, plan._hash_seconds, stage='hash')
+        metrics.add_bytes('hash', real_size)
+        if content_length > 0 and real_size != content_length:
+            raise IOError(f'Incomplete download: {real_size}/{content_length} bytes, will be resumed next time')
+        os.replace(plan.part_path, ep_audio_file_path)
+        remove_part_files(plan.part_path, plan.part_meta_path) # no .part.json if content-encoded
+        audio_sha1, audio_md5 = plan._hasher.sha1, plan._hasher.md5
+    elif plan.blob_sha1 is not None:
+        content_length, real_size = plan.content_length, plan.content_length
+        audio_sha1, audio_md5 = plan.blob_sha1, plan.blob_md5
+
+    if plan.to_download or plan.blob_sha1 is not None:
+        # create title mark file
+        title = plan.title
+        safe_title = safe_chars(title)
+        if safe_title and not os.path.exists(os.path.join(episode_dir, TITLE_MARK_PREFIX+safe_title+MARKS_SUFFIX)):
+            with open(os.path.join(episode_dir, TITLE_MARK_PREFIX+safe_title+MARKS_SUFFIX),
+                      'w', encoding='utf-8') as f:
+                if type(title) == str and title:
+                    f.write(title)
+                else:
+                    f.write('')
+
+        if plan.to_download and POST_DOWNLOAD_DELAY > 0:
+            _shutdown_requested.wait(POST_DOWNLOAD_DELAY) # time.sleep(), cut short by request_shutdown()
+
+        duration = audio_duration(ep_audio_file_path)
+        print('\nAudio duration:', duration)
+
+        save_audio_file_metadata(
+            audio_path=ep_audio_file_path, metadata_path=plan.meta_path, r=r,
+            renew=True, content_length=content_length,
+            audio_sha1=audio_sha1, audio_md5=audio_md5, duration=duration)
+        get_catalog().update_episode_file(plan.podcast_id, plan.guid_sha1, filename=plan.filename,
+                                          expected_size=content_length if content_length > 0 else None,
+                                          actual_size=real_size, sha1=audio_sha1, md5=audio_md5,
+                                          url=plan.url, etag=get_etag(r),
+                                          download_bytes=download_bytes, download_seconds=download_seconds)
+        if plan.to_download:
+            # byte-identical to an episode we already hold (another feed, a new URL...): keep one copy,
+            # the mtime goes to a new blob, not to the one of other episodes
+            get_blob_store().adopt(ep_audio_file_path, audio_sha1, mtime=response_mtime(r))
+
+    if not plan.to_download:
+        sha1 = plan.blob_sha1
+        if sha1 is None: # already downloaded
+            catalog_episode = get_catalog().get_episode(plan.podcast_id, plan.guid_sha1)
+            sha1 = catalog_episode['sha1'] if catalog_episode is not None else None
+        set_audio_mtime(ep_audio_file_path, r, sha1=sha1)
+
+
+def response_mtime(r: requests.Response) -> Optional[float]:
+    ''' Last-Modified of the response, None if missing or invalid '''
+    last_modified = get_last_modified(r)
+    if not last_modified:
+        return None
+    mtime = float_last_modified(last_modified)
+    if not mtime:
+        print('mtime error:', mtime)
+        return None
+    return mtime
+
+
+def set_audio_mtime(audio_path: Path, r: requests.Response, sha1: Optional[str] = None):
+    ''' mtime of the audio file = Last-Modified of the response
+
+    Not if the file is linked to other episodes by the blob store (see `BlobStore.set_mtime()`),
+    it would change the mtime of all of them. `sha1`: of the audio, to recognize its own blob.
+    '''
+    mtime = response_mtime(r)
+    if mtime is not None:
+        get_blob_store().set_mtime(audio_path, mtime, sha1=sha1)
+
+
+@runtimeTypeCheck()
+def download_episode(session: requests.Session, url: str, *, guid: str, episode_dir: Path, filename: str,
+                    possible_size: int=-1, title: str= '',
+                    force_redownload: bool = False):
+    plan = plan_episode_download(url, episode_dir=episode_dir, filename=filename, possible_size=possible_size,
+                                 title=title, force_redownload=force_redownload)
+    if plan is None:
+        return
+
     session.stream = True
-    with session.get(url, stream=True, allow_redirects=True) as r:
-        r.raise_for_status()
-        # show redirect history
-        print('redirect history:')
-        for redirect in r.history:
-            print(redirect.status_code, '==>', redirect.url)
-        print(r.status_code, '==>', r.url)
-        content_length = get_content_length(r)
-        etag = get_etag(r)
-        last_modified = get_last_modified(r)
-
-        # content_disposition = get_content_disposition(r)
-        suggested_filename = get_suggested_filename(r)
-
-        print(f'content-length: {content_length}, etag: [green]{etag}[/green], last-modified: [yellow]{last_modified}[/yellow], suggested_filename: [blue]{suggested_filename}[/blue]')
-        if content_length > 0 and content_length != possible_size:
-            if os.path.exists(ep_audio_file_path) and os.path.getsize(ep_audio_file_path) == content_length:
-                print('File already exists')
-                possible_sizes.append(content_length) if content_length > 0 and content_length not in possible_sizes else None
-                to_download = False
-
-        real_size = 0
-        if to_download or force_redownload:
-            os.makedirs(os.path.dirname(ep_audio_file_path), exist_ok=True)
-            with open(ep_audio_file_path, 'wb') as f:
+    with metrics.timed('episode_download'), session.get(url, stream=True, allow_redirects=True, headers=plan.headers) as r:
+        try:
+            start_episode_download(plan, r)
+        except RestartDownload:
+            r.close()
+            return download_episode(session, url, guid=guid, episode_dir=episode_dir, filename=filename,
+                                    possible_size=possible_size, title=title, force_redownload=force_redownload)
+        try:
+            if plan.to_download:
                 for chunk in r.iter_content(chunk_size=EPISODE_DOWNLOAD_CHUNK_SIZE):
-                    real_size += len(chunk)
-                    checkEpisodeAudioSize(real_size, [possible_size, content_length])
-                    f.write(chunk)
-            print('') # new line
-
-            # create title mark file
-            safe_title = safe_chars(title)
-            if safe_title and not os.path.exists(os.path.join(episode_dir, TITLE_MARK_PREFIX+safe_title+MARKS_SUFFIX)):
-                with open(os.path.join(episode_dir, TITLE_MARK_PREFIX+safe_title+MARKS_SUFFIX),
-                          'w', encoding='utf-8') as f:
-                    if type(title) == str and title:
-                        f.write(title)
-                    else:
-                        f.write('')
-            
-            time.sleep(3)
-
-            print('\nAudio duration:', audio_duration(ep_audio_file_path))
-
-            save_audio_file_metadata(
-                audio_path=ep_audio_file_path, metadata_path=ep_audio_meta_path, r=r,
-                renew=True)
-
-        # modify file modification time
-        if last_modified:
-            atime = os.path.getatime(ep_audio_file_path) # keep access time
-            mtime = float_last_modified(last_modified)
-            if mtime:
-                os.utime(ep_audio_file_path, (atime, mtime)) # modify file update time
-            else:
-                print('mtime error:', mtime)
+                    write_part(plan, chunk)
+                    check_shutdown() # the .part file is resumed next time
+        finally:
+            close_part(plan)
+    # its own stage: POST_DOWNLOAD_DELAY, ffprobe, metadata files, catalog and blob store
+    with metrics.timed('episode_finish'):
+        finish_episode_download(plan, r)
+
 
+def entry_to_json(entry: dict) -> str:
+    return json.dumps(entry, indent=4, ensure_ascii=False)
 
-def save_entry(entry:dict, file_path:str):
+
+def save_entry(entry:dict, file_path:str, entry_json: Optional[str] = None):
     with open(file_path, 'w', encoding='utf-8') as f:
-        f.write(json.dumps(entry, indent=4, ensure_ascii=False))
+        f.write(entry_json if entry_json is not None else entry_to_json(entry))
 
 
 @runtimeTypeCheck()
@@ -219,13 +617,20 @@ def save_podcast_index_json(podcast: Podcast, podcast_json_file_path: Optional[P
 
     with open(podcast_json_file_path, 'w', encoding='utf-8') as f:
         f.write(json.dumps(podcast.to_dict(), indent=4, ensure_ascii=False))
+    get_catalog().upsert_podcast(podcast, index_json=Path(podcast_json_file_path).name)
+    return Path(podcast_json_file_path)
 
 def save_audio_file_metadata(
         audio_path: Path, metadata_path: Path, r: requests.Response,
-        renew: bool = False
+        renew: bool = False, content_length: Optional[int] = None,
+        audio_sha1: Optional[str] = None, audio_md5: Optional[str] = None, duration: Optional[int] = None,
         ):
-    ''' renew: re calculate sha1, md5 '''
-    content_length = get_content_length(r)
+    ''' renew: re calculate sha1, md5
+    content_length: size of the whole file, if `r` is a 206 (resumed) response
+    audio_sha1, audio_md5, duration: already known values (hashed while downloading), skip re-reading the file
+    '''
+    if content_length is None:
+        content_length = get_content_length(r)
 
     if not renew and os.path.exists(metadata_path):
         with open(metadata_path, 'r', encoding='utf-8') as f:
@@ -233,6 +638,13 @@ def save_audio_file_metadata(
     else:
         old_metadata = {}
     
+    if duration is None:
+        duration = audio_duration(audio_path)
+    if audio_sha1 is None:
+        audio_sha1 = sha1file(audio_path) if old_metadata.get('sha1') is None else old_metadata.get('sha1')
+    if audio_md5 is None:
+        audio_md5 = md5file(audio_path) if old_metadata.get('md5') is None else old_metadata.get('md5')
+
     url_history = {}
     for i, redirect in enumerate(r.history):
 
@@ -264,9 +676,9 @@ def save_audio_file_metadata(
         'http-content-disposition-raw': get_content_disposition(r), # http header 'content-disposition
         'http-content-disposition-filename': get_suggested_filename(r) , # http header 'content-disposition'
         'actual-size': os.path.getsize(audio_path) if os.path.exists(audio_path) else None,
-        'actual-duration': audio_duration(audio_path) if audio_duration(audio_path) > 0 else None,
-        'sha1': sha1file(audio_path) if old_metadata.get('sha1') is None else old_metadata.get('sha1'),
-        'md5': md5file(audio_path) if old_metadata.get('md5') is None else old_metadata.get('md5'),
+        'actual-duration': duration if duration > 0 else None,
+        'sha1': audio_sha1,
+        'md5': audio_md5,
         'url-history': url_history,
     }
     with open(metadata_path, 'w', encoding='utf-8') as f:
@@ -277,39 +689,60 @@ def lowercase_headers(headers: CaseInsensitiveDict) -> Dict:
     return {k.lower(): v for k, v in headers.items()}
 
 
-def do_archive(podcast: Podcast, session: requests.Session, delete_episodes_not_in_feed: bool = False):
-    try:
-        r = session.get(podcast.feed_url, headers={'User-Agent': PRESERVE_THOSE_POD_UA})
-        
-        d: feedparser.FeedParserDict = feedparser.parse(r.content,
-            response_headers = lowercase_headers(r.headers), request_headers=r.request.headers,
+def parse_feed(podcast: Podcast, feed: FeedResponse) -> 'feedparser.FeedParserDict':
+    ''' parse a fetched feed and load its metadata into `podcast` '''
+    import feedparser
+    with metrics.timed('feed_parse'):
+        d: feedparser.FeedParserDict = feedparser.parse(feed.content,
+            response_headers = feed.response_headers, request_headers=feed.request_headers,
             agent = PRESERVE_THOSE_POD_UA,
             sanitize_html = True,
             resolve_relative_uris = True
             )
-        # d: feedparser.FeedParserDict = feedparser.parse(podcast.feed_url)
+    # d: feedparser.FeedParserDict = feedparser.parse(podcast.feed_url)
 
-        if d.get('bozo_exception', None) is not None:
-            if len(d.feed) == 0:
-                raise d.bozo_exception # type: ignore
-            logger.warn(f'bozo_exception: {d.bozo_exception}')
+    if d.get('bozo_exception', None) is not None:
+        if len(d.feed) == 0:
+            raise d.bozo_exception # type: ignore
+        logger.warn(f'bozo_exception: {d.bozo_exception}')
 
-        podcast.load(d.feed) # type: ignore @runtimeTypeCheck
-    except Exception as e:
-        podcast.update_failed()
-        raise e
+    podcast.load(d.feed) # type: ignore @runtimeTypeCheck
+    podcast.saveweb['feed_episode_count'] = sum(1 for entry in d.entries if is_episode_entry(entry))
 
     if DEBUG_MODE:
         os.makedirs('debug', exist_ok=True)
         with open(f'debug/{podcast.id}_{int(time.time())}.debug.json', 'w', encoding='utf-8') as f:
             f.write(json.dumps(d, indent=4, ensure_ascii=False))
+    return d
+
+
+def do_archive(podcast: Podcast, session: requests.Session, delete_episodes_not_in_feed: bool = False,
+               incremental: bool = False):
+    try:
+        feed = get_feed(session, podcast.feed_url, headers=podcast.conditional_headers())
+
+        if feed.not_modified:
+            print(f'Podcast {podcast.id}: feed not modified (304), skip.')
+            podcast.update_success()
+            schedule.record_success(podcast)
+            return
+
+        d = parse_feed(podcast, feed)
+    except Exception as e:
+        podcast.update_failed()
+        raise e
 
     podcast_audio_dir = DATA_DIR / PODCAST_AUDIO_DIR / podcast.id
 
     archive_entries(d=d, session=session, podcast_audio_dir=podcast_audio_dir,
-                    delete_episodes_not_in_feed=delete_episodes_not_in_feed)
+                    delete_episodes_not_in_feed=delete_episodes_not_in_feed, incremental=incremental)
 
+    # only remember the validators once every entry is archived,
+    # otherwise a 304 would hide the episodes that failed this time
+    podcast.update_http_cache(etag=feed.response_headers.get('etag'),
+                              last_modified=feed.response_headers.get('last-modified'))
     podcast.update_success()
+    schedule.record_success(podcast, schedule.published_timestamps(d.entries))
 
 
 @runtimeTypeCheck()
@@ -324,20 +757,56 @@ def url2audio_filename(url: str) -> str:
     return audio_filename
 
 
-def archive_entries(d: feedparser.FeedParserDict, session: requests.Session, podcast_audio_dir: Path,
-                    delete_episodes_not_in_feed: bool = False):
-    sha1ed_guids = set()
+def is_episode_entry(entry: dict) -> bool:
+    ''' the entry has an audio or video link '''
+    for link in entry.get('links', []):
+        if link.has_key('type') and ('audio' in link['type'] or 'video' in link['type']):
+            return True
+    return False
 
-    for entry in d.entries:
-        is_episode = False
-        for link in entry.get('links', []):
-            if link.has_key('type') and ('audio' in link['type'] or 'video' in link['type']):
-                is_episode = True
-                break
 
-        if not is_episode:
+@dataclasses.dataclass
+class EpisodeJob:
+    """ an episode of the feed to archive: its enclosure to download and its entry to save """
+    entry: dict
+    entry_json: str
+    entry_hash: str
+    guid: str
+    sha1ed_guid: str
+    url: str
+    length: int # -1: unknown
+    title: str
+    episode_dir: Path
+
+    @property
+    def filename(self) -> str:
+        return url2audio_filename(self.url)
+
+
+def iter_episode_jobs(d: 'feedparser.FeedParserDict', podcast_audio_dir: Path, sha1ed_guids: Set[str],
+                      incremental: bool = False) -> Iterator[EpisodeJob]:
+    ''' the episodes of a parsed feed, at most one enclosure per entry
+
+    sha1ed_guids: filled with the sha1ed guids of every episode in the feed (including the skipped ones)
+    incremental: skip the entries already archived with the same content,
+    without touching their episode directory
+    '''
+    archived_entries = get_catalog().archived_entries(podcast_audio_dir.name) if incremental else {}
+    unchanged_entries = 0
+
+    for entry in d.entries:
+        if not is_episode_entry(entry):
             continue
 
+        entry_json = entry_to_json(entry)
+        entry_hash = sha1(entry_json)
+        if archived_entries and isinstance(entry.get('id'), str) and entry.get('id'):
+            sha1ed_guid = sha1(entry['id'].encode('utf-8'))
+            if archived_entries.get(sha1ed_guid) == entry_hash:
+                sha1ed_guids.add(sha1ed_guid)
+                unchanged_entries += 1
+                continue
+
         print("\n=====================================")
         print(f'Title: "{entry.get("title")}"')
 
@@ -399,39 +868,65 @@ def archive_entries(d: feedparser.FeedParserDict, session: requests.Session, pod
             sha1ed_guid = sha1(guid.encode('utf-8'))
             sha1ed_guids.add(sha1ed_guid)
 
-            episode_dir = podcast_audio_dir / sha1ed_guid
-
-            download_episode(session, link.href, possible_size=length, guid=guid, # type: ignore
-                                episode_dir=episode_dir,
-                                filename=url2audio_filename(link.href), # type: ignore @runtimeTypeCheck
-                                title=title,
-            )
-            save_entry(entry, file_path=os.path.join(episode_dir, f'entry_guid_sha1_{sha1ed_guid}.json'))
+            yield EpisodeJob(entry=entry, entry_json=entry_json, entry_hash=entry_hash, guid=guid,
+                             sha1ed_guid=sha1ed_guid, url=link.href, length=length, title=title, # type: ignore
+                             episode_dir=podcast_audio_dir / sha1ed_guid)
             break # avoid downloading multiple audio files
 
-    if delete_episodes_not_in_feed:
-        # delete episodes not in feed
+    if unchanged_entries:
+        print(f'{unchanged_entries} archived entries unchanged, skipped')
 
-        if not podcast_audio_dir.exists():
-            return
 
-        local_episode_dirs = set(os.listdir(podcast_audio_dir))
+def save_episode_entry(job: EpisodeJob):
+    save_entry(job.entry, file_path=os.path.join(job.episode_dir, f'entry_guid_sha1_{job.sha1ed_guid}.json'),
+               entry_json=job.entry_json)
+    get_catalog().set_download_state(job.episode_dir.parent.name, job.sha1ed_guid, DOWNLOAD_STATE_DOWNLOADED,
+                                     entry_hash=job.entry_hash)
+
+
+def remove_episodes_not_in_feed(podcast_audio_dir: Path, sha1ed_guids: Set[str]):
+    if not podcast_audio_dir.exists():
+        return
 
-        logger.debug(f'local_episode_dirs: {local_episode_dirs}')
-        logger.debug(f'sha1ed_guids: {sha1ed_guids}')
+    local_episode_dirs = set(os.listdir(podcast_audio_dir))
 
-        episodes_not_in_feed_dirs = local_episode_dirs ^ sha1ed_guids
+    logger.debug(f'local_episode_dirs: {local_episode_dirs}')
+    logger.debug(f'sha1ed_guids: {sha1ed_guids}')
 
-        logger.debug(f'episodes_not_in_feed_dirs: {episodes_not_in_feed_dirs}')
+    episodes_not_in_feed_dirs = local_episode_dirs ^ sha1ed_guids
 
-        for dir in episodes_not_in_feed_dirs:
-            print(f'[red]Episode not in feed, deleting {dir}[/red]')
-            shutil.rmtree(os.path.join(podcast_audio_dir, dir))
+    logger.debug(f'episodes_not_in_feed_dirs: {episodes_not_in_feed_dirs}')
+
+    for dir in episodes_not_in_feed_dirs:
+        print(f'[red]Episode not in feed, deleting {dir}[/red]')
+        shutil.rmtree(os.path.join(podcast_audio_dir, dir))
+        get_catalog().delete_episode(podcast_audio_dir.name, dir)
+
+
+def archive_entries(d: 'feedparser.FeedParserDict', session: requests.Session, podcast_audio_dir: Path,
+                    delete_episodes_not_in_feed: bool = False, incremental: bool = False):
+    ''' incremental: see `iter_episode_jobs()` '''
+    sha1ed_guids: Set[str] = set()
+    for job in iter_episode_jobs(d, podcast_audio_dir, sha1ed_guids, incremental=incremental):
+        check_shutdown()
+        check_leases()
+        download_episode(session, job.url, possible_size=job.length, guid=job.guid,
+                         episode_dir=job.episode_dir,
+                         filename=job.filename,
+                         title=job.title,
+        )
+        save_episode_entry(job)
+
+    if delete_episodes_not_in_feed:
+        remove_episodes_not_in_feed(podcast_audio_dir, sha1ed_guids)
 
 
 def all_podcast_id(use_cache: bool=False)-> Set[str]:
     ''' return a set of all feed url sha1.
 
+    The ids come from the index filenames (`get_podcast_registry()`), see `validate_podcast_index()`
+    to check them against the `feed_url` of the JSONs.
+
     Note: URL ends with `/` will be `rstrip('/')` before hashing
     Note: `http://` URL will be treated as the same `https://` URL before hashing
     '''
@@ -440,38 +935,31 @@ def all_podcast_id(use_cache: bool=False)-> Set[str]:
             id_list = f.read().splitlines()
             return set(id_list)
 
-    podcast_id_set = set()
-    podcast_index_dirs = os.listdir(DATA_DIR / PODCAST_INDEX_DIR) if os.path.exists(DATA_DIR / PODCAST_INDEX_DIR) else []
-    for podcast_idnex_dir in podcast_index_dirs:
-        if podcast_idnex_dir.startswith(PODCAST_JSON_PREFIX):
-            podcast_id = podcast_idnex_dir[len(PODCAST_JSON_PREFIX):].split('_')[0]
-            podcast_json_file_path = DATA_DIR / PODCAST_INDEX_DIR / podcast_idnex_dir
-            with open(podcast_json_file_path, 'r', encoding='utf-8') as f:
-                podcast_json = json.load(f)
-            feed_url: str = podcast_json['feed_url']
-            assert podcast_guid_uuid5(feed_url) == podcast_id
-            podcast_id_set.add(podcast_id)
-    with open(DATA_DIR / PODCAST_INDEX_DIR / PODCAST_ID_CACHE, 'w', encoding='utf-8') as f:
-        # separators=(',\n', ': '))
-        f.write('\n'.join(podcast_id_set))
-        print(f'all_feed_url_sha1 cache refreshed/loaded: {len(podcast_id_set)}')
+    return get_podcast_registry().ids()
 
-    return podcast_id_set
 
+def validate_podcast_index() -> bool:
+    ''' check every index JSON against its filename, print the problems '''
+    problems = get_podcast_registry().validate()
+    for filename, problem in problems:
+        print(f'{filename}: {problem}')
+    print(f'{len(get_podcast_registry())} podcasts, {len(problems)} problems')
+    return not problems
 
 
 def add_podcast(session: requests.Session, feed_url: str):
     print(f'Adding podcast: {feed_url}')
-    if podcast_guid_uuid5(feed_url) in all_podcast_id():
+    registry = get_podcast_registry()
+    if podcast_guid_uuid5(feed_url) in registry:
         raise ValueError(f'Podcast already exists (guid: "{podcast_guid_uuid5(feed_url)}")\n')
 
     this_podcast = Podcast()
     this_podcast.create(init_feed_url=feed_url)
     print(f'Podcast id: {this_podcast.id}')
-    with FileLock(DATA_DIR / PODCAST_LOCK_DIR, this_podcast.id):
+    with resource_lock(DATA_DIR / PODCAST_LOCK_DIR, 'podcast', this_podcast.id):
         do_archive(this_podcast, session=session, delete_episodes_not_in_feed=True)
-    save_podcast_index_json(this_podcast)
-    all_podcast_id()
+    podcast_json_file_path = save_podcast_index_json(this_podcast)
+    registry.add(this_podcast.id, podcast_json_file_path.name)
 
 
 def get_args():
@@ -479,57 +967,339 @@ def get_args():
     parser = argparse.ArgumentParser()
     # parser.add_argument('--debug', action='store_true')
     parser.add_argument('-a','--add', nargs='+', help='RSS feed URL(s)', default=[])
+    parser.add_argument('-i', '--import', dest='import_files', nargs='+', type=Path, default=[], metavar='FILE',
+                        help='Register the feeds of OPML or newline-delimited file(s), '
+                             'their episodes are archived by --update (can be combined with it)')
+    parser.add_argument('--metadata-only', action='store_true',
+                        help='Fetch and parse the imported feeds that were never checked, without downloading audio (with --import)')
     parser.add_argument('-u','--update', action='store_true', help='Update podcasts')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running: refresh each podcast when it is due, pick up the new index JSONs '
+                             '(like --update, stop with Ctrl-C or SIGTERM)')
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL, metavar='SECONDS',
+                        help=f'Seconds between two scans of {PODCAST_INDEX_DIR} where inotify is not available '
+                             f'(with --daemon) [default: {DEFAULT_POLL_INTERVAL:.0f}]')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of podcasts to update in parallel (with --update) [default: 1, 16 with --async]')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='Update podcasts with the asyncio engine (needs aiohttp)')
+    parser.add_argument('--max-connections', type=int, default=64,
+                        help='Maximum number of connections (with --async) [default: 64]')
+    parser.add_argument('--max-connections-per-host', type=int, default=4,
+                        help='Maximum number of connections per host (with --async) [default: 4]')
+    parser.add_argument('--max-runtime', type=float, default=None, metavar='SECONDS',
+                        help="Don't start refreshing more podcasts after SECONDS (with --update or --daemon), "
+                             "the most overdue ones go first")
+    parser.add_argument('--full-refresh', action='store_true',
+                        help='Re-check every entry of the feeds (with --update), not only new or changed ones')
     parser.add_argument('--only', nargs='+', help='[dev] Only update these podcast ids', default=[])
+    parser.add_argument('--host-rate', type=float, default=DEFAULT_HOST_RATE,
+                        help=f'Maximum requests per second to the same host [default: {DEFAULT_HOST_RATE}]')
+    parser.add_argument('--host-burst', type=int, default=DEFAULT_HOST_BURST,
+                        help=f'Requests allowed in a row to the same host before --host-rate applies [default: {DEFAULT_HOST_BURST}]')
+    parser.add_argument('--lease-db', default=None, metavar='PATH',
+                        help='Shared SQLite lease table, to run several archiving nodes on the same pod_data '
+                             '(instead of local lock files)')
+    parser.add_argument('--lease-ttl', type=float, default=DEFAULT_LEASE_TTL,
+                        help=f'Seconds before the lease of a dead node expires (with --lease-db) [default: {DEFAULT_LEASE_TTL}]')
+    parser.add_argument('--metrics-port', type=int, default=None, metavar='PORT',
+                        help='Serve timing histograms and counters on http://127.0.0.1:PORT/metrics (Prometheus format)')
+    parser.add_argument('--metrics-json', default=None, metavar='PATH',
+                        help='Dump the metrics as JSON to PATH at exit')
     parser.add_argument("--insecure", action='store_true', help="Disable SSL certificate verification")
+    parser.add_argument('--rebuild-catalog', action='store_true',
+                        help=f'Rebuild the episode catalog ({CATALOG_FILE}) from {DATA_DIR}')
+    parser.add_argument('--dedupe', action='store_true',
+                        help=f'Hardlink the byte-identical episodes to the same blob ({DATA_DIR / BLOB_DIR}) '
+                             'and remove the unused blobs')
+    parser.add_argument('--validate-index', action='store_true',
+                        help=f'Check that the podcast ids of the {PODCAST_INDEX_DIR} filenames match their feed_url')
 
     args = parser.parse_args()
+    if args.daemon and (args.add or args.use_async or args.metadata_only):
+        parser.error('--daemon can not be used with RSS feed URL(s), --async or --metadata-only')
+    if args.poll_interval <= 0:
+        parser.error('--poll-interval must be > 0')
     if args.update and args.add:
         parser.error('--update can not be used with RSS feed URL(s)')
+    if args.metadata_only and not args.import_files:
+        parser.error('--metadata-only can only be used with --import')
+    if args.metadata_only and args.update:
+        parser.error('--metadata-only can not be used with --update')
+    if args.use_async and not args.update:
+        parser.error('--async can only be used with --update')
+    if args.workers is None:
+        args.workers = 16 if args.use_async else 1
+    if args.workers < 1:
+        parser.error('--workers must be >= 1')
+    if args.max_connections < 1 or args.max_connections_per_host < 1:
+        parser.error('--max-connections and --max-connections-per-host must be >= 1')
+    if args.lease_ttl <= 0:
+        parser.error('--lease-ttl must be > 0')
+    if args.max_runtime is not None and args.max_runtime <= 0:
+        parser.error('--max-runtime must be > 0')
+    if args.host_rate <= 0 or args.host_burst < 1:
+        parser.error('--host-rate must be > 0 and --host-burst >= 1')
     if args.only:
         raise NotImplementedError('--only')
     return args
 
-def get_podcast_json_file_paths():
-    for podcast_json_file_path in (DATA_DIR / PODCAST_INDEX_DIR).glob(f'{PODCAST_JSON_PREFIX}*.json'):
-        yield podcast_json_file_path
-
-def update_all(session: requests.Session):
+def make_session(insecure: bool = False) -> requests.Session:
+    session = create_session()
+    if insecure:
+        session.verify = False
+        requests.packages.urllib3.disable_warnings() # type: ignore
+    return session
+
+
+# update_podcast() results
+UPDATE_UPDATED = 'updated'
+UPDATE_SKIPPED = 'skipped' # not due yet
+UPDATE_DISABLED = 'disabled'
+UPDATE_LOCKED = 'locked' # another instance is archiving it
+UPDATE_FAILED = 'failed'
+UPDATE_DEFERRED = 'deferred' # due, but out of --max-runtime or interrupted by a shutdown
+
+# a missing episode weighs as much as being late by BACKLOG_EPISODE_WEIGHT seconds
+BACKLOG_EPISODE_WEIGHT = 60 * 60
+
+
+def update_priority(is_new: bool, lateness: float, backlog: int) -> Tuple[int, float]:
+    ''' sort key of a due podcast, smallest first: new feeds (never archived), then by lateness + missing episodes '''
+    return (0 if is_new else 1, -(lateness + backlog * BACKLOG_EPISODE_WEIGHT))
+
+
+@dataclasses.dataclass
+class UpdateStats:
+    """ Thread-safe counters of an update run. """
+    start_time: float = dataclasses.field(default_factory=time.time)
+    results: Dict[str, int] = dataclasses.field(default_factory=dict)
+    failures: List[Tuple[str, str]] = dataclasses.field(default_factory=list) # [(podcast_json_filename, error), ...]
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+
+    def record(self, name: str, result: str, error: Optional[BaseException] = None):
+        with self._lock:
+            self.results[result] = self.results.get(result, 0) + 1
+            if error is not None:
+                self.failures.append((name, f'{type(error).__name__}: {error}'))
+
+    def summary(self) -> str:
+        elapsed = time.time() - self.start_time
+        total = sum(self.results.values())
+        updated = self.results.get(UPDATE_UPDATED, 0)
+        lines = [
+            f'Checked {total} podcast(s) in {elapsed:.1f}s '
+            f'({total / elapsed * 60 if elapsed > 0 else 0:.2f} podcasts/min, '
+            f'{updated / elapsed * 60 if elapsed > 0 else 0:.2f} updated/min)',
+            ', '.join(f'{result}: {count}' for result, count in sorted(self.results.items())),
+        ]
+        for name, error in self.failures:
+            lines.append(f'[red]failed[/red] {name}: {error}')
+        return '\n'.join(lines)
+
+
+def check_podcast_due(podcast: Podcast) -> Optional[str]:
+    """ None if the podcast should be refreshed now, otherwise why not (UPDATE_DISABLED, UPDATE_SKIPPED) """
+    if podcast.enabled is False:
+        print(f'Podcast {podcast.id}: {podcast.title} is disabled')
+        return UPDATE_DISABLED
+    if not schedule.is_due(podcast):
+        print(f'Podcast {podcast.id}: {podcast.title} not need to update')
+        return UPDATE_SKIPPED
+    return None
+
+
+@dataclasses.dataclass
+class QueuedPodcast:
+    """ a due podcast of the update queue, loaded once by `build_update_queue()` """
+    path: Path
+    podcast: Podcast
+    json_stat: Optional[Tuple[int, int]] # of the JSON when loaded, see `update_podcast()`
+
+
+def load_podcast_if_changed(podcast_json_file_path: Path, json_stat: Optional[Tuple[int, int]]) -> Optional[Podcast]:
+    ''' the podcast loaded again if its JSON changed since `json_stat` (saved by another instance), otherwise None '''
+    if file_stat(podcast_json_file_path) == json_stat:
+        return None
+    podcast = Podcast()
+    podcast.load(podcast_json_file_path)
+    return podcast
+
+
+def build_update_queue(stats: UpdateStats, now: Optional[float] = None) -> List[Tuple[Tuple[int, float, str], QueuedPodcast]]:
+    """ heap (heapq) of the due podcasts, most valuable first: new feeds (never archived),
+    then by lateness + missing episodes. Not due and disabled podcasts are recorded in `stats`.
+    """
+    if now is None:
+        now = time.time()
+    downloaded = get_catalog().downloaded_counts()
+    queue: List[Tuple[Tuple[int, float, str], QueuedPodcast]] = []
     for podcast_json_file_path in get_podcast_json_file_paths():
-        this_podcast = Podcast()
-        this_podcast.load(podcast_json_file_path)
-        assert this_podcast.id
-
-        if this_podcast.enabled is False:
-            print(f'Podcast {this_podcast.id}: {this_podcast.title} is disabled')
+        podcast = Podcast()
+        json_stat = file_stat(podcast_json_file_path) # before loading: a later write is seen as a change
+        try:
+            podcast.load(podcast_json_file_path)
+        except Exception as e: # broken index JSON, etc.
+            stats.record(podcast_json_file_path.name, UPDATE_FAILED, e)
             continue
-        if (time.time() - this_podcast.saveweb['last_success_timestamp']) < REFRESH_INTERVAL:
-            print(f'Podcast {this_podcast.id}: {this_podcast.title} not need to update')
+        not_due = check_podcast_due(podcast)
+        if not_due is not None:
+            stats.record(podcast_json_file_path.name, not_due)
             continue
+        is_new = not podcast.saveweb.get('last_success_timestamp')
+        backlog = max(0, (podcast.saveweb.get('feed_episode_count') or 0) - downloaded.get(podcast.id, 0))
+        priority = update_priority(is_new, schedule.lateness(podcast, now=now), backlog)
+        heapq.heappush(queue, ((*priority, podcast_json_file_path.name),
+                               QueuedPodcast(podcast_json_file_path, podcast, json_stat)))
+    print(f'{len(queue)} podcast(s) due')
+    return queue
+
+
+def iter_update_queue(stats: UpdateStats, max_runtime: Optional[float] = None) -> Iterator[QueuedPodcast]:
+    """ the due podcasts in priority order, until `max_runtime` seconds after the start of the run,
+    the remaining ones are recorded as UPDATE_DEFERRED """
+    queue = build_update_queue(stats)
+    deadline = stats.start_time + max_runtime if max_runtime else None
+    while queue:
+        if deadline is not None and time.time() >= deadline:
+            print(f'[yellow]--max-runtime reached, {len(queue)} due podcast(s) deferred to the next run[/yellow]')
+            for _, queued in queue:
+                stats.record(queued.path.name, UPDATE_DEFERRED)
+            return
+        yield heapq.heappop(queue)[1]
 
-        print(f'Podcast {this_podcast.id}: {this_podcast.title} updating...')
-        try:
-            with FileLock(DATA_DIR / PODCAST_LOCK_DIR, this_podcast.id):
-                do_archive(this_podcast, session=session)
-        except AlreadyRunningError:
-            print("Another instance is archiving this podcast, skip.")
-            continue
-        save_podcast_index_json(this_podcast, podcast_json_file_path=Path(podcast_json_file_path))
+
+def update_podcast(podcast_json_file_path: Path, session: requests.Session,
+                   incremental: bool = True, podcast: Optional[Podcast] = None,
+                   json_stat: Optional[Tuple[int, int]] = None) -> Tuple[str, Optional[Exception]]:
+    """ Refresh a single podcast, returns (UPDATE_*, exception if failed)
+
+    podcast, json_stat: the podcast already loaded and found due (see `QueuedPodcast`),
+    only loaded and checked again, under the lock, if its JSON changed since
+    """
+    this_podcast = podcast
+    if this_podcast is None:
+        this_podcast = Podcast()
+        this_podcast.load(podcast_json_file_path)
+        not_due = check_podcast_due(this_podcast)
+        if not_due is not None:
+            return not_due, None
+    assert this_podcast.id
+
+    print(f'Podcast {this_podcast.id}: {this_podcast.title} updating...')
+    error = None
+    try:
+        with resource_lock(DATA_DIR / PODCAST_LOCK_DIR, 'podcast', this_podcast.id):
+            if podcast is not None:
+                try:
+                    changed = load_podcast_if_changed(podcast_json_file_path, json_stat)
+                except Exception as e: # broken index JSON, don't overwrite it
+                    return UPDATE_FAILED, e
+                if changed is not None:
+                    this_podcast = changed
+                    not_due = check_podcast_due(this_podcast)
+                    if not_due is not None:
+                        return not_due, None
+            do_archive(this_podcast, session=session, incremental=incremental)
+    except AlreadyRunningError:
+        print("Another instance is archiving this podcast, skip.")
+        return UPDATE_LOCKED, None
+    except LeaseLostError as e:
+        # another node is archiving it now, leave its index JSON alone
+        print(f'[red]Podcast {this_podcast.id}: {this_podcast.title} failed: {e}[/red]')
+        return UPDATE_FAILED, e
+    except ArchiveInterrupted:
+        # not a failure: still due, picked up by the next run
+        print(f'[yellow]Podcast {this_podcast.id}: {this_podcast.title} interrupted[/yellow]')
+        return UPDATE_DEFERRED, None
+    except Exception as e:
+        print(f'[red]Podcast {this_podcast.id}: {this_podcast.title} failed: {e}[/red]')
+        this_podcast.update_failed()
+        schedule.record_failure(this_podcast)
+        error = e
+    save_podcast_index_json(this_podcast, podcast_json_file_path=Path(podcast_json_file_path))
+
+    return (UPDATE_FAILED, error) if error is not None else (UPDATE_UPDATED, None)
+
+
+def update_all(session: requests.Session, workers: int = 1,
+               session_factory: Optional[Callable[[], requests.Session]] = None,
+               incremental: bool = True, max_runtime: Optional[float] = None):
+    """ workers: number of podcasts refreshed in parallel, each worker thread
+    uses its own session created by `session_factory`
+    incremental: only archive new or changed entries (see `archive_entries()`)
+    max_runtime: don't start refreshing podcasts after `max_runtime` seconds (see `iter_update_queue()`)
+    """
+    stats = UpdateStats()
+
+    if workers <= 1:
+        for queued in iter_update_queue(stats, max_runtime=max_runtime):
+            result, error = update_podcast(queued.path, session=session, incremental=incremental,
+                                           podcast=queued.podcast, json_stat=queued.json_stat)
+            stats.record(queued.path.name, result, error)
+        print(stats.summary())
+        return stats
+
+    if session_factory is None:
+        session_factory = create_session
+    local = threading.local()
+
+    def worker(queued: QueuedPodcast):
+        # requests.Session is not thread-safe, one session per worker thread
+        if getattr(local, 'session', None) is None:
+            local.session = session_factory()
+        return update_podcast(queued.path, session=local.session, incremental=incremental,
+                              podcast=queued.podcast, json_stat=queued.json_stat)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='update') as executor:
+        running: Dict[Future, Path] = {}
+
+        def collect(done: Set[Future]):
+            for future in done:
+                podcast_json_file_path = running.pop(future)
+                try:
+                    result, error = future.result()
+                except Exception as e: # broken index JSON, etc.
+                    result, error = UPDATE_FAILED, e
+                stats.record(podcast_json_file_path.name, result, error)
+
+        for queued in iter_update_queue(stats, max_runtime=max_runtime):
+            # keep the queue bounded, don't glob the whole index into the executor
+            if len(running) >= workers * 2:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                collect(done)
+            running[executor.submit(worker, queued)] = queued.path
+        collect(wait(running).done)
+
+    print(stats.summary())
+    return stats
 
 
 def main():
-    session = create_session()
     args = get_args()
+    configure_rate_limiter(rate=args.host_rate, burst=args.host_burst)
+    configure_lease_coordinator(args.lease_db, ttl=args.lease_ttl)
+    metrics.configure_metrics(port=args.metrics_port, json_path=args.metrics_json)
+    session = make_session(insecure=args.insecure)
 
     (DATA_DIR / PODCAST_INDEX_DIR).mkdir(parents=True, exist_ok=True)
     (DATA_DIR / PODCAST_LOCK_DIR).mkdir(parents=True, exist_ok=True)
     (DATA_DIR / PODCAST_AUDIO_DIR).mkdir(parents=True, exist_ok=True)
 
     if args.insecure:
-        session.verify = False
-        requests.packages.urllib3.disable_warnings() # type: ignore
         logger.warning("SSL certificate verification disabled")
 
+    if args.rebuild_catalog:
+        rebuild_catalog()
+
+    if args.dedupe:
+        dedupe_episodes()
+
+    if args.validate_index and not validate_podcast_index():
+        raise SystemExit(1)
+
     for feed_url in args.add:
         try:
             add_podcast(session, feed_url)
@@ -539,9 +1309,31 @@ def main():
             else:
                 raise e
 
-    if args.update:
-        update_all(session=session)
+    if args.import_files:
+        from preserve_podcasts.importer import import_feeds
+        import_feeds(args.import_files, session_factory=lambda: make_session(insecure=args.insecure),
+                     metadata_only=args.metadata_only, workers=args.workers)
+
+    if args.daemon:
+        from preserve_podcasts.daemon import run_daemon
+        run_daemon(workers=args.workers, session_factory=lambda: make_session(insecure=args.insecure),
+                   incremental=not args.full_refresh, poll_interval=args.poll_interval,
+                   max_runtime=args.max_runtime)
+    elif args.update and args.use_async:
+        import asyncio
+        try:
+            from preserve_podcasts.async_engine import update_all_async
+        except ImportError as e:
+            raise SystemExit(f'--async needs aiohttp ({e}), install it with `pip install aiohttp`')
+        asyncio.run(update_all_async(workers=args.workers, max_connections=args.max_connections,
+                                     max_connections_per_host=args.max_connections_per_host,
+                                     insecure=args.insecure, incremental=not args.full_refresh,
+                                     max_runtime=args.max_runtime))
+    elif args.update:
+        update_all(session=session, workers=args.workers,
+                   session_factory=lambda: make_session(insecure=args.insecure),
+                   incremental=not args.full_refresh, max_runtime=args.max_runtime)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,106 @@
+import json
+import os
+from pathlib import Path
+import tempfile
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+from preserve_podcasts.utils.util import podcast_guid_uuid5
+
+
+class PodcastRegistry:
+    """ ids of the archived podcasts, from the `<prefix><id>_<title>.json` filenames of the index.
+
+    Listing the index directory is enough, the JSONs are only opened by `validate()`.
+    Load it once per process and `add()` the new podcasts.
+    """
+    def __init__(self, index_dir: Path, json_prefix: str, cache_filename: str):
+        self.index_dir = Path(index_dir)
+        self.json_prefix = json_prefix
+        self.cache_filename = cache_filename
+        self._filenames: Dict[str, str] = {} # {podcast_id: index JSON filename}
+        self._lock = threading.Lock()
+
+    def podcast_id_of(self, filename: str) -> Optional[str]:
+        if not (filename.startswith(self.json_prefix) and filename.endswith('.json')):
+            return None
+        return filename[len(self.json_prefix):].split('_')[0] or None
+
+    def _index_filenames(self) -> List[str]:
+        if not self.index_dir.is_dir():
+            return []
+        with os.scandir(self.index_dir) as entries:
+            return [entry.name for entry in entries if self.podcast_id_of(entry.name) is not None]
+
+    def load(self) -> 'PodcastRegistry':
+        filenames = {}
+        for filename in self._index_filenames():
+            filenames[self.podcast_id_of(filename)] = filename
+        with self._lock:
+            self._filenames = filenames
+        self.write_cache()
+        return self
+
+    def __contains__(self, podcast_id: str) -> bool:
+        with self._lock:
+            return podcast_id in self._filenames
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._filenames)
+
+    def ids(self) -> Set[str]:
+        with self._lock:
+            return set(self._filenames)
+
+    def path_of(self, podcast_id: str) -> Optional[Path]:
+        with self._lock:
+            filename = self._filenames.get(podcast_id)
+        return self.index_dir / filename if filename is not None else None
+
+    def add(self, podcast_id: str, filename: str):
+        with self._lock:
+            self._filenames[podcast_id] = filename
+        self.write_cache()
+
+    def write_cache(self):
+        ''' the ids, one per line, replaced atomically (readers never see a partial file) '''
+        if not self.index_dir.is_dir():
+            return
+        with self._lock:
+            data = '\n'.join(sorted(self._filenames))
+        fd, tmp_path = tempfile.mkstemp(dir=self.index_dir, prefix=f'.{self.cache_filename}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, self.index_dir / self.cache_filename)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def validate(self) -> List[Tuple[str, str]]:
+        ''' [(filename, problem), ...] of the index JSONs whose filename does not match their feed_url '''
+        problems = []
+        seen: Dict[str, str] = {}
+        for filename in sorted(self._index_filenames()):
+            podcast_id = self.podcast_id_of(filename)
+            assert podcast_id is not None
+            if podcast_id in seen:
+                problems.append((filename, f'duplicate id, also in {seen[podcast_id]}'))
+            seen[podcast_id] = filename
+            try:
+                with open(self.index_dir / filename, 'r', encoding='utf-8') as f:
+                    podcast_json = json.load(f)
+            except (OSError, ValueError) as e:
+                problems.append((filename, f'unreadable: {e}'))
+                continue
+            feed_url = podcast_json.get('feed_url')
+            if not isinstance(feed_url, str) or not feed_url:
+                problems.append((filename, 'no feed_url'))
+                continue
+            if podcast_guid_uuid5(feed_url) != podcast_id:
+                problems.append((filename, f'id does not match feed_url {feed_url} ({podcast_guid_uuid5(feed_url)})'))
+            if podcast_json.get('id') != podcast_id:
+                problems.append((filename, f'id field {podcast_json.get("id")} does not match the filename'))
+        return problems
+
@@ -0,0 +1,119 @@
+""" Per-podcast refresh schedule, from the publish cadence of the feed.
+
+A daily show is checked a few times a day, a feed dormant since 2015 once a week,
+a failing feed less and less often. The schedule is kept in the `saveweb` block
+of the podcast index JSON (`next_check_timestamp`, `refresh_interval`, `consecutive_failures`).
+"""
+import calendar
+import statistics
+import time
+from typing import Iterable, List, Optional, Tuple
+
+from preserve_podcasts.podcast import Podcast
+
+
+DEFAULT_REFRESH_INTERVAL = 60 * 60 * 24 # 24 hours, not enough history to guess
+MIN_REFRESH_INTERVAL = 60 * 60 # 1 hour
+MAX_REFRESH_INTERVAL = 60 * 60 * 24 * 7 # 7 days
+CADENCE_SAMPLES = 10 # number of recent gaps between episodes used
+LATE_FACTOR = 3 # no episode for LATE_FACTOR gaps: the feed is late or dormant, back off
+NEXT_EPISODE_GRACE = 60 * 15 # check a bit after the next expected episode
+
+FAILURE_BACKOFF_BASE = 60 * 60 # 1 hour
+FAILURE_BACKOFF_MAX = 60 * 60 * 24 * 7 # 7 days
+
+
+def published_timestamps(entries: Iterable[dict]) -> List[float]:
+    ''' UNIX timestamps of the `published_parsed` (or `updated_parsed`) of feedparser entries '''
+    timestamps = []
+    for entry in entries:
+        parsed = entry.get('published_parsed') or entry.get('updated_parsed')
+        if not parsed:
+            continue
+        try:
+            timestamps.append(float(calendar.timegm(tuple(parsed)))) # feedparser's *_parsed are UTC
+        except (TypeError, ValueError, OverflowError):
+            continue
+    return timestamps
+
+
+def _clamp(interval: float) -> int:
+    return int(min(max(interval, MIN_REFRESH_INTERVAL), MAX_REFRESH_INTERVAL))
+
+
+def estimate_schedule(timestamps: List[float], now: Optional[float] = None) -> Tuple[int, int]:
+    ''' (refresh_interval, next_check_timestamp) for a feed that published at `timestamps`
+
+    Checks about twice per median gap between the recent episodes, right after the next
+    expected episode if it comes sooner, and backs off when the feed is late (dormant).
+    '''
+    if now is None:
+        now = time.time()
+    published = sorted(t for t in timestamps if t <= now + MIN_REFRESH_INTERVAL) # ignore scheduled episodes
+    gaps = [b - a for a, b in zip(published, published[1:]) if b > a][-CADENCE_SAMPLES:]
+    if not gaps:
+        return DEFAULT_REFRESH_INTERVAL, int(now + DEFAULT_REFRESH_INTERVAL)
+
+    cadence = statistics.median(gaps)
+    since_last = now - published[-1]
+    if since_last > cadence * LATE_FACTOR:
+        interval = _clamp(since_last / 4)
+    else:
+        interval = _clamp(cadence / 2)
+
+    next_check = now + interval
+    next_expected = published[-1] + cadence + NEXT_EPISODE_GRACE
+    if now < next_expected < next_check:
+        next_check = max(next_expected, now + MIN_REFRESH_INTERVAL)
+    return interval, int(next_check)
+
+
+def record_success(podcast: Podcast, timestamps: Optional[List[float]] = None, now: Optional[float] = None):
+    ''' schedule the next check after a successful refresh
+
+    timestamps: publish times of the feed entries, None if the feed was not modified (304)
+    '''
+    if now is None:
+        now = time.time()
+    saveweb = podcast.saveweb
+    saveweb['consecutive_failures'] = 0
+    if timestamps is None:
+        interval = saveweb.get('refresh_interval') or DEFAULT_REFRESH_INTERVAL
+        saveweb['next_check_timestamp'] = int(now + interval)
+        return
+    interval, next_check = estimate_schedule(timestamps, now=now)
+    saveweb['refresh_interval'] = interval
+    saveweb['next_check_timestamp'] = next_check
+
+
+def record_failure(podcast: Podcast, now: Optional[float] = None):
+    ''' exponential backoff of a failing feed '''
+    if now is None:
+        now = time.time()
+    saveweb = podcast.saveweb
+    failures = (saveweb.get('consecutive_failures') or 0) + 1
+    saveweb['consecutive_failures'] = failures
+    backoff = min(FAILURE_BACKOFF_BASE * 2 ** (failures - 1), FAILURE_BACKOFF_MAX)
+    saveweb['next_check_timestamp'] = int(now + backoff)
+
+
+def next_check_timestamp(podcast: Podcast) -> float:
+    ''' when the podcast is due
+
+    podcasts never scheduled are due once a day (the old fixed REFRESH_INTERVAL)
+    '''
+    next_check = podcast.saveweb.get('next_check_timestamp') or 0
+    if not next_check:
+        next_check = (podcast.saveweb.get('last_success_timestamp') or 0) + DEFAULT_REFRESH_INTERVAL
+    return next_check
+
+
+def lateness(podcast: Podcast, now: Optional[float] = None) -> float:
+    ''' seconds since the podcast is due, negative if not due yet '''
+    if now is None:
+        now = time.time()
+    return now - next_check_timestamp(podcast)
+
+
+def is_due(podcast: Podcast, now: Optional[float] = None) -> bool:
+    return lateness(podcast, now=now) >= 0
@@ -0,0 +1,282 @@
+""" `podcastsStats`: what `pod_data/` holds and costs, per podcast and in total.
+
+Reads the catalog (`pod_data/catalog.sqlite3`) when it knows every episode, otherwise
+(or with `--scan`) walks the tree with `os.scandir`: episode sizes come from the
+directory entries, only the podcast index JSONs are parsed.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import dataclasses
+import json
+import os
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+from rich.console import Console
+from rich.table import Table
+
+from preserve_podcasts.catalog import get_catalog
+from preserve_podcasts.layout import (
+    CATALOG_FILE, DATA_DIR, PODCAST_AUDIO_DIR, PODCAST_INDEX_DIR, PODCAST_JSON_PREFIX, SPAM_MARK, UPLOADED_MARK,
+)
+from preserve_podcasts.podcast import Podcast
+
+
+REPEATED_FAILURES = 3 # consecutive failed refreshes before a feed is reported as failing
+DEFAULT_TOP = 30 # podcasts in the table
+DEFAULT_SCAN_WORKERS = 16
+
+METADATA_SUFFIX = '.metadata.json'
+ENTRY_PREFIX = 'entry_guid_sha1_'
+
+
+@dataclasses.dataclass
+class PodcastStats:
+    id: str
+    title: Optional[str] = None
+    feed_url: Optional[str] = None
+    enabled: bool = True
+    last_checked_status: Optional[str] = None
+    last_success_timestamp: int = 0
+    consecutive_failures: int = 0
+    episodes: int = 0 # downloaded
+    bytes: int = 0
+    to_upload: int = 0
+    uploaded: int = 0
+    download_bytes: int = 0
+    download_seconds: float = 0.0
+
+    @property
+    def download_speed(self) -> Optional[float]:
+        ''' bytes/s of the timed downloads '''
+        return self.download_bytes / self.download_seconds if self.download_seconds > 0 else None
+
+
+@dataclasses.dataclass
+class GlobalStats:
+    source: str # 'catalog' or 'scan'
+    podcasts: int = 0
+    enabled_podcasts: int = 0
+    episodes: int = 0
+    bytes: int = 0
+    unique_bytes: int = 0 # byte-identical episodes (hardlinks, same sha1) counted once
+    to_upload: int = 0
+    uploaded: int = 0
+    download_bytes: int = 0
+    download_seconds: float = 0.0
+    failing_podcasts: int = 0
+    elapsed: float = 0.0 # seconds to collect the stats
+
+    @property
+    def download_speed(self) -> Optional[float]:
+        return self.download_bytes / self.download_seconds if self.download_seconds > 0 else None
+
+
+def podcast_stats_from_podcast(podcast: Podcast) -> PodcastStats:
+    return PodcastStats(
+        id=podcast.id, title=podcast.title, feed_url=podcast.feed_url, enabled=podcast.enabled is not False,
+        last_checked_status=podcast.saveweb.get('last_checked_status'),
+        last_success_timestamp=podcast.saveweb.get('last_success_timestamp') or 0,
+        consecutive_failures=podcast.saveweb.get('consecutive_failures') or 0,
+    )
+
+
+def collect_from_catalog() -> Tuple[Dict[str, PodcastStats], GlobalStats]:
+    catalog = get_catalog()
+    podcasts: Dict[str, PodcastStats] = {}
+    for row in catalog.podcasts():
+        podcasts[row['id']] = PodcastStats(
+            id=row['id'], title=row['title'], feed_url=row['feed_url'], enabled=bool(row['enabled']),
+            last_checked_status=row['last_checked_status'],
+            last_success_timestamp=row['last_success_timestamp'] or 0,
+            consecutive_failures=row['consecutive_failures'] or 0,
+        )
+    for row in catalog.episode_stats():
+        stats = podcasts.setdefault(row['podcast_id'], PodcastStats(id=row['podcast_id']))
+        stats.episodes, stats.bytes = row['episodes'], row['bytes']
+        stats.to_upload, stats.uploaded = row['to_upload'], row['uploaded']
+        stats.download_bytes, stats.download_seconds = row['download_bytes'], row['download_seconds']
+    totals = GlobalStats(source='catalog', unique_bytes=catalog.unique_bytes())
+    return podcasts, totals
+
+
+def load_index_json(path: str) -> Optional[PodcastStats]:
+    podcast = Podcast()
+    try:
+        podcast.load(path)
+    except (OSError, ValueError):
+        return None
+    return podcast_stats_from_podcast(podcast) if podcast.id else None
+
+
+def scan_podcast_audio_dir(path: str, upload_marks: Tuple[str, str]) -> Tuple[int, int, int, int, Dict[Tuple[int, int], int]]:
+    ''' (downloaded episodes, bytes, to upload, uploaded, {(st_dev, st_ino): size} of the audio files) '''
+    uploaded_mark, spam_mark = upload_marks
+    episodes, total, to_upload, uploaded = 0, 0, 0, 0
+    inodes: Dict[Tuple[int, int], int] = {}
+    with os.scandir(path) as podcast_entries:
+        for episode_entry in podcast_entries:
+            if not episode_entry.is_dir(follow_symlinks=False):
+                continue
+            with os.scandir(episode_entry.path) as it:
+                files = {entry.name: entry for entry in it}
+            audio = None
+            for name in files:
+                if name.endswith(METADATA_SUFFIX):
+                    audio = files.get(name[:-len(METADATA_SUFFIX)])
+                    break
+            if audio is None or f'{ENTRY_PREFIX}{episode_entry.name}.json' not in files:
+                continue # not (completely) downloaded
+            st = audio.stat()
+            episodes += 1
+            total += st.st_size
+            inodes[(st.st_dev, st.st_ino)] = st.st_size
+            if uploaded_mark in files:
+                uploaded += 1
+            elif spam_mark not in files:
+                to_upload += 1
+    return episodes, total, to_upload, uploaded, inodes
+
+
+def collect_from_disk(workers: int = DEFAULT_SCAN_WORKERS) -> Tuple[Dict[str, PodcastStats], GlobalStats]:
+    index_dir = DATA_DIR / PODCAST_INDEX_DIR
+    audio_dir = DATA_DIR / PODCAST_AUDIO_DIR
+    index_paths, audio_paths = [], []
+    if index_dir.is_dir():
+        with os.scandir(index_dir) as it:
+            index_paths = [entry.path for entry in it
+                           if entry.name.startswith(PODCAST_JSON_PREFIX) and entry.name.endswith('.json')]
+    if audio_dir.is_dir():
+        with os.scandir(audio_dir) as it:
+            audio_paths = [entry.path for entry in it if entry.is_dir(follow_symlinks=False)]
+
+    podcasts: Dict[str, PodcastStats] = {}
+    inodes: Dict[Tuple[int, int], int] = {} # hardlinks (blob store) counted once
+    # stat() and small reads release the GIL, threads help on network filesystems
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='stats') as executor:
+        for stats in executor.map(load_index_json, index_paths):
+            if stats is not None:
+                podcasts[stats.id] = stats
+        scans = executor.map(scan_podcast_audio_dir, audio_paths, [(UPLOADED_MARK, SPAM_MARK)] * len(audio_paths))
+        for path, (episodes, total, to_upload, uploaded, podcast_inodes) in zip(audio_paths, scans):
+            podcast_id = os.path.basename(path)
+            stats = podcasts.setdefault(podcast_id, PodcastStats(id=podcast_id))
+            stats.episodes, stats.bytes, stats.to_upload, stats.uploaded = episodes, total, to_upload, uploaded
+            inodes.update(podcast_inodes)
+    return podcasts, GlobalStats(source='scan', unique_bytes=sum(inodes.values()))
+
+
+def collect(scan: bool = False, workers: int = DEFAULT_SCAN_WORKERS) -> Tuple[List[PodcastStats], GlobalStats]:
+    ''' per-podcast stats (biggest first) and the totals '''
+    start = time.monotonic()
+    use_catalog = not scan and (DATA_DIR / CATALOG_FILE).exists() and get_catalog().is_complete()
+    podcasts, totals = collect_from_catalog() if use_catalog else collect_from_disk(workers=workers)
+    for stats in podcasts.values():
+        totals.podcasts += 1
+        totals.enabled_podcasts += stats.enabled
+        totals.episodes += stats.episodes
+        totals.bytes += stats.bytes
+        totals.to_upload += stats.to_upload
+        totals.uploaded += stats.uploaded
+        totals.download_bytes += stats.download_bytes
+        totals.download_seconds += stats.download_seconds
+        totals.failing_podcasts += stats.consecutive_failures >= REPEATED_FAILURES
+    totals.elapsed = time.monotonic() - start
+    return sorted(podcasts.values(), key=lambda s: (-s.bytes, s.id)), totals
+
+
+def human_size(n: float) -> str:
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if abs(n) < 1024 or unit == 'TiB':
+            return f'{n:.0f} {unit}' if unit == 'B' else f'{n:.1f} {unit}'
+        n /= 1024
+    raise AssertionError
+
+
+def human_speed(bytes_per_second: Optional[float]) -> str:
+    return f'{human_size(bytes_per_second)}/s' if bytes_per_second is not None else '-'
+
+
+def to_json(podcasts: List[PodcastStats], totals: GlobalStats) -> str:
+    def with_speed(stats) -> dict:
+        return {**dataclasses.asdict(stats), 'download_speed': stats.download_speed}
+    return json.dumps({
+        'global': with_speed(totals),
+        'podcasts': [with_speed(stats) for stats in podcasts],
+    }, indent=2, ensure_ascii=False)
+
+
+def print_tables(podcasts: List[PodcastStats], totals: GlobalStats, top: int = DEFAULT_TOP):
+    console = Console()
+
+    table = Table(title=f'Top {min(top, len(podcasts))} of {len(podcasts)} podcasts by size')
+    for column in ('podcast', 'title', 'episodes', 'size', 'to upload', 'uploaded', 'speed', 'status'):
+        if column == 'title':
+            table.add_column(column, overflow='ellipsis', min_width=12, max_width=40)
+        else:
+            table.add_column(column, justify='left' if column in ('podcast', 'status') else 'right', no_wrap=True)
+    for stats in podcasts[:top]:
+        status = stats.last_checked_status or '-'
+        if stats.consecutive_failures:
+            status += f' ({stats.consecutive_failures}x)'
+        if not stats.enabled:
+            status += ' disabled'
+        table.add_row(stats.id[:8], (stats.title or '')[:40], str(stats.episodes), human_size(stats.bytes),
+                      str(stats.to_upload), str(stats.uploaded), human_speed(stats.download_speed), status)
+    console.print(table)
+
+    failing = sorted((stats for stats in podcasts if stats.consecutive_failures >= REPEATED_FAILURES),
+                     key=lambda s: -s.consecutive_failures)
+    if failing:
+        table = Table(title=f'{len(failing)} feeds failing for {REPEATED_FAILURES}+ refreshes')
+        for column in ('podcast', 'failures', 'last success', 'feed url'):
+            table.add_column(column)
+        for stats in failing[:top]:
+            last_success = time.strftime('%Y-%m-%d', time.gmtime(stats.last_success_timestamp)) \
+                if stats.last_success_timestamp else 'never'
+            table.add_row(stats.id[:8], str(stats.consecutive_failures), last_success, stats.feed_url or '')
+        console.print(table)
+
+    table = Table(title=f'pod_data ({totals.source}, {totals.elapsed:.2f}s)', show_header=False)
+    table.add_column(justify='left')
+    table.add_column(justify='right')
+    table.add_row('podcasts (enabled)', f'{totals.podcasts} ({totals.enabled_podcasts})')
+    table.add_row('failing podcasts', str(totals.failing_podcasts))
+    table.add_row('downloaded episodes', str(totals.episodes))
+    table.add_row('size', human_size(totals.bytes))
+    table.add_row('size on disk (deduplicated)', human_size(totals.unique_bytes))
+    table.add_row('episodes to upload', str(totals.to_upload))
+    table.add_row('uploaded episodes', str(totals.uploaded))
+    table.add_row('average download speed', human_speed(totals.download_speed))
+    console.print(table)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=f'Storage and throughput report of {DATA_DIR}')
+    parser.add_argument('--json', action='store_true', help='Print the stats of every podcast as JSON')
+    parser.add_argument('--scan', action='store_true',
+                        help=f'Walk {DATA_DIR} instead of reading the catalog ({CATALOG_FILE})')
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP, help=f'Podcasts shown in the tables [default: {DEFAULT_TOP}]')
+    parser.add_argument('--workers', type=int, default=DEFAULT_SCAN_WORKERS,
+                        help=f'Threads scanning {DATA_DIR} (with --scan, or without a complete catalog) [default: {DEFAULT_SCAN_WORKERS}]')
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('--workers must be >= 1')
+    return args
+
+
+def main():
+    args = get_args()
+    if not DATA_DIR.is_dir():
+        print(f'{DATA_DIR} not found, run podcastsStats where podcastsPreserve runs', file=sys.stderr)
+        sys.exit(1)
+    podcasts, totals = collect(scan=args.scan, workers=args.workers)
+    if args.json:
+        print(to_json(podcasts, totals))
+    else:
+        print_tables(podcasts, totals, top=args.top)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,48 @@
+from __future__ import annotations # `list[Path]` on Python < 3.9, lazy internetarchive types
+
 import argparse
-from dataclasses import dataclass
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
 import datetime
 import io
 import json
 import logging
 import os
 from pathlib import Path
+import threading
 import time
-from typing import List, Optional, Tuple
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Set, Tuple
 from urllib.parse import urlparse
 
 import requests
 from rich import print
-from internetarchive import get_item, Item, get_session, ArchiveSession
 from preserve_podcasts.pod_sessiosn import PRESERVE_THOSE_POD_UA
-from preserve_podcasts.utils.fileLock import AlreadyRunningError, FileLock
+from preserve_podcasts.lease import DEFAULT_LEASE_TTL, LeaseLostError, configure_lease_coordinator, resource_lock
+from preserve_podcasts.utils import metrics
+from preserve_podcasts.utils.fileLock import AlreadyRunningError
 from preserve_podcasts.utils.requests_patch import SessionMonkeyPatch
 
 from preserve_podcasts.utils.util import podcast_guid_uuid5, sha1
 from preserve_podcasts.podcast import Podcast
-from preserve_podcasts.preservePodcasts import get_podcast_json_file_paths
-from preserve_podcasts.preservePodcasts import (
+from preserve_podcasts.catalog import UPLOAD_STATE_PENDING, UPLOAD_STATE_SPAM, UPLOAD_STATE_UPLOADED, get_catalog
+from preserve_podcasts.layout import (
     DATA_DIR, PODCAST_INDEX_DIR, PODCAST_AUDIO_DIR, PODCAST_JSON_PREFIX,
-    PODCAST_ID_CACHE, TITLE_MARK_PREFIX, MARKS_SUFFIX,
+    PODCAST_ID_CACHE, TITLE_MARK_PREFIX, MARKS_SUFFIX, PART_SUFFIX, PART_META_SUFFIX,
+    EPISODE_LOCK_DIR, MARKS_PREFIX, PENDING_MARK, UPLOADED_MARK, SPAM_MARK, get_podcast_json_file_paths,
 )
 
-EPISODE_LOCK_DIR = "episode_lock/"
-MARKS_PREFIX = "_"
-PENDING_MARK = "_pending.mark"
-UPLOADED_MARK = "_uploaded.mark"
-SPAM_MARK = "_spam.mark"
+if TYPE_CHECKING:
+    from internetarchive import ArchiveSession, Item # imported at first use, the heaviest dependency
+
+# upload_episode() result when the item is not created by IA yet
+PENDING_RESULT = "Still in queue, pending"
+
+PENDING_POLL_INTERVAL = 30 # seconds
+PENDING_POLL_MAX_INTERVAL = 60 * 10
+PENDING_POLL_BATCH_SIZE = 50
+PENDING_POLL_DIRECT_AFTER = 3 # polls, then also ask the metadata API (the search index may lag behind)
+
+SCRAPE_BATCH_SIZE = 100 # identifiers per scrape API query
 
 logger = logging.Logger(__name__)
 
@@ -55,6 +68,11 @@ class Args:
     no_wait: bool = False
     insecure: bool = False
     feed: Optional[str] = None
+    jobs: int = 1
+    lease_db: Optional[str] = None
+    lease_ttl: float = DEFAULT_LEASE_TTL
+    metrics_port: Optional[int] = None
+    metrics_json: Optional[str] = None
 
     def __post_init__(self):
         self.keys_file = Path(self.keys_file).expanduser().resolve()
@@ -70,28 +88,401 @@ def get_args():
     parser.add_argument("--dry-run", action="store_true", help="Dry run")
     parser.add_argument("--debug", action="store_true", help="Debug")
     parser.add_argument("--not-spam", action="store_true", help="Re-upload episodes marked as spam by IA previously")
-    parser.add_argument("--no-wait", action="store_true", help="Don't wait for item to be created") # upload full metadata initially
+    parser.add_argument("--no-wait", action="store_true", help="Don't wait for pending items to be created at the end of the run") # upload full metadata initially
     parser.add_argument("--insecure", action="store_true", help="Don't verify SSL certificate")
     parser.add_argument("--feed", help="Upload a specific podcast by uuid or feed_url")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of episodes to upload in parallel [default: 1]")
+    parser.add_argument("--lease-db", default=None, metavar="PATH",
+                        help="Shared SQLite lease table, to run several upload nodes on the same pod_data "
+                             "(instead of local lock files)")
+    parser.add_argument("--lease-ttl", type=float, default=DEFAULT_LEASE_TTL,
+                        help=f"Seconds before the lease of a dead node expires (with --lease-db) [default: {DEFAULT_LEASE_TTL}]")
+    parser.add_argument("--metrics-port", type=int, default=None, metavar="PORT",
+                        help="Serve timing histograms and counters on http://127.0.0.1:PORT/metrics (Prometheus format)")
+    parser.add_argument("--metrics-json", default=None, metavar="PATH", help="Dump the metrics as JSON to PATH at exit")
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be >= 1")
+    if args.lease_ttl <= 0:
+        parser.error("--lease-ttl must be > 0")
 
     return Args(**vars(args))
 
-def upload_podcasts(args: Args, session: ArchiveSession):
-    for podcast_json_file_path in get_podcast_json_file_paths():
-        this_podcast = Podcast()
-        this_podcast.load(podcast_json_file_path)
-        assert this_podcast.id
 
-        # if not this_podcast.enabled
-        #     continue
+@dataclass
+class UploadStats:
+    """ Thread-safe counters of an upload run. """
+    start_time: float = field(default_factory=time.time)
+    results: Dict[str, int] = field(default_factory=dict)
+    uploaded_bytes: int = 0
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+
+    def record(self, result: str):
+        with self._lock:
+            self.results[result] = self.results.get(result, 0) + 1
+
+    def add_bytes(self, n: int):
+        with self._lock:
+            self.uploaded_bytes += n
+
+    def summary(self) -> str:
+        elapsed = time.time() - self.start_time
+        mib = self.uploaded_bytes / 1024 / 1024
+        return '\n'.join([
+            f'Uploaded {mib:.2f} MiB in {elapsed:.1f}s ({mib / elapsed if elapsed > 0 else 0:.2f} MiB/s)',
+            ', '.join(f'{result}: {count}' for result, count in sorted(self.results.items())),
+        ])
+
+
+class GlobalBackoff:
+    """ Shared by all upload workers: once IA says 503/SlowDown, nobody starts a new upload for a while. """
+    def __init__(self, base_delay: float = 60, max_delay: float = 60 * 30):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.delay = base_delay
+        self.resume_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self._lock:
+                remaining = self.resume_at - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 5))
+
+    def trigger(self, reason: str = ''):
+        with self._lock:
+            if self.resume_at > time.time():
+                return # another worker already backed off
+            self.resume_at = time.time() + self.delay
+            print(f"[yellow]IA is overloaded ({reason}), pausing all uploads for {self.delay:.0f}s[/yellow]")
+            self.delay = min(self.delay * 2, self.max_delay)
+
+    def reset(self):
+        with self._lock:
+            self.delay = self.base_delay
+
+
+@dataclass
+class PendingEpisode:
+    podcast: Podcast
+    ep_audio_dir: Path
+    next_poll: float
+    polls: int = 0
+
+    @property
+    def identifier(self) -> str:
+        return f"podcast_ep_{self.ep_audio_dir.name}"
+
+
+class PendingQueue:
+    """ Episodes uploaded to IA whose item is not created yet.
+
+    Instead of blocking until IA creates the item, the uploader keeps going with
+    other episodes and polls the pending identifiers in batches from time to time.
+    """
+    def __init__(self, poll_interval: float = PENDING_POLL_INTERVAL, batch_size: int = PENDING_POLL_BATCH_SIZE):
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self._pending: Dict[str, PendingEpisode] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, podcast: Podcast, ep_audio_dir: Path):
+        pending = PendingEpisode(podcast=podcast, ep_audio_dir=ep_audio_dir,
+                                 next_poll=time.time() + self.poll_interval)
+        with self._lock:
+            self._pending[pending.identifier] = pending
+        print(f"{pending.identifier} is pending, {len(self)} item(s) in the pending queue")
+
+    def next_poll_in(self) -> float:
+        ''' seconds until the next pending item is due for polling '''
+        with self._lock:
+            if not self._pending:
+                return 0
+            return max(0, min(p.next_poll for p in self._pending.values()) - time.time())
+
+    def poll(self, session: ArchiveSession) -> List[PendingEpisode]:
+        ''' check the due items (a batch at most), return the ones created by IA and dequeue them '''
+        now = time.time()
+        with self._lock:
+            due = sorted((p for p in self._pending.values() if p.next_poll <= now), key=lambda p: p.next_poll)
+            due = due[:self.batch_size]
+        if not due:
+            return []
+
+        existing = items_exist([p.identifier for p in due], session=session)
+        existing |= items_exist_direct([p.identifier for p in due
+                                        if p.identifier not in existing and p.polls >= PENDING_POLL_DIRECT_AFTER],
+                                       session=session)
+        ready = []
+        with self._lock:
+            for pending in due:
+                if pending.identifier in existing:
+                    self._pending.pop(pending.identifier, None)
+                    ready.append(pending)
+                else:
+                    pending.polls += 1
+                    pending.next_poll = time.time() + min(self.poll_interval * 2 ** min(pending.polls, 8),
+                                                          PENDING_POLL_MAX_INTERVAL)
+        print(f"Pending queue: {len(ready)}/{len(due)} polled item(s) created, {len(self)} still pending")
+        return ready
+
+
+def scrape_upload_states(identifiers: List[str], session: ArchiveSession) -> Dict[str, Optional[str]]:
+    ''' {identifier: upload-state} of the existing items, with one scrape API query per SCRAPE_BATCH_SIZE identifiers
+
+    Items missing from the result do not exist (or are not indexed yet).
+    '''
+    url = f'{session.protocol}//{session.host}/services/search/v1/scrape'
+    upload_states: Dict[str, Optional[str]] = {}
+    for i in range(0, len(identifiers), SCRAPE_BATCH_SIZE):
+        batch = identifiers[i:i + SCRAPE_BATCH_SIZE]
+        params = {
+            'q': f'identifier:({" OR ".join(batch)})',
+            'fields': 'identifier,upload-state',
+            'count': 10000,
+        }
+        while True:
+            with metrics.timed('ia_scrape'):
+                r = session.get(url, params=params)
+                r.raise_for_status()
+            result = r.json()
+            for doc in result.get('items', []):
+                upload_state = doc.get('upload-state')
+                if isinstance(upload_state, list):
+                    upload_state = upload_state[0] if upload_state else None
+                upload_states[doc['identifier']] = upload_state
+            if not result.get('cursor'):
+                break
+            params['cursor'] = result['cursor']
+    return upload_states
+
+
+def items_exist(identifiers: List[str], session: ArchiveSession) -> Set[str]:
+    if not identifiers:
+        return set()
+    try:
+        return set(scrape_upload_states(identifiers, session=session))
+    except Exception as e:
+        print(f"Failed to scrape items: {e}, falling back to the metadata API")
+        return items_exist_direct(identifiers, session=session)
+
+
+def items_exist_direct(identifiers: List[str], session: ArchiveSession) -> Set[str]:
+    from internetarchive import get_item
+    exists = set()
+    for identifier in identifiers:
+        try:
+            if get_item(identifier, archive_session=session).exists:
+                exists.add(identifier)
+        except Exception as e:
+            print(f"Failed to get item {identifier}: {e}")
+    return exists
+
+
+class IAItemCache:
+    """ upload-state of the items of a podcast, prefetched in bulk
+
+    One scrape API query per SCRAPE_BATCH_SIZE episodes instead of one
+    metadata request per episode for the items already uploaded. The others
+    still need `get_item()`: their file list, and the scrape index lags
+    behind the items created recently (missing from it != missing).
+    """
+    def __init__(self):
+        self._upload_states: Dict[str, Optional[str]] = {}
+        self._checked: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def prefetch(self, identifiers: List[str], session: ArchiveSession):
+        with self._lock:
+            todo = [identifier for identifier in identifiers if identifier not in self._checked]
+        if not todo:
+            return
+        try:
+            upload_states = scrape_upload_states(todo, session=session)
+        except Exception as e:
+            logger.warn(f"Failed to prefetch {len(todo)} item(s), falling back to the metadata API: {e}")
+            return
+        with self._lock:
+            self._upload_states.update(upload_states)
+            self._checked.update(todo)
+        print(f"Prefetched {len(todo)} item(s): {len(upload_states)} exist, "
+              f"{sum(1 for state in upload_states.values() if state == 'uploaded')} uploaded")
+
+    def upload_state(self, identifier: str) -> Optional[str]:
+        with self._lock:
+            return self._upload_states.get(identifier)
+
+    def forget(self, identifier: str):
+        with self._lock:
+            self._checked.discard(identifier)
+            self._upload_states.pop(identifier, None)
+
 
-        upload_podcast(this_podcast, args=args, session=session)
+def is_slow_down(e: requests.exceptions.HTTPError) -> bool:
+    status_code = e.response.status_code if e.response is not None else None
+    return status_code == 503 or 'SlowDown' in str(e)
+
+
+def upload_podcasts(args: Args, session: ArchiveSession,
+                    session_factory: Optional[Callable[[], ArchiveSession]] = None):
+    item_cache = IAItemCache()
+
+    def iter_all_episodes():
+        for podcast_json_file_path in get_podcast_json_file_paths():
+            this_podcast = Podcast()
+            this_podcast.load(podcast_json_file_path)
+            assert this_podcast.id
+
+            # if not this_podcast.enabled
+            #     continue
+
+            yield from iter_podcast_episodes(this_podcast, args=args, session=session, item_cache=item_cache)
+
+    return run_uploads(iter_all_episodes(), args=args, session=session, session_factory=session_factory,
+                       item_cache=item_cache)
         
 
-def upload_podcast(podcast: Podcast, args: Args, session: ArchiveSession):
+def upload_podcast(podcast: Podcast, args: Args, session: ArchiveSession,
+                   session_factory: Optional[Callable[[], ArchiveSession]] = None):
+    item_cache = IAItemCache()
+    episodes = iter_podcast_episodes(podcast, args=args, session=session, item_cache=item_cache)
+    return run_uploads(episodes, args=args, session=session, session_factory=session_factory,
+                       item_cache=item_cache)
+
+
+def iter_podcast_episodes(podcast: Podcast, args: Args, session: ArchiveSession, item_cache: IAItemCache):
     logger.info(f'Uploading podcast: {podcast.id}: {podcast.title}')
+    ep_audio_dirs = list(iter_episodes_to_upload(podcast, args=args))
+    if ep_audio_dirs and not args.dry_run:
+        item_cache.prefetch([f"podcast_ep_{ep_audio_dir.name}" for ep_audio_dir in ep_audio_dirs], session=session)
+    for ep_audio_dir in ep_audio_dirs:
+        yield podcast, ep_audio_dir
+
+
+def upload_episode_job(podcast: Podcast, ep_audio_dir: Path, args: Args, session: ArchiveSession,
+                       stats: UploadStats, backoff: GlobalBackoff, item_cache: Optional[IAItemCache] = None):
+    while True:
+        backoff.wait()
+        try:
+            with resource_lock(DATA_DIR / EPISODE_LOCK_DIR, 'episode', ep_audio_dir.name):
+                result = upload_episode(podcast, ep_audio_dir, args=args, session=session, stats=stats,
+                                        item_cache=item_cache)
+        except AlreadyRunningError:
+            logger.warn(f"Another instance is uploading {ep_audio_dir.name}, skipping.")
+            stats.record('locked')
+            return None
+        except LeaseLostError as e:
+            logger.error(f'Failed to upload {ep_audio_dir.name}: {e}')
+            stats.record('failed')
+            return None
+        except requests.exceptions.HTTPError as e:
+            if not is_slow_down(e):
+                raise
+            backoff.trigger(reason=str(e)[:100])
+            continue # retry this episode
+
+        backoff.reset()
+        if result != PENDING_RESULT: # counted once it leaves the pending queue
+            stats.record('uploaded' if result is True else 'dry-run' if result is None else str(result))
+        return result
+
+
+def run_uploads(episodes: Iterable[Tuple[Podcast, Path]], args: Args, session: ArchiveSession,
+                session_factory: Optional[Callable[[], ArchiveSession]] = None,
+                item_cache: Optional[IAItemCache] = None) -> UploadStats:
+    """ upload episodes, `args.jobs` at a time, each worker thread uses its own session
+
+    Episodes whose item is not created by IA yet go to a PendingQueue, and are
+    finished (metadata, item image) once polling shows that the item exists.
+    """
+    stats = UploadStats()
+    backoff = GlobalBackoff()
+    pending_queue = PendingQueue()
+    local = threading.local()
+
+    def worker(podcast: Podcast, ep_audio_dir: Path):
+        if args.jobs <= 1 or session_factory is None:
+            worker_session = session
+        else:
+            if getattr(local, 'session', None) is None:
+                local.session = session_factory()
+            worker_session = local.session
+        return upload_episode_job(podcast, ep_audio_dir, args=args, session=worker_session, stats=stats, backoff=backoff,
+                                  item_cache=item_cache)
+
+    executor = ThreadPoolExecutor(max_workers=args.jobs, thread_name_prefix='upload') if args.jobs > 1 else None
+    running: Dict[Future, Tuple[Podcast, Path]] = {}
+
+    def handle_result(podcast: Podcast, ep_audio_dir: Path, result):
+        if result == PENDING_RESULT:
+            pending_queue.add(podcast, ep_audio_dir)
+
+    def collect(done):
+        for future in done:
+            podcast, ep_audio_dir = running.pop(future)
+            try:
+                handle_result(podcast, ep_audio_dir, future.result())
+            except Exception as e:
+                logger.error(f'Failed to upload {ep_audio_dir}: {e}')
+                stats.record('failed')
+
+    def submit(podcast: Podcast, ep_audio_dir: Path):
+        if executor is None:
+            handle_result(podcast, ep_audio_dir, worker(podcast, ep_audio_dir))
+            return
+        if len(running) >= args.jobs * 2:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            collect(done)
+        running[executor.submit(worker, podcast, ep_audio_dir)] = (podcast, ep_audio_dir)
+
+    def poll_pending():
+        if len(pending_queue) and pending_queue.next_poll_in() <= 0:
+            for pending in pending_queue.poll(session):
+                submit(pending.podcast, pending.ep_audio_dir)
+
+    try:
+        for podcast, ep_audio_dir in episodes:
+            submit(podcast, ep_audio_dir)
+            poll_pending()
+
+        # drain
+        while running or (len(pending_queue) and not args.no_wait):
+            if running:
+                done, _ = wait(running, timeout=pending_queue.next_poll_in() if len(pending_queue) else None,
+                               return_when=FIRST_COMPLETED)
+                collect(done)
+            elif pending_queue.next_poll_in() > 0:
+                print(f"Waiting for {len(pending_queue)} pending item(s) to be created...", end="\r")
+                time.sleep(pending_queue.next_poll_in())
+            poll_pending()
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    if len(pending_queue):
+        logger.warn(f"{len(pending_queue)} item(s) still in queue (pending), skipping. (pls re-run this script later)")
+        stats.results['pending'] = len(pending_queue)
+    print(stats.summary())
+    return stats
+
+def iter_episodes_to_upload(podcast: Podcast, args: Args):
     podcast_audio_dir = DATA_DIR / PODCAST_AUDIO_DIR / podcast.id
+    catalog = get_catalog()
+    if catalog.is_complete():
+        for guid_sha1 in catalog.episodes_to_upload(podcast.id, include_spam=args.not_spam):
+            yield podcast_audio_dir / guid_sha1
+        return
+
+    logger.warn('Episode catalog is incomplete, scanning episode directories. (run `podcastsPreserve --rebuild-catalog`)')
+    if not podcast_audio_dir.exists():
+        return
     for ep_audio_dir in podcast_audio_dir.iterdir():
         if not ep_audio_dir.is_dir():
             logger.warn(f'Not a directory: {ep_audio_dir}')
@@ -102,12 +493,8 @@ def upload_podcast(podcast: Podcast, args: Args, session: ArchiveSession):
         if (ep_audio_dir / SPAM_MARK).exists() and not args.not_spam:
             logger.warn(f'Marked as spam by IA: {ep_audio_dir}, skipping. (use --not-spam to reupload)')
             continue
-        try:
-            with FileLock(DATA_DIR / EPISODE_LOCK_DIR, ep_audio_dir.name):
-                upload_episode(podcast, ep_audio_dir, args=args, session=session)
-        except AlreadyRunningError:
-            logger.warn(f"Another instance is uploading {ep_audio_dir.name}, skipping.")
-            continue
+        yield ep_audio_dir
+
 
 def find_ep_metadata_file(files: list[Path])->Tuple[Optional[Path], Optional[str]]:
     for file in files:
@@ -172,27 +559,14 @@ def upload_itemimage(ep_sha1ed_guid: str, image_href: str, item: Item, args: Arg
         return
 
     ia_keys = IAKeys(args.keys_file)
-    r = item.upload({image_name : image_io},
-                    access_key=ia_keys.access,
-                    secret_key=ia_keys.secret,)
+    with metrics.timed('ia_upload'):
+        r = item.upload({image_name : image_io},
+                        access_key=ia_keys.access,
+                        secret_key=ia_keys.secret,)
+    metrics.add_bytes('ia_upload', len(image_io.getvalue()))
     logger.debug(f"Upload image response: {r}")
 
 
-def wait_for_item(identifier: str, session: ArchiveSession):
-    """ infinite wait for item to be created """
-    item = get_item(identifier, archive_session=session)  # refresh item
-    waited = 0
-    while not item.exists:
-        print(f"Waiting for item to be created ({waited}s waited)...", end="\r")
-        time.sleep(30)
-        waited += 30
-        try:
-            item = get_item(identifier, archive_session=session)
-        except Exception as e:
-            print("Failed to get item:", e, end="(retrying)")
-    
-    return item
-
 def sort_files_by_size(files: list[Path], ascending: bool = True)->list[Path]:
     return sorted(files, key=lambda f: f.stat().st_size, reverse=not ascending)
 
@@ -207,7 +581,9 @@ def pop_uploaded_files(filedict: dict[str, Path], item: Item):
             print(f"File {file_in_item['name']} already exists in {item.identifier}.")
 
 
-def upload_episode(podcast: Podcast, ep_audio_dir: Path, args: Args, session: ArchiveSession):
+def upload_episode(podcast: Podcast, ep_audio_dir: Path, args: Args, session: ArchiveSession,
+                   stats: Optional[UploadStats] = None, item_cache: Optional[IAItemCache] = None):
+    from internetarchive import get_item
     logger.info(f'Uploading episode: {ep_audio_dir}')
     files = list(ep_audio_dir.glob('*'))
 
@@ -229,6 +605,9 @@ def upload_episode(podcast: Podcast, ep_audio_dir: Path, args: Args, session: Ar
         if file.name.startswith(MARKS_PREFIX) and file.name.endswith(MARKS_SUFFIX):
             logger.debug(f'Found title mark file: {file}')
             continue
+        if file.name.endswith((PART_SUFFIX, PART_META_SUFFIX)):
+            logger.debug(f'Found unfinished download: {file}')
+            continue
 
         filedict[file.name] = file
         print(file.name, "<==", str(file))
@@ -305,6 +684,13 @@ def upload_episode(podcast: Podcast, ep_audio_dir: Path, args: Args, session: Ar
         # fresh upload
         logger.debug("No pending mark found, this is a fresh upload")
 
+        if item_cache is not None and item_cache.upload_state(identifier) == "uploaded":
+            logger.info(f"Item {identifier} already exists, skipping")
+            mark_as_uploaded(ep_audio_dir, identifier)
+            return True
+
+        # not found by the bulk lookup is no proof: the scrape index lags behind the new items,
+        # get the item to not re-upload its files or overwrite its metadata
         logger.debug("Getting item...")
         item = get_item(identifier, archive_session=session)
 
@@ -321,44 +707,47 @@ def upload_episode(podcast: Podcast, ep_audio_dir: Path, args: Args, session: Ar
         ia_keys = IAKeys(args.keys_file)
         try:
             print(metadata_init)
-            r = item.upload(files=filedict, metadata=metadata_init,
-                    access_key=ia_keys.access,
-                    secret_key=ia_keys.secret,
-                    verbose=True,
-                    queue_derive=True,
-                    retries=10,
-                )
+            with metrics.timed('ia_upload'):
+                r = item.upload(files=filedict, metadata=metadata_init,
+                        access_key=ia_keys.access,
+                        secret_key=ia_keys.secret,
+                        verbose=True,
+                        queue_derive=True,
+                        retries=10,
+                    )
+            uploaded_bytes = sum(file.stat().st_size for file in filedict.values())
+            metrics.add_bytes('ia_upload', uploaded_bytes)
+            if stats is not None:
+                stats.add_bytes(uploaded_bytes)
         except requests.exceptions.HTTPError as e:
             if "appears to be spam." in str(e):
                 with open(ep_audio_dir / SPAM_MARK, "w", encoding="utf-8") as f:
                     f.write(f"Spam")
+                get_catalog().set_upload_state(podcast.id, ep_sha1ed_guid, UPLOAD_STATE_SPAM, identifier)
                 logger.error(f"Upload failed: appears to be spam: {e}")
                 return "Upload failed: appears to be spam"
+            if is_slow_down(e):
+                raise # retried by upload_episode_job() after a global backoff
 
         with open(ep_audio_dir / PENDING_MARK, "w", encoding="utf-8") as f:
             f.write(f"Pending {identifier} to be created...")
+        get_catalog().set_upload_state(podcast.id, ep_sha1ed_guid, UPLOAD_STATE_PENDING, identifier)
     else: # pending previously
         logger.info("Found pending mark")
 
     # fresh uploaded or item created from pending
 
-    item = wait_for_item(identifier, session) if not args.no_wait else get_item(identifier, archive_session=session)
-
-    # NOTE:
-    # if args.no_wait:
-        # item.exists is Unkown(T/F)
-    # else: # wait_for_item
-        # item.exists is True
+    item = get_item(identifier, archive_session=session)
+    if not item.exists:
+        # don't block, the caller puts this episode in the PendingQueue
+        # and runs upload_episode() again once the item is created
+        logger.info(f"Item {identifier} still in queue (pending)")
+        return PENDING_RESULT
 
     if image_href := best_image_href(podcast, ep_metadata):
         print(f"Uploading item image... (optional)")
         upload_itemimage(ep_sha1ed_guid, image_href, item, args=args)
 
-    if args.no_wait:
-        if not item.exists:
-            logger.warn(f"Item {identifier} still in queue (pending), skipping. (pls re-run this script later))")
-            return "Still in queue, skipped"
-
     assert item.exists
 
     new_metadata = {}
@@ -373,13 +762,14 @@ def upload_episode(podcast: Podcast, ep_audio_dir: Path, args: Args, session: Ar
         print(f"Updating metadata...")
         print(new_metadata)
         ia_keys = IAKeys(args.keys_file)
-        r = item.modify_metadata(
-            metadata=new_metadata,
-            access_key=ia_keys.access,
-            secret_key=ia_keys.secret
-        )
-        assert isinstance(r, requests.Response)
-        r.raise_for_status()
+        with metrics.timed('ia_modify_metadata'):
+            r = item.modify_metadata(
+                metadata=new_metadata,
+                access_key=ia_keys.access,
+                secret_key=ia_keys.secret
+            )
+            assert isinstance(r, requests.Response)
+            r.raise_for_status()
         print(r.text)
         assert r.json()["success"] == True
     
@@ -395,27 +785,22 @@ def mark_as_uploaded(ep_audio_dir: Path, identifier: str):
         os.remove(ep_audio_dir / SPAM_MARK)
     if (ep_audio_dir / PENDING_MARK).exists():
         os.remove(ep_audio_dir / PENDING_MARK)
+    get_catalog().set_upload_state(ep_audio_dir.parent.name, ep_audio_dir.name, UPLOAD_STATE_UPLOADED, identifier)
 
     print(f"==> Uploaded {identifier} successfully!")
     print(f"==> https://archive.org/details/{identifier}")
 
-def main():
-    args = get_args()
-
+def make_ia_session(args: Args) -> ArchiveSession:
+    from internetarchive import get_session
     session: ArchiveSession = get_session()
     if args.insecure:
         session.verify = False
         requests.packages.urllib3.disable_warnings() # type: ignore
-        logger.warning("SSL certificate verification disabled")
 
     sess_patcher = SessionMonkeyPatch(session=session)
     sess_patcher.hijack()
 
-    stream_handler = logging.StreamHandler()
-    logger.addHandler(stream_handler)
     if args.debug:
-        logger.setLevel(logging.DEBUG)
-
         def print_request(r: requests.Response, *args, **kwargs):
         # TODO: use logging
         # print("H:", r.request.headers)
@@ -423,8 +808,26 @@ def main():
             if r.raw._connection.sock:
                 print(f"Conn: {r.raw._connection.sock.getsockname()} -> {r.raw._connection.sock.getpeername()[0]}")
         session.hooks['response'].append(print_request)
+
+    return session
+
+
+def main():
+    args = get_args()
+    configure_lease_coordinator(args.lease_db, ttl=args.lease_ttl)
+    metrics.configure_metrics(port=args.metrics_port, json_path=args.metrics_json)
+
+    session = make_ia_session(args)
+    if args.insecure:
+        logger.warning("SSL certificate verification disabled")
+
+    stream_handler = logging.StreamHandler()
+    logger.addHandler(stream_handler)
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
+    session_factory = lambda: make_ia_session(args)
     
     if args.feed:
         if args.feed.startswith("http"):
@@ -439,10 +842,10 @@ def main():
             podcast.load(podcast_json_file_path)
             break
         assert podcast.id, f"Podcast not found: {args.feed}"
-        upload_podcast(podcast, args=args, session=session)
+        upload_podcast(podcast, args=args, session=session, session_factory=session_factory)
         return
     
-    upload_podcasts(args=args, session=session)
+    upload_podcasts(args=args, session=session, session_factory=session_factory)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,186 @@
+""" Changes of the files of one directory: inotify (Linux, via ctypes) or polling.
+
+    watcher = open_dir_watcher(path)
+    changes = watcher.wait(timeout) # blocks until something changed, `timeout` or `wakeup()`
+    changes.names                   # names written, moved in, moved out or deleted since the last wait()
+    changes.overflow                # events were lost, rescan the directory
+
+Only finished writes are reported (`IN_CLOSE_WRITE`, `IN_MOVED_TO`), not half-written files.
+"""
+import dataclasses
+import errno
+import logging
+import os
+from pathlib import Path
+import select
+import struct
+import threading
+import time
+from typing import Dict, Optional, Set, Tuple, Union
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLL_INTERVAL = 60.0 # seconds, directory scans of the polling fallback
+
+# <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0o2000000)
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len
+READ_SIZE = 64 * 1024
+
+
+@dataclasses.dataclass
+class DirChanges:
+    names: Set[str] = dataclasses.field(default_factory=set)
+    overflow: bool = False
+
+    def __bool__(self) -> bool:
+        return bool(self.names) or self.overflow
+
+
+class DirWatcher:
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+
+    def wait(self, timeout: Optional[float] = None) -> DirChanges:
+        raise NotImplementedError
+
+    def wakeup(self):
+        ''' make a blocked wait() return now, safe to call from a signal handler '''
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class InotifyWatcher(DirWatcher):
+    def __init__(self, path: Union[str, Path]):
+        super().__init__(path)
+        import ctypes # only here, `podcastsPreserve -h` imports this module for DEFAULT_POLL_INTERVAL
+        import ctypes.util
+        libc_name = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(self.path), WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(e, os.strerror(e), str(self.path))
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_w, False)
+
+    def wait(self, timeout: Optional[float] = None) -> DirChanges:
+        readable, _, _ = select.select([self.fd, self._wakeup_r], [], [], timeout)
+        if self._wakeup_r in readable:
+            os.read(self._wakeup_r, READ_SIZE)
+        changes = DirChanges()
+        if self.fd in readable:
+            self._read_events(changes)
+        return changes
+
+    def _read_events(self, changes: DirChanges):
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(data):
+                _, mask, _, name_len = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + name_len].rstrip(b'\0'))
+                offset += name_len
+                if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    changes.overflow = True
+                elif name:
+                    changes.names.add(name)
+
+    def wakeup(self):
+        try:
+            os.write(self._wakeup_w, b'\0')
+        except BlockingIOError:
+            pass # already woken up
+
+    def close(self):
+        for fd in (self.fd, self._wakeup_r, self._wakeup_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class PollingWatcher(DirWatcher):
+    """ scans the directory every `poll_interval` seconds, compares (mtime, size) """
+    def __init__(self, path: Union[str, Path], poll_interval: float = DEFAULT_POLL_INTERVAL):
+        super().__init__(path)
+        self.poll_interval = poll_interval
+        self._woken = threading.Event()
+        self._snapshot = self._scan()
+        self._next_scan = time.monotonic() + poll_interval
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        snapshot = {}
+        try:
+            with os.scandir(self.path) as entries:
+                for entry in entries:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    snapshot[entry.name] = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            pass
+        return snapshot
+
+    def wait(self, timeout: Optional[float] = None) -> DirChanges:
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        changes = DirChanges()
+        while True:
+            now = time.monotonic()
+            if now >= self._next_scan:
+                snapshot = self._scan()
+                changes.names.update(name for name in snapshot.keys() | self._snapshot.keys()
+                                     if snapshot.get(name) != self._snapshot.get(name))
+                self._snapshot = snapshot
+                self._next_scan = now + self.poll_interval
+                if changes:
+                    return changes
+            wait_until = self._next_scan if deadline is None else min(self._next_scan, deadline)
+            if self._woken.wait(max(wait_until - now, 0)):
+                self._woken.clear()
+                return changes
+            if deadline is not None and time.monotonic() >= deadline:
+                return changes
+
+    def wakeup(self):
+        self._woken.set()
+
+
+def open_dir_watcher(path: Union[str, Path], poll_interval: float = DEFAULT_POLL_INTERVAL) -> DirWatcher:
+    ''' inotify if the platform has it, otherwise a PollingWatcher '''
+    try:
+        return InotifyWatcher(path)
+    except (OSError, AttributeError, TypeError) as e:
+        logger.info(f'dirwatch: inotify not available ({e}), polling {path} every {poll_interval:.0f}s')
+        return PollingWatcher(path, poll_interval=poll_interval)
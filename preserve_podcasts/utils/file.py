@@ -1,25 +1,70 @@
+import functools
 import hashlib
 import json
 import os
 from pathlib import Path
 import subprocess
+from typing import Optional, Tuple, Union
 
+from preserve_podcasts.utils import metrics
 
+
+HASH_CHUNK_SIZE = 1024 * 1024 # bytes
+
+
+class MultiHasher:
+    """ sha1 and md5 of the same stream, so that the data only has to be read once. """
+    def __init__(self):
+        self._sha1 = hashlib.sha1()
+        self._md5 = hashlib.md5()
+
+    def update(self, data: bytes):
+        self._sha1.update(data)
+        self._md5.update(data)
+
+    def update_from_file(self, file_path: Union[Path, str]):
+        with open(file_path, 'rb') as f:
+            while True:
+                data = f.read(HASH_CHUNK_SIZE)
+                if not data:
+                    break
+                self.update(data)
+
+    @property
+    def sha1(self) -> str:
+        return self._sha1.hexdigest()
+
+    @property
+    def md5(self) -> str:
+        return self._md5.hexdigest()
+
+
+def file_stat(file_path: Union[Path, str]) -> Optional[Tuple[int, int]]:
+    ''' (mtime_ns, size), None if the file does not exist: has the file changed since? '''
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+@metrics.timed('hash')
 def sha1file(file_path: Path):
     with open(file_path, 'rb') as f:
         sha1 = hashlib.sha1()
         while True:
-            data = f.read(1024)
+            data = f.read(HASH_CHUNK_SIZE)
             if not data:
                 break
             sha1.update(data)
     return sha1.hexdigest()
 
+@metrics.timed('hash')
 def md5file(file_path: Path):
     with open(file_path, 'rb') as f:
         md5 = hashlib.md5()
         while True:
-            data = f.read(1024)
+            data = f.read(HASH_CHUNK_SIZE)
             if not data:
                 break
             md5.update(data)
@@ -31,22 +76,39 @@ def is_playable(file_path: Path):
         return True
     
     return False
-    
-    
-def audio_duration(file_path: Path):
-    ''' Return audio duration in seconds, -1 if failed'''
-    if not file_path.exists():
-        raise FileNotFoundError(f'File not found: {file_path}')
 
-    rt_code = subprocess.check_call(['ffprobe', '-version'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    if rt_code != 0:
-        raise FileNotFoundError('ffprobe not found')
 
+@functools.lru_cache(maxsize=None)
+def ffprobe_available() -> bool:
+    ''' `ffprobe -version` only once per process '''
+    try:
+        rt_code = subprocess.call(['ffprobe', '-version'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except FileNotFoundError:
+        return False
+    return rt_code == 0
+
+
+@functools.lru_cache(maxsize=1024)
+def _ffprobe_duration(file_path: str, size: int, mtime_ns: int) -> int:
+    ''' cached by (path, size, mtime), a rewritten file is probed again '''
     try:
-        t = subprocess.check_output(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', file_path], stderr=subprocess.STDOUT)
+        with metrics.timed('ffprobe'):
+            t = subprocess.check_output(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', file_path], stderr=subprocess.STDOUT)
         duration = int(t.decode('utf-8').strip("\n").split('.')[0])
         return duration
     except KeyboardInterrupt:
         raise
     except:
         return -1 # failed
+
+
+def audio_duration(file_path: Path):
+    ''' Return audio duration in seconds, -1 if failed'''
+    if not file_path.exists():
+        raise FileNotFoundError(f'File not found: {file_path}')
+
+    if not ffprobe_available():
+        raise FileNotFoundError('ffprobe not found')
+
+    st = os.stat(file_path)
+    return _ffprobe_duration(str(file_path), st.st_size, st.st_mtime_ns)
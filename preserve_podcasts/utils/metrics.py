@@ -0,0 +1,195 @@
+""" In-process metrics of the hot paths: timing histograms, byte and error counters.
+
+Every stage (feed fetch, feed parse, episode download, hashing, ffprobe, IA upload...)
+is recorded under the same names, labeled by `stage`, so that one query tells which
+stage dominates the wall time:
+
+    ptp_stage_seconds{stage="..."}        histogram, one observation per call
+    ptp_stage_errors_total{stage, error}  calls that raised, by exception type
+    ptp_bytes_total{stage="..."}          bytes transferred or processed
+
+Exposed in the Prometheus text format on an optional local HTTP endpoint (`/metrics`,
+`/metrics.json`), and dumped as JSON at exit, see `configure_metrics()`.
+"""
+import atexit
+import bisect
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+STAGE_SECONDS = 'ptp_stage_seconds'
+STAGE_ERRORS = 'ptp_stage_errors_total'
+BYTES = 'ptp_bytes_total'
+
+# seconds, from a parsed feed (ms) to a large episode over a slow link (minutes)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+HELP = {
+    STAGE_SECONDS: 'Time spent in each stage',
+    STAGE_ERRORS: 'Calls of each stage that raised, by exception type',
+    BYTES: 'Bytes transferred or processed by each stage',
+}
+
+LabelsKey = Tuple[Tuple[str, str], ...]
+
+
+def _labels_key(labels: Dict[str, str]) -> LabelsKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: LabelsKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+class Histogram:
+    """ Not thread-safe, see MetricsRegistry. """
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        ''' [(le, count), ...] as in the Prometheus text format '''
+        result, total = [], 0
+        for le, count in zip([*map(str, self.buckets), '+Inf'], self.counts):
+            total += count
+            result.append((le, total))
+        return result
+
+
+class MetricsRegistry:
+    """ Counters and histograms by (name, labels). Thread-safe. """
+    def __init__(self):
+        self._counters: Dict[str, Dict[LabelsKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelsKey, Histogram]] = {}
+        self._lock = threading.Lock()
+        self.start_time = time.time()
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(value)
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.append(f'# HELP {name} {HELP.get(name, name)}')
+                lines.append(f'# TYPE {name} counter')
+                for key, value in sorted(series.items()):
+                    lines.append(f'{name}{_format_labels(key)} {value:g}')
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f'# HELP {name} {HELP.get(name, name)}')
+                lines.append(f'# TYPE {name} histogram')
+                for key, histogram in sorted(series.items()):
+                    for le, count in histogram.cumulative():
+                        lines.append(f'{name}_bucket{_format_labels(key, ("le", le))} {count}')
+                    lines.append(f'{name}_sum{_format_labels(key)} {histogram.sum:g}')
+                    lines.append(f'{name}_count{_format_labels(key)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                'start_time': self.start_time,
+                'uptime': time.time() - self.start_time,
+                'counters': {name: [{'labels': dict(key), 'value': value} for key, value in sorted(series.items())]
+                             for name, series in sorted(self._counters.items())},
+                'histograms': {name: [{'labels': dict(key), 'count': h.count, 'sum': h.sum,
+                                       'buckets': dict(h.cumulative())} for key, h in sorted(series.items())]
+                               for name, series in sorted(self._histograms.items())},
+            }
+
+
+REGISTRY = MetricsRegistry()
+
+
+def inc(name: str, value: float = 1, **labels: str):
+    REGISTRY.inc(name, value, **labels)
+
+
+def observe(name: str, value: float, **labels: str):
+    REGISTRY.observe(name, value, **labels)
+
+
+def add_bytes(stage: str, n: int):
+    REGISTRY.inc(BYTES, n, stage=stage)
+
+
+@contextlib.contextmanager
+def timed(stage: str) -> Iterator[None]:
+    ''' `with timed('feed_fetch'):` observes the duration in ptp_stage_seconds{stage},
+    and counts the exception in ptp_stage_errors_total{stage, error} if it raises '''
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        REGISTRY.inc(STAGE_ERRORS, stage=stage, error=type(e).__name__)
+        raise
+    finally:
+        REGISTRY.observe(STAGE_SECONDS, time.perf_counter() - start, stage=stage)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = REGISTRY.render_prometheus().encode('utf-8'), 'text/plain; version=0.0.4; charset=utf-8'
+        elif self.path == '/metrics.json':
+            body, content_type = json.dumps(REGISTRY.to_dict()).encode('utf-8'), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # no access log in the middle of the progress output
+
+
+def serve_metrics(port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    ''' serve /metrics and /metrics.json from a daemon thread '''
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+def dump_json(path: str):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(REGISTRY.to_dict(), f, indent=2)
+
+
+def configure_metrics(port: Optional[int] = None, json_path: Optional[str] = None, host: str = '127.0.0.1'):
+    ''' `--metrics-port`: serve the metrics locally, `--metrics-json`: dump them at exit '''
+    if port:
+        server = serve_metrics(port, host=host)
+        print(f'metrics: http://{host}:{server.server_address[1]}/metrics')
+    if json_path:
+        atexit.register(dump_json, json_path)
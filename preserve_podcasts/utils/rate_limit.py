@@ -0,0 +1,127 @@
+import email.utils
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+
+DEFAULT_HOST_RATE = 1.0 # requests per second, per host
+DEFAULT_HOST_BURST = 2 # requests
+MAX_RETRY_AFTER = 60 * 60 # seconds, ignore longer `Retry-After`s
+RETRY_AFTER_STATUS = (429, 503)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    ''' seconds to wait of a `Retry-After` header (delay-seconds or HTTP-date), None if invalid '''
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        seconds = float(value)
+    else:
+        try:
+            retry_at = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError, IndexError):
+            return None
+        if retry_at is None:
+            return None
+        seconds = retry_at.timestamp() - time.time()
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+
+class TokenBucket:
+    """ `rate` tokens per second, up to `burst` tokens. Not thread-safe, see HostRateLimiter. """
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0 # monotonic, set by `Retry-After`
+
+    def reserve(self) -> float:
+        ''' take a token, returns how long to wait before using it '''
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1 # may go negative: the token is borrowed from the future
+        delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(delay, self.blocked_until - now)
+
+
+class HostRateLimiter:
+    """ A token bucket per host: requests to different hosts don't wait for each other,
+    each host still gets at most `rate` requests per second (after a `burst`).
+
+    Thread-safe, share one limiter per process (`get_rate_limiter()`).
+    """
+    def __init__(self, rate: float = DEFAULT_HOST_RATE, burst: int = DEFAULT_HOST_BURST):
+        if rate <= 0 or burst < 1:
+            raise ValueError('rate must be > 0 and burst >= 1')
+        self.rate = rate
+        self.burst = burst
+        self._host_rates: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, host: str) -> TokenBucket:
+        bucket = self._host_rates.get(host)
+        if bucket is None:
+            bucket = self._host_rates[host] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def set_host_rate(self, host: str, rate: float, burst: int = 1):
+        ''' override the default rate of a host '''
+        with self._lock:
+            self._host_rates[host] = TokenBucket(rate, burst)
+
+    def reserve(self, host: str) -> float:
+        ''' reserve a request to `host`, returns the seconds to wait before sending it '''
+        with self._lock:
+            return self._bucket(host).reserve()
+
+    def wait(self, url_or_host: str):
+        ''' block until a request to `url_or_host` may be sent '''
+        delay = self.reserve(url_host(url_or_host))
+        if delay > 0:
+            time.sleep(delay)
+
+    def block(self, host: str, seconds: float):
+        ''' no request to `host` for `seconds` (`Retry-After`) '''
+        with self._lock:
+            bucket = self._bucket(host)
+            bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + seconds)
+
+    def observe(self, url: str, status_code: int, retry_after: Optional[str]) -> Optional[float]:
+        ''' honor the `Retry-After` of a 429/503 response, returns the parsed delay '''
+        if status_code not in RETRY_AFTER_STATUS:
+            return None
+        seconds = parse_retry_after(retry_after)
+        if seconds:
+            self.block(url_host(url), seconds)
+            print(f'rate limit: {url_host(url)} asked to retry after {seconds:.0f}s ({status_code})')
+        return seconds
+
+
+def url_host(url_or_host: str) -> str:
+    if '://' not in url_or_host:
+        return url_or_host.lower()
+    return (urlparse(url_or_host).hostname or '').lower()
+
+
+_rate_limiter: Optional[HostRateLimiter] = None
+_rate_limiter_lock = threading.Lock()
+
+def get_rate_limiter() -> HostRateLimiter:
+    ''' the process-wide limiter, shared by every session '''
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = HostRateLimiter()
+        return _rate_limiter
+
+
+def configure_rate_limiter(rate: float = DEFAULT_HOST_RATE, burst: int = DEFAULT_HOST_BURST) -> HostRateLimiter:
+    ''' replace the process-wide limiter, call it before creating sessions '''
+    global _rate_limiter
+    with _rate_limiter_lock:
+        _rate_limiter = HostRateLimiter(rate=rate, burst=burst)
+        return _rate_limiter
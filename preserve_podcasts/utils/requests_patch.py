@@ -1,9 +1,12 @@
 import time
+from typing import Optional
 import warnings
 
 import requests
 import requests.adapters
 
+from preserve_podcasts.utils.rate_limit import HostRateLimiter, get_rate_limiter, url_host
+
 
 class SessionMonkeyPatch:
     """
@@ -11,16 +14,17 @@ class SessionMonkeyPatch:
     """
     hijacked = False
     def __init__(self,*, session: requests.Session,
-                 hard_retries: int=5, delay: int=5,
+                 hard_retries: int=5, rate_limiter: Optional[HostRateLimiter]=None,
                  free_timeout_connections: bool=False, vaild_lft_sec: int=60 * 3
         ):
         """
         hard_retries: hard retries, default 0 (no retry)
+        rate_limiter: per-host rate limit of the requests, default: the process-wide one (`get_rate_limiter()`)
         free_timeout_connections: regularly(`vaild_lft_sec`) clear connections pool
         """
 
         self.session = session
-        self.delay = delay
+        self.rate_limiter = rate_limiter if rate_limiter is not None else get_rate_limiter()
         self.hard_retries = hard_retries
 
         self.free_timeout_connections: bool = free_timeout_connections
@@ -50,12 +54,16 @@ class SessionMonkeyPatch:
 
             while hard_retries_left > 0:
                 try:
-                    time.sleep(self.delay)
+                    delay = self.rate_limiter.reserve(url_host(request.url))
+                    if delay > 0:
+                        time.sleep(delay)
 
                     if self.free_timeout_connections:
                         self.clear_timeouted_pools()
 
-                    return self.old_send_method(request, **kwargs)
+                    response = self.old_send_method(request, **kwargs)
+                    self.rate_limiter.observe(request.url, response.status_code, response.headers.get('retry-after'))
+                    return response
                 except KeyboardInterrupt:
                     raise
                 except Exception as e:
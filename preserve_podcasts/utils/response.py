@@ -1,8 +1,7 @@
-from typing import Optional, Union
+from typing import Optional, Tuple, Union
 import time
 
 import requests
-import pyrfc6266
 from rich import print
 
 from preserve_podcasts.utils.type_check import runtimeTypeCheck
@@ -15,6 +14,27 @@ def get_content_length(r: requests.Response) -> int:
     return int(r.headers.get('content-length', -1))
 
 
+def get_content_range(r: requests.Response) -> Optional[Tuple[int, int, int]]:
+    """Get the `content-range` header of a 206 response as (first, last, complete_length).
+
+    `complete_length` is -1 if the server answered `*`.
+    If the header is not present or malformed, return None.
+    """
+    content_range = r.headers.get('content-range', None)
+    if content_range is None:
+        return None
+
+    try:
+        unit, _, range_and_length = content_range.strip().partition(' ')
+        if unit.lower() != 'bytes':
+            return None
+        byte_range, _, complete_length = range_and_length.partition('/')
+        first, _, last = byte_range.partition('-')
+        return (int(first), int(last), -1 if complete_length == '*' else int(complete_length))
+    except ValueError:
+        return None
+
+
 def get_content_type(r: requests.Response) -> Optional[str]:
     """Get the `content-type` header from a response.
 
@@ -78,6 +98,8 @@ def get_suggested_filename(r_or_string: Union[Optional[requests.Response], Optio
     """Get the suggested filename from a `content-disposition` string or a response. """
     if r_or_string is None:
         return None
+
+    import pyrfc6266 # pyparsing grammar, slow to import, only needed for downloads
     
     if isinstance(r_or_string, requests.Response):
         content_disposition = get_content_disposition(r_or_string)
@@ -1,33 +1,61 @@
+import functools
 import inspect
+import os
 from rich import print
 import sys
 
 FORCE_RAISE_EXCEPTION = False
 
+# `PTP_TYPECHECK=off` (or 0/false/no): the decorator returns the function itself, no overhead.
+# Read once at import, like the checks themselves which are resolved at decoration time.
+TYPECHECK_ENV = 'PTP_TYPECHECK'
+TYPECHECK_ENABLED = os.environ.get(TYPECHECK_ENV, 'on').strip().lower() not in ('off', '0', 'false', 'no')
+
+# isinstance() only understands `Optional[...]`/`Union[...]` annotations on Python >= 3.10
+TYPECHECK_SUPPORTED = sys.version_info >= (3, 10)
+
+_VAR_KINDS = (inspect.Parameter.VAR_POSITIONAL, inspect.Parameter.VAR_KEYWORD)
+_POSITIONAL_KINDS = (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD)
+
+
 class runtimeTypeCheck:
-    """ Decorator to check types at runtime. """
+    """ Decorator to check types at runtime.
+
+    The signature and the annotations to check are resolved once, when decorating:
+    a call only costs one isinstance() per argument passed (defaults are not checked).
+    """
 
     def __init__(self, raise_exception=True):
         self.raise_exception = raise_exception or FORCE_RAISE_EXCEPTION
 
     def __call__(self, f):
+        if not (TYPECHECK_ENABLED and TYPECHECK_SUPPORTED):
+            return f
+
+        sig = inspect.signature(f)
+        # {argument name: annotation}, arguments without annotation are never checked
+        checks = {name: param.annotation for name, param in sig.parameters.items()
+                  if name != 'self' and param.annotation is not inspect.Parameter.empty}
+        positional = tuple(name for name, param in sig.parameters.items() if param.kind in _POSITIONAL_KINDS)
+        has_var_args = any(param.kind in _VAR_KINDS for param in sig.parameters.values())
+
+        def fail(name, annotation):
+            if self.raise_exception:
+                raise TypeError(f'Argument {name} must be of type {annotation}')
+            print(f'[red]Warning: Argument {name} must be of type {annotation}[/red]')
+
+        @functools.wraps(f)
         def wrapper(*args, **kwargs):
-            sig = inspect.signature(f)
-            bound_args = sig.bind(*args, **kwargs)
-            if sys.version_info < (3, 10):
-                # print('[white]Info: Python version < 3.10, skip type check[/white]')
-                return f(*args, **kwargs)
-            for name, value in bound_args.arguments.items():
-                if name == 'self':
-                    continue
-                if name in sig.parameters:
-                    if not isinstance(value, sig.parameters[name].annotation):
-                        if sig.parameters[name].annotation is inspect._empty:
-                            print(f'[white]Info: Argument {name} has no type annotation, skip type check[/white]')
-                            continue
-                        if self.raise_exception:
-                            raise TypeError(f'Argument {name} must be of type {sig.parameters[name].annotation}')
-                        else:
-                            print(f'[red]Warning: Argument {name} must be of type {sig.parameters[name].annotation}[/red]')
+            if has_var_args or len(args) > len(positional):
+                # rare, let inspect map the arguments (and raise on a bad call)
+                items = sig.bind(*args, **kwargs).arguments.items()
+            else:
+                items = zip(positional, args)
+                if kwargs:
+                    items = (*items, *kwargs.items())
+            for name, value in items:
+                annotation = checks.get(name)
+                if annotation is not None and not isinstance(value, annotation):
+                    fail(name, annotation)
             return f(*args, **kwargs)
-        return wrapper
\ No newline at end of file
+        return wrapper
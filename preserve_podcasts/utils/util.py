@@ -13,32 +13,52 @@ NAMESPACE_PODCAST = uuid.UUID("ead4c236-bf58-58c6-a2c6-a6b28d128cb6")
 
 logger = logging.Logger(__name__)
 
+# str.translate() tables, {code point: replacement or None to remove}
+UNPRINTABLE_TABLE = {ord(c): None for c in UNPRINTABLE_CHARS}
+NTFS_TABLE = {ord(c): '_' for c in NTFS_CHARS}
+NTFS_SPACE_TABLE = {**NTFS_TABLE, ord(' '): '_'}
+SAFE_CHARS_TABLE = {**NTFS_TABLE, **UNPRINTABLE_TABLE}
+SAFE_CHARS_SPACE_TABLE = {**NTFS_SPACE_TABLE, **UNPRINTABLE_TABLE}
+
 @runtimeTypeCheck()
 def remove_unprintable_chars(s: str) -> str:
     """Remove unprintable characters."""
-    string = ''.join(c if c not in UNPRINTABLE_CHARS else '' for c in s)
-
-    return string
+    return s.translate(UNPRINTABLE_TABLE)
 
 
 @runtimeTypeCheck()
 def replace_ntfs_chars(s: str, replace_space: bool=True) -> str:
     """Replace NTFS reserved characters with underscores."""
-    to_replace = NTFS_CHARS
-    if replace_space:
-        to_replace += ' '
-    string = ''.join(c if c not in to_replace else '_' for c in s)
+    return s.translate(NTFS_SPACE_TABLE if replace_space else NTFS_TABLE)
+
+
+def truncate_utf8(s: str, max_bytes: int) -> str:
+    """ longest prefix of `s` that is at most `max_bytes` long in UTF-8, code points are never split """
+    encoded = s.encode('utf-8')
+    if len(encoded) <= max_bytes:
+        return s
+    if max_bytes <= 0:
+        return ''
+    # the cut may fall inside a multi-byte sequence: drop that incomplete code point
+    return encoded[:max_bytes].decode('utf-8', 'ignore')
 
-    return string
 
 @runtimeTypeCheck()
 def safe_chars(s: str, replace_space: bool=True, max_bytes: int=240, replace_last_dot: bool=True) -> str:
-    string = remove_unprintable_chars(s)
-    string = replace_ntfs_chars(string, replace_space=replace_space)
+    """ remove_unprintable_chars() + replace_ntfs_chars(), truncated to `max_bytes` of UTF-8 """
+    table = SAFE_CHARS_SPACE_TABLE if replace_space else SAFE_CHARS_TABLE
+    string = None
+    # every character is at least one byte: if the first max_bytes+1 characters are too long
+    # already, the rest is cut anyway and does not need to be translated
+    head_len = max(max_bytes, 0) + 1
+    if len(s) > head_len:
+        head = s[:head_len].translate(table)
+        if len(head.encode('utf-8')) > max_bytes:
+            s[head_len:].encode('utf-8') # still raises on a lone surrogate, as the whole title did
+            string = truncate_utf8(head, max_bytes)
+    if string is None:
+        string = truncate_utf8(s.translate(table), max_bytes)
 
-    while len(string.encode('utf-8')) > max_bytes:
-        string = string[:-1]
-    
     if replace_last_dot and string.endswith('.'):
         string = string[:-1] + '_'
 